@@ -0,0 +1,483 @@
+"""
+benchmark the pipeline stages on synthetic cubes
+
+generates *GENESIS*-like cubes of a configurable shape into a (temporary)
+`Storage` and times each stage of the pipeline separately:
+
+- load: `CubeRevision.load` (parsing the raw csv via regenesis)
+- unpack: `unpack_fact`
+- serialize: `serialize_fact`
+- fact_id: `compute_fact_id`
+- fulltext: `get_fulltext_data`
+- json: json encoding of the serialized facts
+- schema: `build_schema` for all generated cubes
+- compact: `facts.pack_facts` + `facts.serialize_facts`, the compact
+  alternative to unpack + serialize used by `jsonify` (not counted in the
+  totals). Its output is checked for parity with `serialize_fact` and the
+  pickled size of the records (what is sent to the workers) is compared to
+  the `regenesis` facts.
+- native: parsing the cube with the streaming `reader.Reader` instead of
+  regenesis (load), not counted in the totals. Its facts are checked for
+  parity with the `regenesis` facts.
+
+additionally, the encoding throughput of each available output encoder
+(see `genesapi.output`) is measured, and the peak memory of serializing each
+cube like a `jsonify --max-memory` worker, per byte of its `data.csv` and for
+each reader (`memory_factor`, see `scheduler.MEMORY_FACTOR`).
+
+the results are printed as json to stdout so that runs can be compared
+across commits:
+
+    genesapi bench > bench-before.json
+    # ...
+    genesapi bench --compare bench-before.json > bench-after.json
+
+with `--startup`, only the import time of some cli invocations is measured
+(via `python -X importtime`), with their slowest imports. The budget for it
+is checked by `tests/test_startup.py`:
+
+    genesapi bench --startup
+
+with `--fetch`, `fetch` is benchmarked against a local fake *GENESIS*
+server (see `genesapi.fake_genesis`) serving the synthetic cubes (or the
+recorded ones of an existing `--storage`), with the given `--latency` and
+`--error-rate`, once for each of the `--concurrency` settings. The throughput
+is reported in cubes per minute, the command fails if the fetched cubes
+differ from the served ones:
+
+    genesapi bench --fetch --cubes 20 --latency 200 --concurrency 1,4,8
+
+the synthetic cubes follow the section layout of the *GENESIS* "Datenquader"
+csv export: `K;<section>;<header>...` lines introduce a section, followed by
+`D;<values>...` data lines. Facts are in the `QEI` section, their dimension
+values are described by the `DQA` (axes), `DQZ` (time) and `DQI` (measures)
+sections.
+"""
+
+
+import functools
+import json
+import logging
+import os
+import pickle
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from datetime import datetime
+from itertools import product
+from time import perf_counter
+
+from genesapi.build_schema import _get_schema
+from genesapi.facts import SlimCube, pack_facts, serialize_facts
+from genesapi.output import get_available_encoders, get_encoder
+from genesapi.serve import get_args
+from genesapi.storage import Storage, Cube, CubeRevision, CubeSchema
+from genesapi.util import (
+    GENESIS_REGIONS,
+    compute_fact_id,
+    cube_serializer,
+    get_fulltext_data,
+    serialize_fact,
+    unpack_fact
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+STAGES = ('load', 'unpack', 'serialize', 'fact_id', 'fulltext', 'json', 'schema', 'compact', 'native')
+ALTERNATIVE_STAGES = ('compact', 'native')  # not counted in the totals
+MEMORY_READERS = ('regenesis', 'native')  # `jsonify --reader`, see `_bench_memory`
+STARTUP_COMMANDS = (('-h',), ('build_es_template', '{schema}'))
+REGION_ID_LENGTHS = (2, 2, 3, 5, 8)  # by region level, see `util.get_region_level`
+
+
+def _get_region_ids(level, n):
+    if level == 0:
+        return ['DG']
+    length = REGION_ID_LENGTHS[level]
+    return [str(i + 1).zfill(length) for i in range(n)]
+
+
+def generate_cube(name, measures=2, dimensions=2, values=5, region_level=3, regions=100, years=10, rows=None,
+                  seed=None):
+    """
+    return raw csv data for a synthetic cube with the given shape
+
+    `rows` limits the number of fact lines, otherwise all combinations of
+    `regions` x `values` ** `dimensions` x `years` are generated
+    """
+    rand = random.Random(seed if seed is not None else name)
+    statistic = name[:5]
+    region_key = GENESIS_REGIONS[region_level].upper()
+    region_ids = _get_region_ids(region_level, regions)
+    measure_keys = ['BENCH%s' % str(i + 1).zfill(2) for i in range(measures)]
+    dimension_keys = ['BDIM%s' % str(i + 1).zfill(2) for i in range(dimensions)]
+    dimension_values = {d: ['%sV%s' % (d, str(i + 1).zfill(3)) for i in range(values)] for d in dimension_keys}
+    year_values = [str(2019 - i) for i in range(years)]
+
+    lines = [
+        'K;DQ;FACH-SCHL;GHH-ART;GHM-WERTE-JN;GENESIS-VBD;REGIOSTAT;EU-VBD;"mit Werten"',
+        'D;%s;;N;N;N;N;J' % name,
+        'K;DQ-ERH;FACH-SCHL',
+        'D;%s' % statistic,
+        'K;DQA;NAME;RHF-BSR;RHF-ABSZ',
+        'D;%s;1;false' % region_key
+    ]
+    lines += ['D;%s;%s;false' % (d, i + 2) for i, d in enumerate(dimension_keys)]
+    lines += [
+        'K;DQZ;NAME;ZI-RHF-BSR;ZI-RHF-SORT',
+        'D;STAG;%s;false' % (len(dimension_keys) + 2),
+        'K;DQI;NAME;ME-NAME;DST;TYP;NKM-STELLEN;GHH-ART;GHM-WERTE-JN',
+    ]
+    lines += ['D;%s;Anzahl;FEST;GANZ;0;;N' % m for m in measure_keys]
+    lines += [
+        'K;ERH;NAME;INHALT;GUELTIG-VON;PERIODE',
+        'D;%s;Synthetische Statistik %s;01.01.1990;JAEHRLICH' % (statistic, statistic),
+        'K;MM;NAME;INHALT;MM-TYP;GLIED-TYP;SUMMIERBAR',
+        'D;%s;%s;K-REG-MM;;N' % (region_key, region_key.title())
+    ]
+    lines += ['D;%s;Dimension %s;K-SACH-MM;DAVON;N' % (d, d) for d in dimension_keys]
+    lines += ['D;%s;Merkmal %s;W-MM;;J' % (m, m) for m in measure_keys]
+    lines += ['K;KMA;MM-NAME;NAME;INHALT']
+    lines += ['D;%s;%s;Region %s' % (region_key, r, r) for r in region_ids]
+    lines += ['D;%s;%s;Auspraegung %s' % (d, v, v) for d in dimension_keys for v in dimension_values[d]]
+    lines += ['K;QEI;FACH-SCHL;ZI-WERT;%s' % ';'.join(['WERT;QUALITAET;GESPERRT;WERT-VERFAELSCHT'] * measures)]
+
+    combinations = product(region_ids, *[dimension_values[d] for d in dimension_keys], year_values)
+    for i, combination in enumerate(combinations):
+        if rows is not None and i >= rows:
+            break
+        key, year = ','.join(combination[:-1]), combination[-1]
+        cells = ['%s;e;;0.0' % rand.randint(0, 100000) for _ in measure_keys]
+        lines.append('D;%s;31.12.%s;%s' % (key, year, ';'.join(cells)))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_storage(directory, cubes=1, region_levels=(3,), **shape):
+    """
+    create a `Storage` at `directory` with `cubes` synthetic cubes for each
+    region level in `region_levels`
+    """
+    storage = Storage.create(directory)
+    stand = datetime.now().replace(microsecond=0)
+    for level in region_levels:
+        for i in range(cubes):
+            name = '99%s%sBJ%s' % (level, str(i).zfill(2), str(level).zfill(3))
+            cube = Cube(name, storage)
+            revision = CubeRevision(cube, stand.isoformat())
+            data = generate_cube(name, region_level=level, **shape)
+            revision.create({}, {'stand': stand.strftime('%d.%m.%Y %H:%M:%S'), 'status': 'synthetic'}, data)
+            cube.touch('last_updated')
+    return storage
+
+
+class Stopwatch:
+    def __init__(self):
+        self.seconds = {stage: 0. for stage in STAGES}
+        self.encoders = {}
+        self.transfer_bytes = {'facts': 0, 'compact': 0}
+        self.parity = True
+
+    def time(self, stage, func, *args):
+        start = perf_counter()
+        res = func(*args)
+        self.seconds[stage] += perf_counter() - start
+        return res
+
+
+def _bench_cube(cube, stopwatch):
+    revision = cube.current
+    regenesis_cube = stopwatch.time('load', revision.load)
+    facts = stopwatch.time('load', lambda: list(regenesis_cube.facts))
+    revision.__dict__['schema'] = CubeSchema(regenesis_cube)  # don't parse the cube again for the schema
+    schema = cube.schema
+    # prime cached properties so that they are not counted for the first stage that uses them
+    for prop in ('measures', 'dimensions', 'regions', 'statistic'):
+        getattr(schema, prop)
+
+    unpacked = stopwatch.time('unpack', lambda: [f for fact in facts for f in unpack_fact(fact, schema)])
+    serialized = stopwatch.time('serialize', lambda: [serialize_fact(f, cube) for f in unpacked])
+    stopwatch.time('fact_id', lambda: [compute_fact_id(f) for f in serialized])
+    stopwatch.time('fulltext', lambda: [get_fulltext_data(f, cube) for f in serialized])
+    stopwatch.time('json', lambda: [json.dumps(f) for f in serialized])
+
+    packed = stopwatch.time('compact', pack_facts, facts, schema)
+    compact = stopwatch.time('compact', lambda: list(serialize_facts(packed, cube)))
+    if sorted(json.dumps(f) for f in compact) != sorted(json.dumps(f) for f in serialized):
+        logger.error('Compact serialization of cube `%s` differs from `serialize_fact`!' % cube)
+        stopwatch.parity = False
+    # what is passed to the workers: the facts with the cube (and its parsed schema) or the compact
+    # records with a `SlimCube`
+    stopwatch.transfer_bytes['facts'] += len(pickle.dumps((facts, cube)))
+    stopwatch.transfer_bytes['compact'] += len(pickle.dumps((packed, SlimCube(cube, schema))))
+
+    with revision.read() as reader:
+        native = stopwatch.time('native', lambda: list(reader.facts()))
+    if _get_fingerprints(native) != _get_fingerprints(f.to_dict() for f in facts):
+        logger.error('Native reader facts of cube `%s` differ from regenesis!' % cube)
+        stopwatch.parity = False
+
+    encoders = [(encoder, get_encoder(encoder)) for encoder in get_available_encoders()]
+    try:
+        encoders.append(('msgpack', get_encoder(format='msgpack')))
+    except ImportError:
+        pass
+    for encoder, encode in encoders:
+        start = perf_counter()
+        for fact in serialized:
+            encode(fact)
+        stopwatch.encoders[encoder] = stopwatch.encoders.get(encoder, 0) + perf_counter() - start
+    return len(serialized)
+
+
+def _get_fingerprints(facts):
+    return sorted(json.dumps(f, sort_keys=True, default=cube_serializer) for f in facts)
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ('git', 'rev-parse', 'HEAD'), cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def _get_maxrss():
+    # in bytes, `ru_maxrss` is in kilobytes on linux, but in bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _get_peak_rss():
+    return round(_get_maxrss() / 1024 / 1024, 1)
+
+
+def _get_memory_factor(directory, reader, name):
+    # runs in a fresh (forked) process per cube: the peak memory of
+    # serializing the cube like a `scheduler` worker does, per byte of its
+    # `data.csv` (see `scheduler.MEMORY_FACTOR`). A forked process starts
+    # with the peak of its parent, so only what this cube adds counts.
+    from genesapi.jsonify import _serialize_cube
+    cube = Storage(directory).cube(name)
+    start = _get_maxrss()
+    _serialize_cube(cube, get_args('jsonify', directory, '--reader', reader, '--force-export'), chunked=False)
+    return (_get_maxrss() - start) / cube.size
+
+
+def _bench_memory(storage, cubes):
+    """
+    return the memory factor of each reader over `cubes`: the maximum and the
+    median of their peak memory per byte of `data.csv`
+    """
+    import genesapi.jsonify  # noqa, imported once before the workers are forked
+    from multiprocessing import get_context
+
+    results = {}
+    for reader in MEMORY_READERS:
+        func = functools.partial(_get_memory_factor, storage.directory, reader)
+        with get_context('fork').Pool(1, maxtasksperchild=1) as P:
+            factors = sorted(P.map(func, [c.name for c in cubes if c.size], chunksize=1))
+        if factors:
+            results[reader] = {'max': factors[-1], 'median': factors[len(factors) // 2]}
+    return results
+
+
+def get_import_time(argv):
+    """
+    return the cumulative import time (in ms) of `genesapi <argv>` and all
+    imports (slowest first), measured with `python -X importtime`
+    """
+    code = 'import sys; sys.argv = %r; from genesapi.entry import main; main()' % (['genesapi'] + list(argv))
+    res = subprocess.run((sys.executable, '-X', 'importtime', '-c', code),
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    total, imports, started = 0, [], False
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        # ignore everything the interpreter imports on its own before `genesapi`
+        started = started or 'genesapi' in name
+        if started:
+            imports.append((name.strip(), int(self_us) / 1000))
+            if not name.startswith('  '):  # top level import
+                total += int(cumulative_us) / 1000
+    return total, sorted(imports, key=lambda x: x[1], reverse=True)
+
+
+def _bench_startup(args):
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as schema:
+        schema.write('{}')
+        schema.flush()
+        results = {}
+        for argv in STARTUP_COMMANDS:
+            argv = [a.format(schema=schema.name) for a in argv]
+            total, imports = get_import_time(argv)
+            command = ' '.join(['genesapi'] + argv[:1])
+            results[command] = {'import_ms': total, 'slowest': imports[:10]}
+            logger.info('`%s`: %.1f ms imports' % (command, total))
+            for name, ms in imports[:10]:
+                logger.debug('  %8.1f ms  %s' % (ms, name))
+
+    sys.stdout.write(json.dumps(results, indent=2))
+
+
+def _compare(results, fp):
+    with open(fp) as f:
+        previous = json.load(f)
+    logger.info('Comparing with `%s` (commit %s):' % (fp, previous.get('commit')))
+    for stage in STAGES:
+        if stage not in previous['stages']:  # results of an older version
+            continue
+        before, after = previous['stages'][stage]['seconds'], results['stages'][stage]['seconds']
+        if before:
+            logger.info('  %-10s %8.3fs -> %8.3fs (%+.1f%%)' % (stage, before, after, (after / before - 1) * 100))
+    logger.info('  facts/sec  %8.0f  -> %8.0f' % (previous['facts_per_second'], results['facts_per_second']))
+
+
+def _bench_fetch(args, shape, region_levels):
+    from genesapi import fetch
+    from genesapi.fake_genesis import FakeGenesis
+    from genesapi.serve import get_args
+
+    directory = tempfile.mkdtemp(prefix='genesapi-bench-fetch-')
+    catalog = os.getenv('CATALOG')
+    results = {}
+    try:
+        if args.storage and os.path.exists(args.storage):
+            source = Storage(args.storage)
+            logger.info('Serving recorded cubes from `%s` ...' % source)
+        else:
+            source = generate_storage(os.path.join(directory, 'source'), args.cubes, region_levels, **shape)
+        hashes = {c.name: c.current.data_hash for c in source}
+        # restrict the catalog requests of `fetch` to the served cubes
+        prefix = os.path.commonprefix(list(hashes))
+        with FakeGenesis(source, latency=args.latency / 1000, error_rate=args.error_rate, seed=0) as server:
+            os.environ['CATALOG'] = os.path.join(directory, 'catalog.yml')
+            server.write_catalog(os.environ['CATALOG'])
+            for concurrency in (int(c) for c in args.concurrency.split(',')):
+                target = os.path.join(directory, 'fetch-%s' % concurrency)
+                argv = [target, '--new', '--concurrency', str(concurrency)] + (['--prefix', prefix] if prefix else [])
+                requests, errors = sum(server.requests.values()), server.errors
+                start = perf_counter()
+                fetch.main(get_args('fetch', *argv))
+                seconds = perf_counter() - start
+                fetched = {c.name: c.current.data_hash for c in Storage(target)}
+                results[concurrency] = {
+                    'seconds': seconds,
+                    'cubes': len(fetched),
+                    'cubes_per_minute': len(fetched) / seconds * 60 if seconds else 0,
+                    'requests': sum(server.requests.values()) - requests,
+                    'errors': server.errors - errors,
+                    'parity': fetched == hashes
+                }
+                logger.info('  concurrency %3s %8.3fs %8.1f cubes/min (%s requests, %s errors)' % (
+                    concurrency, seconds, results[concurrency]['cubes_per_minute'],
+                    results[concurrency]['requests'], results[concurrency]['errors']))
+    finally:
+        if catalog is None:
+            os.environ.pop('CATALOG', None)
+        else:
+            os.environ['CATALOG'] = catalog
+        shutil.rmtree(directory)
+
+    sys.stdout.write(json.dumps({
+        'commit': _get_commit(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'shape': {**shape, **{'cubes': args.cubes, 'region_levels': region_levels}},
+        'latency_ms': args.latency,
+        'error_rate': args.error_rate,
+        'concurrency': results
+    }, indent=2))
+    failed = [c for c, r in results.items() if not r['parity']]
+    if failed:
+        logger.error('Fetched cubes differ from the served ones for concurrency: %s' % ', '.join(map(str, failed)))
+        sys.exit(1)
+
+
+def main(args):
+    if args.startup:
+        return _bench_startup(args)
+
+    shape = {
+        'measures': args.measures,
+        'dimensions': args.dimensions,
+        'values': args.values,
+        'regions': args.regions,
+        'years': args.years,
+        'rows': args.rows
+    }
+    region_levels = tuple(int(level) for level in args.region_levels.split(','))
+    if args.fetch:
+        return _bench_fetch(args, shape, region_levels)
+
+    directory = args.storage or tempfile.mkdtemp(prefix='genesapi-bench-')
+    if args.storage and os.path.exists(args.storage):
+        storage = Storage(directory)
+        logger.info('Using existing Storage `%s` ...' % storage)
+    else:
+        logger.info('Generating synthetic cubes into `%s` ...' % directory)
+        storage = generate_storage(directory, args.cubes, region_levels, **shape)
+
+    try:
+        stopwatch = Stopwatch()
+        facts = 0
+        cubes = storage.cubes
+        for cube in cubes:
+            logger.info('Benchmarking cube `%s` ...' % cube)
+            facts += _bench_cube(cube, stopwatch)
+        stopwatch.time('schema', _get_schema, [c.current.load() for c in cubes])
+        memory_factor = _bench_memory(storage, cubes)
+    finally:
+        if not args.storage:
+            shutil.rmtree(directory)
+
+    total = sum(v for k, v in stopwatch.seconds.items() if k not in ALTERNATIVE_STAGES)
+    fact_seconds = sum(v for k, v in stopwatch.seconds.items() if k not in ('schema',) + ALTERNATIVE_STAGES)
+    results = {
+        'commit': _get_commit(),
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'shape': {**shape, **{'cubes': args.cubes, 'region_levels': region_levels}},
+        'cubes': len(cubes),
+        'facts': facts,
+        'facts_per_second': facts / fact_seconds if fact_seconds else 0,
+        'peak_rss_mb': _get_peak_rss(),
+        'memory_factor': memory_factor,
+        'stages': {stage: {
+            'seconds': seconds,
+            'share': seconds / total if total else 0,
+            'facts_per_second': facts / seconds if seconds and stage != 'schema' else None
+        } for stage, seconds in stopwatch.seconds.items()},
+        'encoders': {encoder: {
+            'seconds': seconds,
+            'facts_per_second': facts / seconds if seconds else None
+        } for encoder, seconds in stopwatch.encoders.items()},
+        'compact_parity': stopwatch.parity,
+        'transfer_bytes': stopwatch.transfer_bytes
+    }
+
+    logger.info('Benchmarked %s facts in %s cubes (%.0f facts/sec, peak rss %s MB)' %
+                (facts, len(cubes), results['facts_per_second'], results['peak_rss_mb']))
+    for stage, result in results['stages'].items():
+        logger.info('  %-10s %8.3fs %5.1f%%' % (stage, result['seconds'], result['share'] * 100))
+    for encoder, result in results['encoders'].items():
+        logger.info('  encoder %-8s %10.0f facts/sec' % (encoder, result['facts_per_second'] or 0))
+    logger.info('  pickled facts for workers: %s bytes, compact: %s bytes' %
+                (stopwatch.transfer_bytes['facts'], stopwatch.transfer_bytes['compact']))
+    for reader, factor in memory_factor.items():
+        logger.info('  memory per byte of data.csv (%s): max %.1f, median %.1f (`jsonify --memory-factor`)' %
+                    (reader, factor['max'], factor['median']))
+    if args.compare:
+        _compare(results, args.compare)
+
+    sys.stdout.write(json.dumps(results, indent=2))
+    if not stopwatch.parity:
+        sys.exit(1)
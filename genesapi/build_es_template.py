@@ -7,10 +7,79 @@ import json
 import logging
 import sys
 
+from genesapi.util import get_index_name
+
 
 logger = logging.getLogger(__name__)
 
 
+INDEX_SORT_FIELDS = ('region_id', 'year', 'statistic')
+# `statistic` is in the cube table for the `compact` output profile of `jsonify`
+COMPACT_INDEX_SORT_FIELDS = ('region_id', 'year', 'cube')
+
+
+def _split(value):
+    return [v.strip() for v in value.split(',') if v.strip()] if value else []
+
+
+def _get_dimensions(schema):
+    return set(
+        dimension for statistic in schema.values()
+        for measure in statistic.get('measures', {}).values()
+        for dimension in measure.get('dimensions', {}).keys()
+    )
+
+
+def _get_path_fields(schema):
+    # dynamic mapping of `path` creates an object for each measure and a field
+    # for each of its dimensions: `path.<measure>.<dimension>`
+    measures = {}
+    for statistic in schema.values():
+        for measure_key, measure in statistic.get('measures', {}).items():
+            measures.setdefault(measure_key, set()).update(measure.get('dimensions', {}).keys())
+    return len(measures) + sum(len(d) for d in measures.values())
+
+
+def _get_path_mapping(args):
+    if args.path == 'flattened':
+        return {'type': 'flattened'}
+    if args.path == 'disabled':
+        return {'type': 'object', 'enabled': False}
+    return {'type': 'object'}
+
+
+def _get_sort_fields(args):
+    return COMPACT_INDEX_SORT_FIELDS if args.output_profile == 'compact' else INDEX_SORT_FIELDS
+
+
+def _get_keyword_mapping(field, args):
+    mapping = {'type': 'keyword'}
+    aggregatable = _split(args.aggregatable)
+    if aggregatable and field not in aggregatable and not (args.index_sort and field in _get_sort_fields(args)):
+        mapping['doc_values'] = False
+    if field in _split(args.eager_global_ordinals):
+        mapping['eager_global_ordinals'] = True
+    return mapping
+
+
+def _get_settings(args):
+    settings = {
+        'index.mapping.total_fields.limit': 100000,
+        'index.number_of_shards': args.shards,
+        'index.number_of_replicas': args.replicas
+    }
+    if args.index_sort:
+        settings['index.sort.field'] = list(_get_sort_fields(args))
+        settings['index.sort.order'] = ['asc'] * len(_get_sort_fields(args))
+    if args.best_compression:
+        settings['index.codec'] = 'best_compression'
+    if args.bulk_load:
+        # set these back after the initial load, e.g. `"refresh_interval": "1s"`
+        settings['index.refresh_interval'] = '-1'
+        settings['index.number_of_replicas'] = 0
+    return settings
+
+
 def _get_template(schema, args):
     # mapping = {
     #     field: {'type': 'keyword'}
@@ -28,27 +97,80 @@ def _get_template(schema, args):
     #             'type': 'category'
     #         }]
     #     }
-    return {
+    template = {
         'index_patterns': [args.index_pattern],
         'mappings': {
             'properties': {**{
-                field: {'type': 'keyword'} for field in set(
-                    dimension for statistic in schema.values()
-                    for measure in statistic.get('measures', {}).values()
-                    for dimension in measure.get('dimensions', {}).keys()
-                ) | set(['region_id', 'nuts', 'lau', 'cube', 'statistic'])
-            }, **{'path': {'type': 'object'}, 'year': {'type': 'short'}}}
+                field: _get_keyword_mapping(field, args) for field in
+                _get_dimensions(schema) | set(['region_id', 'nuts', 'lau', 'cube', 'statistic'])
+            }, **{'path': _get_path_mapping(args), 'year': {'type': 'short'}}}
         },
-        'settings': {
-            'index.mapping.total_fields.limit': 100000,
-            'index.number_of_shards': args.shards,
-            'index.number_of_replicas': args.replicas
-        }
+        'settings': _get_settings(args)
     }
+    if args.rollup:
+        template['mappings']['properties']['derived'] = {'type': 'boolean'}
+    if args.output_profile == 'compact':
+        # compact facts have neither `path` nor `statistic`
+        for field in ('path', 'statistic'):
+            del template['mappings']['properties'][field]
+    # no `aliases` here: every new index matching the pattern would join them
+    # while it is still loading, see `_get_alias_actions`
+    return template
+
+
+def _get_alias_actions(index, args):
+    """
+    body for the `_aliases` api to atomically switch `args.alias` for a
+    statistic (or group of statistics) from its current index(es) to `index`,
+    e.g. `genesapi-12111-2` after rebuilding with `jsonify --index-version 2`
+
+    `index` can also be a pattern (e.g. `genesapi-*`) to add all existing
+    indexes to the alias after the initial load
+    """
+    if '*' in index:
+        return {'actions': [{'add': {'index': index, 'alias': args.alias}}]}
+    previous = get_index_name(index[len(args.index_prefix) + 1:], args.index_prefix, args.index_granularity)
+    return {'actions': [
+        {'remove': {'index': '%s*' % previous, 'alias': args.alias}},
+        {'add': {'index': index, 'alias': args.alias}}
+    ]}
+
+
+def _report(schema, template):
+    properties = template['mappings']['properties']
+    path_fields = _get_path_fields(schema)
+    if 'path' not in properties:
+        fields = len(properties)
+        logger.info('no `path` (compact profile): saves ~%s fields' % path_fields)
+    elif properties['path']['type'] == 'object' and properties['path'].get('enabled', True):
+        fields = len(properties) + path_fields
+        logger.info('`path` as dynamic object: ~%s fields' % path_fields)
+    else:
+        fields = len(properties)
+        logger.info('`path` as `%s`: saves ~%s fields' % (
+            'disabled' if properties['path']['type'] == 'object' else properties['path']['type'], path_fields - 1))
+    without_doc_values = [k for k, v in properties.items() if v.get('doc_values') is False]
+    logger.info('doc_values disabled for %s of %s keyword fields' % (
+        len(without_doc_values), len([v for v in properties.values() if v['type'] == 'keyword'])))
+    logger.info('eager_global_ordinals for: %s' % (
+        ', '.join(k for k, v in properties.items() if v.get('eager_global_ordinals')) or '-'))
+    logger.info('Mapped fields (without dynamic measure values): ~%s' % fields)
 
 
 def main(args):
+    if args.swap:
+        if not args.alias:
+            raise ValueError('`--swap` requires `--alias`')
+        sys.stdout.write(json.dumps(_get_alias_actions(args.swap, args), indent=2))
+        return
+    if args.alias:
+        raise ValueError('`--alias` is only applied with `--swap`, the template doesn\'t add indexes to it')
+    if not args.schema:
+        raise ValueError('`schema` is required (unless `--swap` is given)')
+
     with open(args.schema) as f:
         schema = json.load(f)
 
-    sys.stdout.write(json.dumps(_get_template(schema, args), indent=2))
+    template = _get_template(schema, args)
+    _report(schema, template)
+    sys.stdout.write(json.dumps(template, indent=2))
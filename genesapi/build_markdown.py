@@ -1,8 +1,16 @@
 """
 build frontmatter markdown files for schema attributes (e.g. for jekyll)
+
+only files whose rendered content changed are (re)written, unchanged files
+are not touched so that their mtime is kept and static site generators don't
+need to rebuild everything. The sha1 of each rendered document is kept in a
+manifest file (`.genesapi-manifest.json`, ignored by jekyll) in the output
+directory, keys that are in the manifest but no longer in the schema are
+reported as deleted.
 """
 
 
+import hashlib
 import json
 import os
 import logging
@@ -14,22 +22,58 @@ from genesapi.util import parallelize
 logger = logging.getLogger(__name__)
 
 
+MANIFEST = '.genesapi-manifest.json'
+THREADS_THRESHOLD = 1000  # use threads instead of processes for less schema items
+
+
 def _build_item(data):
     content = data.pop('description') or data['name']
     return frontmatter.Post(content, **data)
 
 
-def _process_items(items, output):
+def _get_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def _is_unchanged(fp, content_hash, manifest_hash):
+    if not os.path.isfile(fp):
+        return False
+    if content_hash == manifest_hash:
+        return True
+    with open(fp) as f:
+        return _get_hash(f.read()) == content_hash
+
+
+def _process_items(items, output, manifest):
     res = []
     for key, data in items:
-        matter = _build_item(data)
+        content = frontmatter.dumps(_build_item(data))
+        content_hash = _get_hash(content)
         fp = os.path.join(output, '%s.md' % key.lower())
-        with open(fp, 'w') as f:
-            f.write(frontmatter.dumps(matter))
-        res.append((key, fp))
+        changed = not _is_unchanged(fp, content_hash, manifest.get(key))
+        if changed:
+            with open('%s.tmp' % fp, 'w') as f:
+                f.write(content)
+            os.replace('%s.tmp' % fp, fp)
+        res.append((key, fp, content_hash, changed))
     return res
 
 
+def _load_manifest(output):
+    fp = os.path.join(output, MANIFEST)
+    if os.path.isfile(fp):
+        with open(fp) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_manifest(output, manifest):
+    fp = os.path.join(output, MANIFEST)
+    with open('%s.tmp' % fp, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace('%s.tmp' % fp, fp)
+
+
 def main(args):
     if not os.path.isdir(args.output):
         logger.log(logging.ERROR, 'output `%s` not valid.' % args.output)
@@ -38,6 +82,20 @@ def main(args):
     with open(args.schema) as f:
         schema = json.load(f)
 
-    items = parallelize(_process_items, list(schema.items()), args.output)
-    for key, fp in items:
-        logger.log(logging.INFO, 'Saved `%s` to `%s`' % (key, fp))
+    manifest = _load_manifest(args.output)
+    threads = len(schema) < THREADS_THRESHOLD
+    items = parallelize(_process_items, list(schema.items()), args.output, manifest, threads=threads)
+
+    new_manifest = {}
+    written = 0
+    for key, fp, content_hash, changed in items:
+        new_manifest[key] = content_hash
+        if changed:
+            written += 1
+            logger.log(logging.INFO, 'Saved `%s` to `%s`' % (key, fp))
+    _save_manifest(args.output, new_manifest)
+
+    for key in sorted(set(manifest) - set(new_manifest)):
+        logger.log(logging.WARNING, 'Key `%s` was deleted from the schema, file: `%s`' %
+                   (key, os.path.join(args.output, '%s.md' % key.lower())))
+    logger.log(logging.INFO, 'Saved %s changed files, %s unchanged.' % (written, len(new_manifest) - written))
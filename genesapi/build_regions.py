@@ -16,6 +16,9 @@ build name mapping for regions
         }
     },
 }
+
+with `--hierarchy <path>`, also write the region hierarchy (parents, children,
+regions per level) to `<path>.json` and `<path>.bin`, see `genesapi.hierarchy`
 """
 
 
@@ -23,10 +26,8 @@ import json
 import logging
 import os
 import sys
-import pandas as pd
-
-from elasticsearch import Elasticsearch
 
+from genesapi.hierarchy import build_hierarchy, write as write_hierarchy
 from genesapi.storage import Storage
 from genesapi.util import time_to_json
 
@@ -48,6 +49,9 @@ def main(args):
                 regions[region_id] = region
 
     if args.host and args.index:
+        import pandas as pd
+        from elasticsearch import Elasticsearch
+
         logger.info(f'Aggregate dates from ES: {args.host}/{args.index}')
         auth = os.getenv('ELASTIC_AUTH', None)
         es = Elasticsearch(hosts=[args.host], http_auth=auth)
@@ -79,4 +83,13 @@ def main(args):
             except KeyError:
                 pass
 
+    if args.hierarchy:
+        # precomputed parents, children and levels, see `genesapi.hierarchy`
+        hierarchy = build_hierarchy(regions)
+        with open('%s.json' % args.hierarchy, 'w') as f:
+            json.dump(hierarchy, f)
+        write_hierarchy('%s.bin' % args.hierarchy, hierarchy)
+        logger.info('Wrote hierarchy of %s regions to `%s.json` and `%s.bin`' %
+                    (len(regions), args.hierarchy, args.hierarchy))
+
     sys.stdout.write(json.dumps(regions, default=time_to_json))
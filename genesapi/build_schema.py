@@ -56,12 +56,14 @@ schema layout:
 """
 
 
+import hashlib
 import json
 import logging
+import os
 import sys
 
-from genesapi.storage import Storage, CubeSchema
-from genesapi.util import cube_serializer
+from genesapi.storage import Storage, CubeSchema, schema_cache
+from genesapi.util import cube_serializer, parse_shard
 
 
 logger = logging.getLogger(__name__)
@@ -73,15 +75,36 @@ def _dumper(value):
     return cube_serializer(value)
 
 
-def main(args):
-    storage = Storage(args.directory)
-    schema = {}
-    for cube in storage._cubes:
+def _add_measures(schema, statistic_info, measures):
+    statistic_key = statistic_info['name']
+    if statistic_key in schema:
+        existing_measures = schema[statistic_key]['measures']
+        for measure_key, measure_info in measures.items():
+            if measure_key not in existing_measures:
+                existing_measures[measure_key] = measure_info
+            else:
+                existing_measures[measure_key]['region_levels'] |= measure_info['region_levels']
+                for k, v in measure_info['dimensions'].items():
+                    existing_measures[measure_key]['dimensions'][k] = v
+                existing_measures[measure_key]['cubes'] |= measure_info['cubes']
+    else:
+        schema[statistic_key] = statistic_info
+        schema[statistic_key]['measures'] = measures
+
+
+def _get_schema(cubes, schema=None, revisions=None, provenance=None):
+    """
+    add the measures of `cubes` (regenesis cubes) to `schema`, optional
+    `revisions` maps cube names to the revision that is loaded, recorded per
+    cube in `provenance` (if given, see `_write_provenance`)
+    """
+    schema = schema if schema is not None else {}
+    revisions = revisions or {}
+    for cube in cubes:
         logger.info('Loading `%s` ...' % cube.name)
         try:
             # get measures with their dimensions from cube
             statistic_info = cube.metadata['statistic']
-            statistic_key = statistic_info['name']
             cube_schema = CubeSchema(cube)
             measures = cube_schema.measures
 
@@ -90,22 +113,134 @@ def main(args):
                 measure_info['dimensions'] = cube_schema.dimensions
                 measure_info['region_levels'] = cube_schema.region_levels
                 measure_info['cubes'] = set([cube.name])
+            if provenance is not None:
+                provenance[cube.name] = {
+                    'revision': revisions.get(cube.name),
+                    'region_levels': sorted(cube_schema.region_levels),
+                    'dimensions': sorted(cube_schema.dimensions.keys())
+                }
 
             # add measures to schema
-            if statistic_key in schema:
-                existing_measures = schema[statistic_key]['measures']
-                for measure_key, measure_info in measures.items():
-                    if measure_key not in existing_measures:
-                        existing_measures[measure_key] = measure_info
-                    else:
-                        existing_measures[measure_key]['region_levels'] |= measure_info['region_levels']
-                        for k, v in measure_info['dimensions'].items():
-                            existing_measures[measure_key]['dimensions'][k] = v
-                        existing_measures[measure_key]['cubes'] |= measure_info['cubes']
-            else:
-                schema[statistic_key] = statistic_info
-                schema[statistic_key]['measures'] = measures
+            _add_measures(schema, statistic_info, measures)
         except KeyError:
             logger.warn('No metadata for cube `%s`' % cube.name)
-
-    sys.stdout.write(json.dumps(schema, default=_dumper))
+    return schema
+
+
+def _load_schema(fp):
+    with open(fp) as f:
+        schema = json.load(f)
+    for statistic in schema.values():
+        for measure in statistic['measures'].values():
+            measure['region_levels'] = set(measure['region_levels'])
+            measure['cubes'] = set(measure['cubes'])
+            measure.pop('provenance', None)  # schemas built before the provenance file
+    return schema
+
+
+def _get_hash(fp):
+    with open(fp, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _load_provenance(fp, schema_fp):
+    """
+    return the provenance of the cubes of the schema `schema_fp` from the
+    provenance file `fp` or `None` if it doesn't exist or belongs to another
+    version of the schema
+    """
+    if not fp or not os.path.exists(fp):
+        return
+    with open(fp) as f:
+        provenance = json.load(f)
+    if provenance['schema'] != _get_hash(schema_fp):
+        logger.warning('Provenance `%s` doesn\'t match the schema `%s`.' % (fp, schema_fp))
+        return
+    return provenance['cubes']
+
+
+def _write_provenance(fp, provenance, output):
+    """
+    the provenance of each cube (`revision`, `region_levels`, `dimensions`)
+    in a file next to the schema, `output`: the schema json, its hash ties
+    both together
+    """
+    with open('%s.tmp' % fp, 'w') as f:
+        json.dump({'schema': hashlib.sha1(output.encode('utf-8')).hexdigest(), 'cubes': provenance}, f)
+    os.replace('%s.tmp' % fp, fp)
+
+
+def _merge_schema(schema, other):
+    for statistic_info in other.values():
+        _add_measures(schema, statistic_info, statistic_info['measures'])
+    return schema
+
+
+def _remove_cubes(schema, cube_names, provenance):
+    """
+    remove the contributions of `cube_names` from `schema`: drop them from
+    the measures' cubes, re-compute region levels and dimensions from the
+    remaining cubes (via their `provenance`) and drop measures & statistics
+    without any cubes left
+    """
+    for statistic_key, statistic in list(schema.items()):
+        measures = statistic['measures']
+        for measure_key, measure in list(measures.items()):
+            if not measure['cubes'] & cube_names:
+                continue
+            measure['cubes'] -= cube_names
+            if not measure['cubes']:
+                del measures[measure_key]
+                continue
+            remaining = [provenance[c] for c in measure['cubes'] if c in provenance]
+            measure['region_levels'] = set(l for p in remaining for l in p['region_levels'])
+            dimensions = set(d for p in remaining for d in p['dimensions'])
+            measure['dimensions'] = {k: v for k, v in measure['dimensions'].items() if k in dimensions}
+        if not measures:
+            del schema[statistic_key]
+    return schema
+
+
+def _load_cubes(cubes):
+    for cube in cubes:
+        regenesis_cube = cube.current.load()
+        if schema_cache.size:
+            # for `jsonify` in the same process (see `genesapi serve`)
+            cube.current.get_schema(regenesis_cube)
+        yield regenesis_cube
+
+
+def main(args, stream=None):
+    storage = Storage(args.directory)
+    provenance_fp = args.provenance or ('%s.provenance.json' % args.previous if args.previous else None)
+    provenance = {} if provenance_fp else None
+    schema = {}
+    for fp in args.merge or ():
+        logger.info('Merging schema `%s` ...' % fp)
+        _merge_schema(schema, _load_schema(fp))
+        if provenance is not None:
+            provenance.update(_load_provenance('%s.provenance.json' % fp, fp) or {})
+    shard = parse_shard(args.shard) if args.shard else None
+    cubes = storage.get_cubes(shard)
+    # the revision name (date), no need to read the data to detect changes
+    revisions = {c.name: c.current.name for c in cubes}
+
+    if args.previous:
+        previous = _load_schema(args.previous)
+        previous_provenance = _load_provenance(provenance_fp, args.previous)
+        if previous_provenance is None:
+            logger.warning('No provenance for schema `%s`, rebuilding everything.' % args.previous)
+        else:
+            deleted = set(previous_provenance) - set(c.name for c in storage.cubes)
+            cubes = [c for c in cubes if previous_provenance.get(c.name, {}).get('revision') != revisions[c.name]]
+            removed = deleted | set(c.name for c in cubes)
+            logger.info('Updating schema `%s`: %s changed cubes, %s deleted cubes.' %
+                        (args.previous, len(cubes), len(deleted)))
+            schema = _merge_schema(_remove_cubes(previous, removed, previous_provenance), schema)
+            provenance.update({k: v for k, v in previous_provenance.items() if k not in removed})
+
+    schema = _get_schema(_load_cubes(cubes), schema, revisions, provenance)
+    output = json.dumps(schema, default=_dumper)
+    (stream or sys.stdout).write(output)
+    if provenance_fp:
+        _write_provenance(provenance_fp, provenance, output)
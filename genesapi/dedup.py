@@ -0,0 +1,204 @@
+"""
+drop duplicate facts across cubes (and runs) before they are written
+
+the same fact (same `fact_id`) is often published in several cubes of a
+statistic. `FactIndex` keeps track of all facts written so far in a compact
+on-disk hash table (memory-mapped, 24 bytes per fact, so only the touched
+pages need to be in memory):
+
+    fact key (128 bit, from the fact_id)  ->  value hash (32 bit) | stand (32 bit)
+
+the slot is found by the first 64 bits of the key, the other 64 bits are
+compared on a hit, so two facts are only mixed up if 128 bits of their
+`fact_id` collide.
+
+a fact is skipped if it was already written with the same value, or if it
+was written from a cube that is more recent (`stand`, the `last_updated` of
+the facts) than the current one. `jsonify --dedup` processes the cubes
+ordered by their `stand` (most recent first), so that the freshest version of
+a fact wins.
+
+the index is kept in the storage (`facts.idx`) across runs, so facts that
+didn't change are not sent again after a cube update. It needs to be reset
+(`--dedup-reset`) if the target (e.g. the Elasticsearch index) is rebuilt
+from scratch. Each shard (`jsonify --shard`) has its own index, so duplicates
+across shards are not detected.
+
+the workers of `util.parallelize` only read the index, the main process
+writes it after each cube.
+"""
+
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+
+MAGIC = b'GAPIDDP2'
+LEGACY_MAGIC = (b'GAPIDDP1',)
+HEADER = struct.Struct('<8sQQ')  # magic, capacity, size
+SLOT = struct.Struct('<QQQ')  # fact key (high, low 64 bits), entry
+INITIAL_CAPACITY = 1 << 16  # slots, must be a power of 2
+MAX_LOAD = .7
+MASK = 0xffffffff
+KEY_MASK = (1 << 64) - 1
+
+
+def get_fact_key(fact_id):
+    # `fact_id` is a sha1 hexdigest already, a high part of 0 marks empty slots
+    key = int(fact_id[:32], 16)
+    if not key >> 64:
+        key |= 1 << 64
+    return key
+
+
+def get_entry(value, stand):
+    """
+    `value`: the serialized measure of the fact (`{'value': ..., 'quality': ...}`)
+    `stand`: datetime of the cube's last update
+    """
+    value_hash = int.from_bytes(hashlib.sha1(json.dumps(value, sort_keys=True).encode('utf-8')).digest()[:4], 'big')
+    return value_hash << 32 | int(stand.timestamp() / 60) & MASK
+
+
+def is_duplicate(stored, entry):
+    """
+    `stored`: entry in the index for this fact (or `None`)
+    """
+    if stored is None:
+        return False
+    return stored >> 32 == entry >> 32 or stored & MASK > entry & MASK
+
+
+class FactIndex:
+    def __init__(self, fp, readonly=False):
+        self.fp = fp
+        self.readonly = readonly
+        self._file = None
+        self._data = None
+        self.capacity = 0
+        self.size = 0
+        if not os.path.exists(fp) and not readonly:
+            self._create(fp, INITIAL_CAPACITY)
+        if os.path.exists(fp):
+            self._open()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def _create(fp, capacity):
+        with open(fp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, capacity, 0))
+            f.truncate(HEADER.size + capacity * SLOT.size)
+
+    def _open(self):
+        self._file = open(self.fp, 'rb' if self.readonly else 'r+b')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+        magic, self.capacity, self.size = HEADER.unpack_from(self._data)
+        if magic in LEGACY_MAGIC:
+            self.close()
+            raise ValueError('`%s` was created by an older version, reset it with `--dedup-reset`.' % self.fp)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('`%s` is not a fact index.' % self.fp)
+
+    def close(self):
+        if self._data is not None:
+            if not self.readonly:
+                self._data.flush()
+            self._data.close()
+            self._file.close()
+            self._data = self._file = None
+
+    def _find(self, key):
+        # linear probing on the high part of the key, the slot only matches if
+        # the low part is the same as well. Return offset, whether the slot is
+        # taken and entry of the slot
+        mask = self.capacity - 1
+        high, low = key >> 64, key & KEY_MASK
+        i = high & mask
+        while True:
+            offset = HEADER.size + i * SLOT.size
+            stored_high, stored_low, entry = SLOT.unpack_from(self._data, offset)
+            if stored_high == 0:
+                return offset, False, entry
+            if stored_high == high and stored_low == low:
+                return offset, True, entry
+            i = (i + 1) & mask
+
+    def get(self, key):
+        if self._data is None:
+            return
+        _, found, entry = self._find(key)
+        if found:
+            return entry
+
+    def put(self, key, entry):
+        offset, found, _ = self._find(key)
+        SLOT.pack_into(self._data, offset, key >> 64, key & KEY_MASK, entry)
+        if not found:
+            self.size += 1
+            HEADER.pack_into(self._data, 0, MAGIC, self.capacity, self.size)
+            if self.size > self.capacity * MAX_LOAD:
+                self._grow()
+
+    def items(self):
+        for i in range(self.capacity):
+            high, low, entry = SLOT.unpack_from(self._data, HEADER.size + i * SLOT.size)
+            if high:
+                yield high << 64 | low, entry
+
+    def _grow(self):
+        fp = '%s.tmp' % self.fp
+        self._create(fp, self.capacity * 2)
+        with FactIndex(fp) as index:
+            for key, entry in self.items():
+                index.put(key, entry)
+        self.close()
+        os.replace(fp, self.fp)
+        self._open()
+
+
+class Deduplicator:
+    """
+    decide in the main process which facts of a cube to write, the index is
+    only updated (`commit`) once all facts of the cube are written
+    """
+    def __init__(self, fp, reset=False):
+        if reset and os.path.exists(fp):
+            os.remove(fp)
+        self.index = FactIndex(fp)
+        self.pending = {}
+        self.skipped = 0
+        self.bytes_saved = 0
+
+    def check(self, key, entry, data, size=0):
+        """
+        `data`: encoded fact or `None` if a worker already found it to be a
+        duplicate, `size`: its encoded size, return if it should be written
+        """
+        stored = self.pending[key] if key in self.pending else self.index.get(key)
+        if stored is None or stored & MASK <= entry & MASK:
+            self.pending[key] = entry
+        if data is None or is_duplicate(stored, entry):
+            self.skipped += 1
+            self.bytes_saved += size
+            return False
+        return True
+
+    def commit(self):
+        for key, entry in self.pending.items():
+            self.index.put(key, entry)
+        self.pending = {}
+
+    def close(self):
+        self.index.close()
@@ -25,13 +25,41 @@ COMMANDS = {
             'flag': '--force-update',
             'help': 'Re-download all cubes regardless if they are already up to date.',
             'action': 'store_true'
+        }, {
+            'flag': '--resume',
+            'help': 'Resume the last unfinished run (see `logs/fetch.journal` in the storage)',
+            'action': 'store_true'
+        }, {
+            'flag': '--slice-threshold',
+            'help': 'Download cubes bigger than this (in MB, according to their current revision) in slices '
+                    '(by region or years) concurrently',
+            'type': int
+        }, {
+            'flag': '--concurrency',
+            'help': 'Number of cubes to download at once (default: 1)',
+            'type': int,
+            'default': 1
         })
     },
     'build_schema': {
         'args': ({
             'flag': 'directory',
             'help': 'Directory with raw cubes downloaded via the `fetch` command'
-        },)
+        }, {
+            'flag': '--shard',
+            'help': 'Only process the cubes of shard `i` of `N` (format: `i/N`, e.g. `1/4`)'
+        }, {
+            'flag': '--merge',
+            'help': 'Merge these schema files (e.g. from other shards) into the output',
+            'nargs': '+'
+        }, {
+            'flag': '--previous',
+            'help': 'Update this previous schema output: only re-process cubes that changed since'
+        }, {
+            'flag': '--provenance',
+            'help': 'Write the revision, region levels and dimensions of each cube to this file (default with '
+                    '`--previous`: `<PREVIOUS>.provenance.json`), needed for the next `--previous` update'
+        })
     },
     'build_markdown': {
         'args': ({
@@ -52,19 +80,25 @@ COMMANDS = {
         }, {
             'flag': '--index',
             'help': 'Elastic index'
+        }, {
+            'flag': '--hierarchy',
+            'help': 'Also write the region hierarchy (parents, children, levels) to `<HIERARCHY>.json` and '
+                    '`<HIERARCHY>.bin`'
         })
     },
     'build_es_template': {
         'args': ({
             'flag': 'schema',
-            'help': 'JSON file from `build_schema` output'
+            'help': 'JSON file from `build_schema` output (not needed for `--swap`)',
+            'nargs': '?'
         }, {
             'flag': '--index-pattern',
             'help': 'Elasticsearch index pattern',
             'default': 'genesapi-*'
         }, {
             'flag': '--shards',
-            'help': 'Number of shards for elasticsearch index',
+            'help': 'Number of shards for elasticsearch index (per index: use 1 for one index per statistic, '
+                    'see `jsonify --index-prefix`, otherwise ~1000 indexes get 5 shards each)',
             'type': int,
             'default': 5
         }, {
@@ -72,6 +106,56 @@ COMMANDS = {
             'help': 'Number of replicas for elasticsearch index',
             'type': int,
             'default': 0
+        }, {
+            'flag': '--path',
+            'help': 'Mapping for the `path` field: dynamic `object` (default), `flattened` or `disabled`',
+            'choices': ('object', 'flattened', 'disabled'),
+            'default': 'object'
+        }, {
+            'flag': '--index-sort',
+            'help': 'Sort the index by `region_id`, `year`, `statistic`',
+            'action': 'store_true'
+        }, {
+            'flag': '--best-compression',
+            'help': 'Use the `best_compression` codec',
+            'action': 'store_true'
+        }, {
+            'flag': '--aggregatable',
+            'help': 'Comma separated fields to aggregate on, `doc_values` are disabled for all other keyword fields'
+        }, {
+            'flag': '--eager-global-ordinals',
+            'help': 'Comma separated (hot) keyword fields to load global ordinals eagerly for'
+        }, {
+            'flag': '--bulk-load',
+            'help': 'Settings for the initial bulk load: no refresh, no replicas',
+            'action': 'store_true'
+        }, {
+            'flag': '--alias',
+            'help': 'Alias that spans all indexes (e.g. one per statistic), for `--swap`'
+        }, {
+            'flag': '--swap',
+            'help': 'Instead of the template, print the `_aliases` actions to switch `--alias` to this (rebuilt) '
+                    'index, or to add all indexes matching a pattern (e.g. `genesapi-*`) to it'
+        }, {
+            'flag': '--index-prefix',
+            'help': 'Index prefix used for `jsonify --index-prefix` (for `--swap`)',
+            'default': 'genesapi'
+        }, {
+            'flag': '--index-granularity',
+            'help': 'Index granularity used for `jsonify --index-granularity` (for `--swap`)',
+            'type': int,
+            'default': 5
+        }, {
+            'flag': '--profile',
+            'help': 'Output profile of `jsonify --profile`: `compact` drops the `path` and `statistic` mappings and '
+                    'sorts by `cube` instead of `statistic` (with `--index-sort`)',
+            'dest': 'output_profile',
+            'choices': ('full', 'compact'),
+            'default': 'full'
+        }, {
+            'flag': '--rollup',
+            'help': 'Map the `derived` flag of the sums of `jsonify --rollup` as boolean',
+            'action': 'store_true'
         })
     },
     'jsonify': {
@@ -100,6 +184,291 @@ COMMANDS = {
             'flag': '--fulltext',
             'help': 'Index schema and region names and context for fulltext search',
             'action': 'store_true'
+        }, {
+            'flag': '--encoder',
+            'help': 'JSON encoder to use, `orjson` and `ujson` need to be installed (default: json)',
+            'choices': ('json', 'orjson', 'ujson'),
+            'default': 'json'
+        }, {
+            'flag': '--format',
+            'help': 'Output format for stdout, `msgpack` needs to be installed (default: json)',
+            'choices': ('json', 'msgpack'),
+            'default': 'json'
+        }, {
+            'flag': '--shard',
+            'help': 'Only serialize the cubes of shard `i` of `N` (format: `i/N`, e.g. `1/4`)'
+        }, {
+            'flag': '--resume',
+            'help': 'Resume the last unfinished run (see `logs/jsonify.journal` in the storage)',
+            'action': 'store_true'
+        }, {
+            'flag': '--index-prefix',
+            'help': 'Route facts to one index per statistic: add an `index` field like `<prefix>-<statistic>`'
+        }, {
+            'flag': '--index-granularity',
+            'help': 'Number of leading digits of the cube name for the index name, 5: per statistic (default), '
+                    'less: per group of statistics',
+            'type': int,
+            'default': 5
+        }, {
+            'flag': '--index-version',
+            'help': 'Append this version to the index names, to rebuild statistics in fresh indexes'
+        }, {
+            'flag': '--reader',
+            'help': 'Parse the cubes with `regenesis` (default) or the faster, streaming `native` reader',
+            'choices': ('regenesis', 'native'),
+            'default': 'regenesis'
+        }, {
+            'flag': '--dedup',
+            'help': 'Skip facts that were already written (in this or previous runs) with the same value or '
+                    'from a more recent cube, see `facts.idx` in the storage',
+            'action': 'store_true'
+        }, {
+            'flag': '--dedup-reset',
+            'help': 'Reset the index of written facts for `--dedup` (e.g. after the target index was rebuilt)',
+            'action': 'store_true'
+        }, {
+            'flag': '--rollup',
+            'help': 'Add derived facts: sums of summable measures for unpublished region levels and totals over '
+                    'dimensions',
+            'action': 'store_true'
+        }, {
+            'flag': '--hierarchy',
+            'help': 'Region hierarchy (`.bin`) from `build_regions --hierarchy` for the region sums of `--rollup`'
+        }, {
+            'flag': '--max-memory',
+            'help': 'Memory budget in MB: serialize several cubes at once (one per core) as long as their '
+                    'estimated memory fits, bigger cubes alone',
+            'type': int
+        }, {
+            'flag': '--memory-factor',
+            'help': 'Estimated peak memory per byte of a cube\'s `data.csv` for `--max-memory` (default: 45), '
+                    'measure it for your cubes with `genesapi bench --storage` (`memory_factor`)',
+            'type': float
+        }, {
+            'flag': '--profile',
+            'help': 'Output profile: `full` (default) or `compact`, without the per-cube fields (see `--cube-table`) '
+                    'and the fields derivable from others (`path`, `year_name`, fulltext `dimensions`)',
+            'dest': 'output_profile',
+            'choices': ('full', 'compact'),
+            'default': 'full'
+        }, {
+            'flag': '--cube-table',
+            'help': 'ndjson file to append the per-cube fields of `--profile compact` to, one record per exported '
+                    'cube (default: `cubes.ndjson` in the storage)'
+        }, {
+            'flag': '--region-levels',
+            'help': 'Comma separated region levels to serialize, 0: Deutschland, 1: Länder, 2: Regierungsbezirke, '
+                    '3: Kreise, 4: Gemeinden (e.g. "3")'
+        }, {
+            'flag': '--since-year',
+            'help': 'Only serialize facts from this year on',
+            'type': int
+        }, {
+            'flag': '--until-year',
+            'help': 'Only serialize facts up to this year',
+            'type': int
+        }, {
+            'flag': '--measures',
+            'help': 'Comma separated measures to serialize (e.g. "BEVSTD,WOHNY1")'
+        })
+    },
+    'export_parquet': {
+        'args': ({
+            'flag': 'storage',
+            'help': 'Directory with raw cubes downloaded via the `fetch` command'
+        }, {
+            'flag': 'output',
+            'help': 'Output directory for the partitioned parquet dataset'
+        }, {
+            'flag': '--prefix',
+            'help': 'Prefix for cube names to filter for'
+        }, {
+            'flag': '--force-export',
+            'help': 'Export cubes even if they are up to date according to the storage.',
+            'action': 'store_true'
+        }, {
+            'flag': '--compression',
+            'help': 'Parquet compression codec (default: zstd)',
+            'default': 'zstd'
+        }, {
+            'flag': '--duckdb',
+            'help': 'Create (or update) this duckdb database with a `facts` view on the dataset'
+        })
+    },
+    'fake_genesis': {
+        'args': ({
+            'flag': 'storage',
+            'help': 'Storage with the (recorded or synthetic) cubes to serve'
+        }, {
+            'flag': '--host',
+            'help': 'Host to listen on (default: 127.0.0.1)',
+            'default': '127.0.0.1'
+        }, {
+            'flag': '--port',
+            'help': 'Port to listen on (default: 8080)',
+            'type': int,
+            'default': 8080
+        }, {
+            'flag': '--latency',
+            'help': 'Latency per request in milliseconds (default: 0)',
+            'type': int,
+            'default': 0
+        }, {
+            'flag': '--error-rate',
+            'help': 'Share of requests that fail with http status 503, e.g. 0.05 (default: 0)',
+            'type': float,
+            'default': 0
+        }, {
+            'flag': '--catalog',
+            'help': 'Write a catalog file for `fetch` (via `CATALOG`) that points to this server'
+        })
+    },
+    'bench': {
+        'args': ({
+            'flag': '--storage',
+            'help': 'Use (or create) the Storage at this directory instead of a temporary one'
+        }, {
+            'flag': '--cubes',
+            'help': 'Number of synthetic cubes per region level',
+            'type': int,
+            'default': 2
+        }, {
+            'flag': '--measures',
+            'help': 'Number of measures per cube',
+            'type': int,
+            'default': 2
+        }, {
+            'flag': '--dimensions',
+            'help': 'Number of dimensions per cube (without region & time)',
+            'type': int,
+            'default': 2
+        }, {
+            'flag': '--values',
+            'help': 'Number of values per dimension',
+            'type': int,
+            'default': 5
+        }, {
+            'flag': '--region-levels',
+            'help': 'Comma separated region levels to generate cubes for (0-4)',
+            'default': '3'
+        }, {
+            'flag': '--regions',
+            'help': 'Number of regions per cube',
+            'type': int,
+            'default': 100
+        }, {
+            'flag': '--years',
+            'help': 'Number of years per cube',
+            'type': int,
+            'default': 10
+        }, {
+            'flag': '--rows',
+            'help': 'Maximum number of fact rows per cube',
+            'type': int
+        }, {
+            'flag': '--compare',
+            'help': 'JSON output of a previous `bench` run to compare with'
+        }, {
+            'flag': '--startup',
+            'help': 'Only measure the import time of cli invocations (see `tests/test_startup.py` for the budget)',
+            'action': 'store_true'
+        }, {
+            'flag': '--fetch',
+            'help': 'Benchmark `fetch` against a local fake GENESIS server (see `fake_genesis`) instead',
+            'action': 'store_true'
+        }, {
+            'flag': '--concurrency',
+            'help': 'Comma separated `fetch --concurrency` settings to compare for `--fetch`',
+            'default': '1,4'
+        }, {
+            'flag': '--latency',
+            'help': 'Latency per request in milliseconds of the fake server for `--fetch`',
+            'type': int,
+            'default': 50
+        }, {
+            'flag': '--error-rate',
+            'help': 'Share of failing requests of the fake server for `--fetch`',
+            'type': float,
+            'default': 0
+        })
+    },
+    'serve': {
+        'args': ({
+            'flag': 'storage',
+            'help': 'Directory where to store cube data'
+        }, {
+            'flag': '--interval',
+            'help': 'Minutes between runs (default: 60)',
+            'type': int,
+            'default': 60
+        }, {
+            'flag': '--prefix',
+            'help': 'Prefix of cube names to restrict downloading, e.g. "111"'
+        }, {
+            'flag': '--slice-threshold',
+            'help': 'Download cubes bigger than this (in MB) in slices, see `fetch`',
+            'type': int
+        }, {
+            'flag': '--concurrency',
+            'help': 'Number of cubes to download at once, see `fetch`',
+            'type': int,
+            'default': 1
+        }, {
+            'flag': '--schema',
+            'help': 'Keep this schema file up to date (via `build_schema --previous`)'
+        }, {
+            'flag': '--pipe',
+            'help': 'Serialize changed cubes with `jsonify` and pipe the facts to this shell command'
+        }, {
+            'flag': '--jsonify-args',
+            'help': 'Additional arguments for `jsonify`, e.g. "--dedup --reader native"'
+        }, {
+            'flag': '--schema-cache',
+            'help': 'Keep the parsed schemas of this many cubes in memory between `build_schema`, `jsonify` '
+                    'and the next runs, 0 to disable (default: 256)',
+            'type': int,
+            'default': 256
+        }, {
+            'flag': '--socket',
+            'help': 'Unix socket for the control commands (default: `genesapi.sock` in the storage)'
+        }, {
+            'flag': '--send',
+            'help': 'Send this command to the running daemon and print its answer',
+            'choices': ('status', 'run', 'stop')
+        })
+    },
+    'sync': {
+        'args': ({
+            'flag': 'storage',
+            'help': 'Directory where to store cube data'
+        }, {
+            'flag': '--new',
+            'help': 'Initialize Storage if it doesn\'t exist and start downloading',
+            'action': 'store_true'
+        }, {
+            'flag': '--prefix',
+            'help': 'Prefix of cube names to restrict downloading and exporting, e.g. "111"'
+        }, {
+            'flag': '--force-update',
+            'help': 'Re-download all cubes regardless if they are already up to date.',
+            'action': 'store_true'
+        }, {
+            'flag': '--slice-threshold',
+            'help': 'Download cubes bigger than this (in MB) in slices, see `fetch`',
+            'type': int
+        }, {
+            'flag': '--concurrency',
+            'help': 'Number of cubes to download at once, see `fetch`',
+            'type': int,
+            'default': 1
+        }, {
+            'flag': '--workers',
+            'help': 'Number of processes to export cubes (default: number of cores)',
+            'type': int
+        }, {
+            'flag': '--jsonify-args',
+            'help': 'Additional arguments for the export, see `jsonify`, e.g. "--reader native"'
         })
     },
     'status': {
@@ -120,11 +489,15 @@ COMMANDS = {
 def main():
     parser = argparse.ArgumentParser(prog='genesapi')
     parser.add_argument('--loglevel', default='INFO')
+    parser.add_argument('--profile', help='Profile the command with cProfile and write the stats to this file')
+    parser.add_argument('--profile-memory', help='Trace memory allocations as well (use with --profile)',
+                        action='store_true')
     subparsers = parser.add_subparsers(help='commands help')
     for name, opts in COMMANDS.items():
         subparser = subparsers.add_parser(name)
         subparser.set_defaults(func=name)
         for args in opts.get('args', []):
+            args = dict(args)
             flag = args.pop('flag')
             subparser.add_argument(flag, **args)
 
@@ -134,6 +507,14 @@ def main():
     if hasattr(args, 'func'):
         try:
             func = import_module('genesapi.%s' % args.func)
-            func.main(args)
-        except ImportError:
+        except ModuleNotFoundError as e:
+            if e.name != 'genesapi.%s' % args.func:
+                raise  # a missing dependency of the command
             raise Exception('`%s` is not a valid command.' % args.func)
+        # import errors of the command itself (e.g. optional dependencies) keep their message
+        if args.profile:
+            from genesapi import profiling
+            with profiling.profile(args.profile, memory=args.profile_memory):
+                func.main(args)
+        else:
+            func.main(args)
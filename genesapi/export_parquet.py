@@ -0,0 +1,139 @@
+"""
+export facts into a local columnar "warehouse": a parquet dataset partitioned
+by statistic and region level, optionally with a duckdb database on top
+
+    <output>/
+        statistic=11111/
+            region_level=3/
+                11111KJ001.parquet      -   all facts of this cube at this region level
+                ...
+
+the facts are the same as `jsonify` produces via `serialize_facts`, flattened
+to one row per fact: the measure value (as float) with its `quality`,
+`error` and `locked` flags and a (dictionary encoded) column for each
+dimension of the cube.
+
+only cubes that changed since the last parquet export are written (tracked
+via the `last_exported_parquet` timestamp per cube), their files are replaced.
+
+requires `pyarrow` (and `duckdb` for `--duckdb`)
+"""
+
+
+import logging
+import os
+
+from datetime import datetime
+from glob import glob
+
+from genesapi.facts import SlimCube, pack_facts, serialize_facts
+from genesapi.storage import CubeSchema, Storage
+from genesapi.util import parallelize
+
+
+logger = logging.getLogger(__name__)
+
+
+TIMESTAMP = 'last_exported_parquet'
+NO_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # null value for hive partitioning
+PLAIN_COLUMNS = ('fact_id', 'date', 'last_updated', 'last_downloaded', 'last_imported')  # not dictionary encoded
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return
+
+
+def _get_rows(cube):
+    # the revision is parsed once, its facts are packed and serialized like in `jsonify`
+    regenesis_cube = cube.current.load()
+    schema = CubeSchema(regenesis_cube)
+    facts = pack_facts(regenesis_cube.facts, schema)
+    del regenesis_cube
+    for data in serialize_facts(facts, SlimCube(cube, schema)):
+        measure = data['measure']
+        row = {k: v for k, v in data.items() if k not in (measure, 'path') and not isinstance(v, dict)}
+        row.update({k: data[measure].get(k) for k in ('quality', 'error', 'locked')})
+        row['value'] = _to_float(data['value'])
+        yield row
+
+
+def _get_table(rows):
+    import pyarrow as pa
+
+    columns = {}
+    for column in sorted(set(k for row in rows for k in row)):
+        values = [row.get(column) for row in rows]
+        if column == 'value':
+            columns[column] = pa.array(values, pa.float64())
+        elif column == 'year':
+            columns[column] = pa.array([int(v) if v else None for v in values], pa.int16())
+        else:
+            values = pa.array([str(v) if v is not None else None for v in values], pa.string())
+            columns[column] = values if column in PLAIN_COLUMNS else values.dictionary_encode()
+    return pa.table(columns)
+
+
+def _remove_cube(output, cube):
+    for fp in glob(os.path.join(output, 'statistic=%s' % cube.name[:5], '*', '%s.parquet' % cube.name)):
+        os.remove(fp)
+
+
+def _export_cubes(cubes, args):
+    import pyarrow.parquet as pq
+
+    res = []
+    for cube in cubes:
+        logger.info('Exporting cube `%s` ...' % cube)
+        # stamped as `TIMESTAMP`, so that a revision created meanwhile is exported again
+        loaded = datetime.now()
+        partitions = {}
+        for row in _get_rows(cube):
+            key = (row.pop('statistic'), row.pop('region_level', None))
+            partitions.setdefault(key, []).append(row)
+
+        _remove_cube(args.output, cube)
+        for (statistic, region_level), rows in partitions.items():
+            directory = os.path.join(args.output, 'statistic=%s' % statistic,
+                                     'region_level=%s' % (NO_PARTITION if region_level is None else region_level))
+            os.makedirs(directory, exist_ok=True)
+            fp = os.path.join(directory, '%s.parquet' % cube.name)
+            pq.write_table(_get_table(rows), '%s.tmp' % fp, compression=args.compression)
+            os.replace('%s.tmp' % fp, fp)
+        res.append((cube.name, sum(len(rows) for rows in partitions.values()), loaded))
+    return res
+
+
+def _create_duckdb(fp, output):
+    import duckdb
+
+    con = duckdb.connect(fp)
+    con.execute("""
+        CREATE OR REPLACE VIEW facts AS
+        SELECT * FROM read_parquet('%s', hive_partitioning = true, union_by_name = true,
+                                  hive_types = {'statistic': VARCHAR, 'region_level': INTEGER})
+    """ % os.path.join(os.path.abspath(output), '*', '*', '*.parquet').replace("'", "''"))
+    con.close()
+    logger.info('Created view `facts` in duckdb `%s`' % fp)
+
+
+def main(args):
+    storage = Storage(args.storage)
+    os.makedirs(args.output, exist_ok=True)
+    cubes = storage.get_cubes_for_export(args.force_export, args.prefix, target=TIMESTAMP)
+    logger.info('Starting to export %s cubes from `%s` to `%s` ...' % (len(cubes), storage, args.output))
+
+    i = 0
+    if len(cubes) == 0:
+        logger.info('Everything seems up to date.')
+    else:
+        for name, facts, loaded in parallelize(_export_cubes, cubes, args):
+            storage.cube(name).touch(TIMESTAMP, loaded)
+            i += facts
+    logger.info('Exported %s facts.' % i)
+
+    if args.duckdb:
+        _create_duckdb(args.duckdb, args.output)
+    logger.info('Finished export of %s cubes from `%s` .' % (len(cubes), storage))
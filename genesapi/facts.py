@@ -0,0 +1,337 @@
+"""
+compact representation of facts for the serialization pipeline
+
+a `regenesis.cube.Fact` (or its `to_dict()`) becomes a `Fact` record: a
+`__slots__` object holding a reference to a shared, per-cube column schema
+(`FactSchema`: the interned keys of the fact and which of them are measures)
+and a plain tuple of values. Nested dicts (e.g. `{'value': ..., 'quality':
+...}` for measures) are stored as tuples of their items as well.
+
+the records are unpacked (one per measure) and serialized lazily, dicts are
+only built right before encoding, one at a time:
+
+    facts = pack_facts(regenesis_cube.facts, cube.schema)
+    for data in serialize_facts(facts, cube):
+        encode(data)
+
+the workers get a `SlimCube` instead of the `storage.Cube`: only the
+metadata and (if needed) the schema as plain dicts, without the parsed
+`regenesis` cube.
+
+`serialize_facts` yields exactly the same dicts as `unpack_fact` +
+`serialize_fact` (see `genesapi bench` for a parity check), but without deep
+copying the facts, with cached key and value transformations and without the
+json round trip per fact.
+"""
+
+
+import hashlib
+import json
+import sys
+
+from datetime import date, datetime
+
+from genesapi.util import (
+    EXCLUDE_KEYS,
+    GENESIS_REGIONS,
+    META_KEYS,
+    compute_fact_id,
+    get_fact_path,
+    slugify_graphql,
+    time_to_json,
+    to_date
+)
+
+
+REGION_KEYS = tuple(k.upper() for k in GENESIS_REGIONS)
+JSON_TYPES = (str, int, float, bool, type(None))
+
+# the same for all facts of a cube, in the cube table (see `get_cube_record`) for the `compact` profile
+CUBE_KEYS = ('statistic', 'last_updated', 'last_downloaded', 'last_imported')
+# derivable from other fields: `path` from the measure and dimensions, `year_name` and the fulltext
+# `dimensions` from `year` and `dimension_names`
+DERIVED_KEYS = ('path', 'year_name', 'dimensions')
+
+
+class FactSchema:
+    """
+    column schema shared by all facts of a cube with the same keys
+    """
+    __slots__ = ('keys', 'nested', 'measures')
+
+    def __init__(self, signature, measures):
+        self.keys = tuple(sys.intern(k) for k, _ in signature)
+        self.nested = tuple(n for _, n in signature)
+        self.measures = tuple(k for k in self.keys if k in measures)
+
+
+class Fact:
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def to_dict(self):
+        return {k: dict(v) if n else v for k, n, v in zip(self.schema.keys, self.schema.nested, self.values)}
+
+
+def _intern(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+
+class FactFilter:
+    """
+    filter the facts of a cube while they are read, before they are packed
+    or serialized:
+
+    `region_levels`: keep only facts of these region levels (0: Deutschland
+    to 4: Gemeinde, see `REGION_KEYS`), `since` / `until`: keep only facts
+    of these years (inclusive), `measures`: keep only these measures (facts
+    without any of them are dropped)
+
+    facts without a region or a year are dropped if the respective filter is
+    set. `skipped` counts the dropped facts.
+    """
+    def __init__(self, region_levels=None, since=None, until=None, measures=None):
+        self.region_levels = set(region_levels) if region_levels is not None else None
+        self.since = since
+        self.until = until
+        self.measures = set(m.upper() for m in measures) if measures is not None else None
+        self.skipped = 0
+
+    def __bool__(self):
+        return any(v is not None for v in (self.region_levels, self.since, self.until, self.measures))
+
+    @property
+    def key(self):
+        """
+        short hash of the filter settings, e.g. for a timestamp per filter
+        """
+        settings = [sorted(v) if v is not None else None for v in (self.region_levels, self.measures)]
+        settings += [self.since, self.until]
+        return hashlib.sha1(json.dumps(settings).encode('utf-8')).hexdigest()[:8]
+
+    def get_measures(self, measures):
+        """
+        the keys of `measures` to keep
+        """
+        if self.measures is None:
+            return tuple(measures)
+        return tuple(m for m in measures if m.upper() in self.measures)
+
+    def keeps_region(self, fact):
+        """
+        `fact`: dict with (at least) the region keys of a fact
+        """
+        if self.region_levels is None:
+            return True
+        for level, key in enumerate(REGION_KEYS):
+            if fact.get(key):
+                return level in self.region_levels
+        return False
+
+    def keeps_time(self, key, value):
+        """
+        `key`: time dimension (`STAG` or `JAHR`), `value`: its raw value
+        (`31.12.2016` or `2016`)
+        """
+        if self.since is None and self.until is None:
+            return True
+        if key not in ('STAG', 'JAHR') or not value:
+            return False
+        year = int(value[-4:])
+        return (self.since is None or year >= self.since) and (self.until is None or year <= self.until)
+
+    def apply(self, fact, measures):
+        """
+        return `fact` (a dict) without the excluded measures or `None` if it
+        is excluded, `measures`: all measure keys of the cube
+        """
+        if not self.keeps_region(fact):
+            self.skipped += 1
+            return
+        if self.since is not None or self.until is not None:
+            time = fact.get('STAG', fact.get('JAHR'))
+            if time is None or not self.keeps_time('STAG' if 'STAG' in fact else 'JAHR', time['value']):
+                self.skipped += 1
+                return
+        if self.measures is not None:
+            kept = set(self.get_measures(measures))
+            fact = {k: v for k, v in fact.items() if k not in measures or k in kept}
+            if not any(k in kept for k in fact):
+                self.skipped += 1
+                return
+        return fact
+
+
+def pack_facts(facts, schema, fact_filter=None):
+    """
+    convert `facts` (`regenesis.cube.Fact` or dicts) of a cube into a list
+    of compact `Fact` records, `schema` is the cube's `CubeSchema`,
+    `fact_filter`: an optional `FactFilter`
+    """
+    measures = set(schema.measures)
+    schemas = {}
+    res = []
+    for fact in facts:
+        if not isinstance(fact, dict):
+            fact = fact.to_dict()
+        if fact_filter:
+            fact = fact_filter.apply(fact, measures)
+            if fact is None:
+                continue
+        signature = tuple((k, isinstance(v, dict)) for k, v in fact.items())
+        if signature not in schemas:
+            schemas[signature] = FactSchema(signature, measures)
+        values = tuple(tuple((sys.intern(i), _intern(j)) for i, j in v.items()) if isinstance(v, dict)
+                       else _intern(v) for v in fact.values())
+        res.append(Fact(schemas[signature], values))
+    return res
+
+
+class SlimSchema:
+    """
+    the parts of a `storage.CubeSchema` used to serialize facts (fulltext,
+    rollups) as plain dicts, without the parsed `regenesis` cube
+    """
+    def __init__(self, schema):
+        self.statistic = schema.statistic
+        self.measures = schema.measures
+        self.dimensions = schema.dimensions
+        self.regions = schema.regions
+
+
+class SlimCube:
+    """
+    stand-in for a `storage.Cube` in the workers, cheap to pickle: its name,
+    timestamps and `stand`, `schema`: optional `CubeSchema` or `SlimSchema`
+    """
+    def __init__(self, cube, schema=None):
+        self.name = cube.name
+        self.metadata = {'stand': cube.metadata['stand']}
+        self.last_updated = cube.last_updated
+        self.last_exported = cube.last_exported
+        self.schema = SlimSchema(schema) if schema is not None else None
+
+    def __str__(self):
+        return self.name
+
+
+def _to_json(value):
+    # the same as `json.loads(json.dumps(value, default=time_to_json))`
+    if isinstance(value, JSON_TYPES):
+        return value
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return time_to_json(value)
+
+
+class Serializer:
+    """
+    serialize `Fact` records of `cube`, caching everything that is the same
+    for many facts (meta data, key casing, slugified values, parsed dates)
+    """
+    def __init__(self, cube):
+        self.meta = {
+            'cube': cube.name,
+            'statistic': cube.name[:5],
+            'last_updated': to_date(cube.metadata['stand'], True),
+            'last_downloaded': cube.last_updated,
+            'last_imported': cube.last_exported
+        }
+        self.keys = {}
+        self.slugs = {}
+        self.dates = {}
+
+    def _get_key(self, key):
+        # -> (output key, excluded, slugify value)
+        if key not in self.keys:
+            lower = key.lower()
+            self.keys[key] = (sys.intern(key.upper() if lower not in META_KEYS else lower),
+                              lower in EXCLUDE_KEYS, key not in META_KEYS)
+        return self.keys[key]
+
+    def _slugify(self, value):
+        if not isinstance(value, str):
+            return value
+        if value not in self.slugs:
+            self.slugs[value] = sys.intern(slugify_graphql(value, False))
+        return self.slugs[value]
+
+    def _get_date(self, value):
+        if value not in self.dates:
+            self.dates[value] = datetime.strptime(value, '%d.%m.%Y').date()
+        return self.dates[value]
+
+    def serialize(self, fact, measure):
+        schema = fact.schema
+        data = {}
+        for key, nested, value in zip(schema.keys, schema.nested, fact.values):
+            if key in schema.measures and key != measure:
+                continue
+            data[key] = dict(value) if nested else value
+        data['measure'] = measure
+        data['value'] = data[measure]['value']
+        data.update(self.meta)
+
+        for level, key in enumerate(REGION_KEYS):
+            if data.get(key):
+                data['region_id'] = data[key]
+                data['region_level'] = level
+                if level < 4:
+                    data['nuts'] = level
+                else:
+                    data['lau'] = 2
+                break
+        if 'STAG' in data:
+            stag = self._get_date(data['STAG']['value'])
+            data['date'] = stag.isoformat()
+            data['year'] = str(stag.year)
+            del data['STAG']
+        if 'JAHR' in data:
+            data['year'] = data['JAHR']['value']
+        if 'date' not in data and 'year' in data:
+            data['date'] = date(int(data['year']), 12, 31)
+
+        fact_data = {}
+        for key, value in data.items():
+            key, excluded, slugify = self._get_key(key)
+            if not excluded:
+                fact_data[key] = self._slugify(value) if slugify else value
+
+        fact_data['fact_id'] = compute_fact_id(fact_data)
+        fact_data['path'] = get_fact_path(fact_data)
+        return _to_json(fact_data)
+
+
+def serialize_facts(facts, cube):
+    """
+    unpack (one fact per measure) and serialize compact `facts` of `cube`,
+    yield json-serializable dicts
+    """
+    serializer = Serializer(cube)
+    for fact in facts:
+        for measure in fact.schema.measures:
+            yield serializer.serialize(fact, measure)
+
+
+def compact_fact(data):
+    """
+    drop the per-cube constants and derivable fields of a serialized fact
+    (the `compact` output profile)
+    """
+    for key in CUBE_KEYS + DERIVED_KEYS:
+        data.pop(key, None)
+    return data
+
+
+def get_cube_record(cube):
+    """
+    the per-cube constants that `compact_fact` drops, keyed by `cube`
+    """
+    return _to_json(Serializer(cube).meta)
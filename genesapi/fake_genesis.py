@@ -0,0 +1,301 @@
+"""
+local stand-in for the *GENESIS* SOAP webservices, to benchmark and test
+`fetch` without the real (slow, credential-gated) instance
+
+serves the cubes of a `Storage` (recorded with `fetch` or synthetic, see
+`bench.generate_storage`) via the two operations `genesapi` uses:
+
+    DatenKatalog    -   catalog entries (`code`, `inhalt`, `stand`) of the
+                        cubes matching `filter` (e.g. `111*`)
+    DatenExport     -   the current data of the cube `namen`, sliced by
+                        `regionalmerkmal` / `regionalschluessel` and
+                        `startjahr` / `endjahr` if given
+
+the wsdl is served at `<url>/RechercheService_2010?wsdl` and
+`<url>/ExportService_2010?wsdl`. Every request is delayed by `latency`
+seconds (+/- 50% jitter) and fails with the probability `error_rate`, like
+an overloaded server: with http status 503 and without a SOAP fault, so
+that `fetch` retries it.
+
+usage:
+
+    genesapi fake_genesis ./data/ --port 8080 --latency 200 --catalog catalog.yml
+    CATALOG=catalog.yml genesapi fetch ./copy/ --new --prefix 99
+
+or in-process (see `genesapi bench --fetch`):
+
+    with FakeGenesis(storage, latency=.1) as server:
+        server.write_catalog('catalog.yml')
+"""
+
+
+import fnmatch
+import logging
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from genesapi.reader import FACTS_SECTION, Reader
+from genesapi.storage import Storage
+from genesapi.util import dump_yaml
+
+
+logger = logging.getLogger(__name__)
+
+
+NAMESPACE = 'http://fake.genesapi/'
+SERVICES = {'index': 'RechercheService_2010', 'export': 'ExportService_2010'}
+PARAMETERS = {
+    'DatenKatalog': ('kennung', 'passwort', 'filter', 'bereich', 'listenLaenge', 'sprache'),
+    'DatenExport': ('kennung', 'passwort', 'namen', 'bereich', 'format', 'werte', 'metadaten', 'zusatz',
+                    'startjahr', 'endjahr', 'zeitscheiben', 'inhalte', 'regionalmerkmal', 'regionalschluessel',
+                    'sachmerkmal', 'sachschluessel', 'sachmerkmal2', 'sachschluessel2', 'sachmerkmal3',
+                    'sachschluessel3', 'stand', 'sprache')
+}
+# result fields of the operations, `xsd:anyType` ones are returned as raw xml elements by zeep
+RESULTS = {
+    'DatenKatalog': (('ident', 'xsd:string'), ('status', 'xsd:string'), ('datenKatalogEintraege', 'xsd:anyType')),
+    'DatenExport': (('ident', 'xsd:string'), ('status', 'xsd:string'), ('quader', 'xsd:anyType'))
+}
+YEAR_RE = re.compile(r'(\d{4})$')
+
+
+def _get_wsdl(location):
+    elements, messages, operations, bindings = [], [], [], []
+    for operation, parameters in PARAMETERS.items():
+        elements.append(
+            '<xsd:element name="%s"><xsd:complexType><xsd:sequence>%s</xsd:sequence></xsd:complexType>'
+            '</xsd:element>' % (operation, ''.join(
+                '<xsd:element name="%s" type="xsd:string" minOccurs="0"/>' % p for p in parameters)))
+        elements.append(
+            '<xsd:element name="%sResponse"><xsd:complexType><xsd:sequence><xsd:element name="%sReturn">'
+            '<xsd:complexType><xsd:sequence>%s</xsd:sequence></xsd:complexType></xsd:element></xsd:sequence>'
+            '</xsd:complexType></xsd:element>' % (operation, operation, ''.join(
+                '<xsd:element name="%s" type="%s" minOccurs="0"/>' % r for r in RESULTS[operation])))
+        messages.append(
+            '<message name="%sRequest"><part name="parameters" element="tns:%s"/></message>'
+            '<message name="%sResponse"><part name="parameters" element="tns:%sResponse"/></message>'
+            % ((operation,) * 4))
+        operations.append('<operation name="%s"><input message="tns:%sRequest"/>'
+                          '<output message="tns:%sResponse"/></operation>' % ((operation,) * 3))
+        bindings.append('<operation name="%s"><soap:operation soapAction=""/><input><soap:body use="literal"/>'
+                        '</input><output><soap:body use="literal"/></output></operation>' % operation)
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/" '
+        'xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}">'
+        '<types><xsd:schema targetNamespace="{ns}" elementFormDefault="unqualified">{elements}</xsd:schema></types>'
+        '{messages}<portType name="Genesis">{operations}</portType>'
+        '<binding name="GenesisBinding" type="tns:Genesis">'
+        '<soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>{bindings}</binding>'
+        '<service name="Genesis"><port name="Genesis" binding="tns:GenesisBinding">'
+        '<soap:address location="{location}"/></port></service></definitions>'
+    ).format(ns=NAMESPACE, elements=''.join(elements), messages=''.join(messages),
+             operations=''.join(operations), bindings=''.join(bindings), location=escape(location))
+
+
+def _get_envelope(body):
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<soapenv:Body>%s</soapenv:Body></soapenv:Envelope>' % body)
+
+
+def _get_response(operation, **fields):
+    # fields: name -> xml content
+    return _get_envelope('<ns:%sResponse xmlns:ns="%s"><%sReturn>%s</%sReturn></ns:%sResponse>' % (
+        operation, NAMESPACE, operation, ''.join('<%s>%s</%s>' % (k, v, k) for k, v in fields.items()),
+        operation, operation))
+
+
+def _get_fault(message):
+    return _get_envelope('<soapenv:Fault><faultcode>soapenv:Server</faultcode><faultstring>%s</faultstring>'
+                         '</soapenv:Fault>' % escape(message))
+
+
+def _get_elements(data):
+    return ''.join('<%s>%s</%s>' % (k, escape(str(v)), k) for k, v in data.items() if v is not None)
+
+
+def get_slice(fp, region_key=None, region_pattern=None, start_year=None, end_year=None):
+    """
+    return the raw csv data of the cube at `fp`, only with the facts of the
+    regions matching `region_pattern` (for the dimension `region_key`) and
+    of the years between `start_year` and `end_year`
+    """
+    with Reader(fp) as reader:
+        dimensions = reader.dimensions
+    index = dimensions.index(region_key) if region_key in dimensions and region_pattern else None
+    lines, section = [], None
+    with open(fp) as f:
+        for line in f:
+            parts = line.split(';', 3)
+            if parts[0] == 'K':
+                section = parts[1].strip()
+            elif section == FACTS_SECTION and parts[0] == 'D':
+                if index is not None and not fnmatch.fnmatch(parts[1].split(',')[index], region_pattern):
+                    continue
+                year = YEAR_RE.search(parts[2].strip()) if len(parts) > 2 else None
+                if year and start_year and int(year.group(1)) < int(start_year):
+                    continue
+                if year and end_year and int(year.group(1)) > int(end_year):
+                    continue
+            lines.append(line)
+    return ''.join(lines)
+
+
+class FakeGenesis:
+    def __init__(self, storage, host='127.0.0.1', port=0, latency=0, error_rate=0, seed=None):
+        """
+        `storage`: `Storage` (or its directory) with the cubes to serve
+        `port`: 0 picks a free port, see `url`
+        `latency`: seconds per request
+        """
+        self.storage = storage if isinstance(storage, Storage) else Storage(storage)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = {operation: 0 for operation in PARAMETERS}
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.genesis = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def get_catalog(self):
+        return {
+            'name': 'fake_genesis',
+            'url': self.url,
+            'username': 'genesapi',
+            'password': 'genesapi',
+            'index_url': '%s/%s?wsdl' % (self.url, SERVICES['index']),
+            'export_url': '%s/%s?wsdl' % (self.url, SERVICES['export'])
+        }
+
+    def write_catalog(self, fp):
+        with open(fp, 'w') as f:
+            f.write(dump_yaml(self.get_catalog()))
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info('Serving %s cubes from `%s` at %s ...' % (len(self.storage), self.storage, self.url))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        logger.info('Serving %s cubes from `%s` at %s ...' % (len(self.storage), self.storage, self.url))
+        self.server.serve_forever()
+
+    def _should_fail(self):
+        with self._lock:
+            fail = self.random.random() < self.error_rate
+            jitter = self.random.uniform(.5, 1.5)
+        time.sleep(self.latency * jitter)
+        return fail
+
+    def handle(self, operation, params):
+        """
+        return the http status and the soap response for `operation`
+        (`None` for a simulated error)
+        """
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+        if self._should_fail():
+            with self._lock:
+                self.errors += 1
+            return 503, None
+        try:
+            return 200, getattr(self, '_%s' % operation)(params)
+        except Exception as e:
+            logger.error('`%s` failed: %s' % (operation, e))
+            return 500, _get_fault(str(e))
+
+    def _DatenKatalog(self, params):
+        pattern = params.get('filter') or '*'
+        limit = int(params.get('listenLaenge') or 500)
+        entries = []
+        for cube in self.storage:
+            if fnmatch.fnmatch(cube.name, pattern):
+                entries.append({'code': cube.name, 'inhalt': cube.name, 'stand': cube.metadata.get('stand')})
+        entries = sorted(entries, key=lambda e: e['code'])[:limit]
+        return _get_response('DatenKatalog', ident='', status='Ergebnis', datenKatalogEintraege=''.join(
+            '<datenKatalogEintraege>%s</datenKatalogEintraege>' % _get_elements(e) for e in entries))
+
+    def _DatenExport(self, params):
+        cube = self.storage.cube(params.get('namen') or '')
+        if cube is None or not cube.exists:
+            raise ValueError('Unknown cube `%s`' % params.get('namen'))
+        data = get_slice(cube._path('current', 'data.csv'), params.get('regionalmerkmal'),
+                         params.get('regionalschluessel'), params.get('startjahr'), params.get('endjahr'))
+        metadata = {k: v for k, v in cube.metadata.items() if k != 'quaderDaten'}
+        return _get_response('DatenExport', ident=escape(cube.name), status='Ergebnis', quader='<quader>%s%s</quader>'
+                             % (_get_elements(metadata), '<quaderDaten>%s</quaderDaten>' % escape(data)))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def _send(self, status, body, content_type='text/xml; charset=utf-8'):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0].strip('/')
+        if path not in SERVICES.values():
+            return self._send(404, 'Not found', 'text/plain')
+        self._send(200, _get_wsdl('%s/%s' % (self.server.genesis.url, path)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        try:
+            request = ElementTree.fromstring(body)
+            operation = next(iter(request.find('{http://schemas.xmlsoap.org/soap/envelope/}Body')))
+        except (ElementTree.ParseError, StopIteration, TypeError):
+            return self._send(400, _get_fault('Invalid request'))
+        name = operation.tag.split('}')[-1]
+        if name not in PARAMETERS:
+            return self._send(500, _get_fault('Unknown operation `%s`' % name))
+        params = {p.tag.split('}')[-1]: p.text for p in operation}
+        status, response = self.server.genesis.handle(name, params)
+        if response is None:
+            # no content at all, `zeep` raises a `TransportError` with the status then
+            return self._send(status, '', 'text/plain')
+        self._send(status, response)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main(args):
+    server = FakeGenesis(args.storage, args.host, args.port, args.latency / 1000, args.error_rate)
+    if args.catalog:
+        server.write_catalog(args.catalog)
+        logger.info('Wrote catalog for `fetch` to `%s`' % args.catalog)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
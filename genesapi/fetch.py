@@ -5,7 +5,9 @@ download raw cubes, see `genesapi.storage` for details
 
 import logging
 
+from genesapi import metrics
 from genesapi.exceptions import StorageDoesNotExist
+from genesapi.journal import Journal
 from genesapi.storage import Storage
 
 
@@ -13,6 +15,7 @@ logger = logging.getLogger(__name__)
 
 
 def main(args):
+    metrics.start('fetch')
     try:
         storage = Storage(args.storage, filelogging=args.cronjob)
     except StorageDoesNotExist:
@@ -24,5 +27,14 @@ def main(args):
                 args.storage)
 
     logger.log(logging.INFO, 'Starting download / update for Storage `%s` ...' % args.storage)
-    storage.update(prefix=args.prefix, force=args.force_update)
+    journal = Journal(storage._path('logs'), 'fetch', resume=args.resume)
+    slice_threshold = args.slice_threshold * 1024 * 1024 if args.slice_threshold else None
+    failed = storage.update(prefix=args.prefix, force=args.force_update, journal=journal,
+                            slice_threshold=slice_threshold, concurrency=args.concurrency)
+    if failed:
+        # keep the run unfinished, so that `--resume` only retries the failed cubes
+        logger.error('Failed to update %s cubes: %s (use `--resume` to retry them)' % (len(failed), ', '.join(failed)))
+    else:
+        journal.finish()
+    metrics.flush(storage._path('logs'))
     logger.log(logging.INFO, 'Finished download / update for Storage `%s`' % args.storage)
@@ -0,0 +1,256 @@
+"""
+precomputed region hierarchy (Deutschland -> Land -> Regierungsbezirk ->
+Kreis -> Gemeinde) for the regions of `build_regions`
+
+the parent of a region is the region with the longest id (AGS) that is a
+prefix of its id (e.g. `08425` -> `084` -> `08`), Länder are children of
+`DG` (Deutschland). Regions without an existing intermediate level (e.g. the
+Kreise of Länder without Regierungsbezirke) are attached to the next higher
+existing one.
+
+json (`build_hierarchy`):
+
+    {
+        "regions": {
+            "08425": {
+                "level": 3,
+                "parent": "084",
+                "children": ["08425005", "08425008", ...]   // sorted
+            },
+        },
+        "levels": {
+            "0": ["DG"],
+            "1": ["01", "02", ...],                          // sorted
+        }
+    }
+
+binary (`write`), little endian, to be memory-mapped (see `Hierarchy`):
+
+    header      magic, number of regions, number of children, hash capacity
+    levels      (LEVELS + 1) record indexes: regions of level `l` are the
+                records `levels[l]:levels[l + 1]`, sorted by id
+    records     id (12 bytes, null padded), level, parent (record index or -1),
+                offset and count of its children in the children table
+    children    record indexes, sorted by id per parent
+    hash table  record index + 1 (0: empty slot) by `crc32(id)`, linear
+                probing, for O(1) lookups by id
+
+usage:
+
+    with Hierarchy('regions.bin') as hierarchy:
+        hierarchy.parent('08425')               # '084'
+        hierarchy.children('08')                # ['081', '082', '083', '084']
+        hierarchy.descendants('08', level=3)    # all Kreise of Baden-Württemberg
+        hierarchy.level(1)                      # all Länder
+"""
+
+
+import mmap
+import struct
+import zlib
+
+from genesapi.util import GENESIS_REGIONS, get_region_level
+
+
+MAGIC = b'GAPIRHI1'
+HEADER = struct.Struct('<8sIII')  # magic, regions, children, hash capacity
+LEVELS = len(GENESIS_REGIONS)
+LEVEL = struct.Struct('<%sI' % (LEVELS + 1))
+RECORD = struct.Struct('<12sBxxxiII')  # id, level, parent, children offset, children count
+INDEX = struct.Struct('<I')
+ROOT = 'DG'
+
+
+def _get_level(region_id, regions):
+    region = regions[region_id]
+    if isinstance(region, dict) and region.get('level') is not None:
+        return region['level']
+    return get_region_level(region_id)[0]
+
+
+def get_parent(region_id, regions):
+    """
+    return the id of the parent region of `region_id` (or `None`), `regions`
+    are all known region ids
+    """
+    if region_id == ROOT:
+        return
+    for i in range(len(region_id) - 1, 1, -1):
+        if region_id[:i] in regions:
+            return region_id[:i]
+    if ROOT in regions:
+        return ROOT
+
+
+def build_hierarchy(regions):
+    """
+    `regions`: `{region_id: {'level': ..., ...}}` from `build_regions`
+    """
+    hierarchy = {'regions': {}, 'levels': {str(level): [] for level in range(LEVELS)}}
+    for region_id in sorted(regions):
+        level = _get_level(region_id, regions)
+        hierarchy['regions'][region_id] = {
+            'level': level,
+            'parent': get_parent(region_id, regions),
+            'children': []
+        }
+        hierarchy['levels'][str(level)].append(region_id)
+    for region_id, region in hierarchy['regions'].items():
+        if region['parent'] is not None:
+            hierarchy['regions'][region['parent']]['children'].append(region_id)
+    return hierarchy
+
+
+def _get_capacity(size):
+    capacity = 1
+    while capacity < size * 2:
+        capacity <<= 1
+    return capacity
+
+
+def _get_slot(region_id, capacity):
+    return zlib.crc32(region_id.encode('utf-8')) & (capacity - 1)
+
+
+def to_bytes(hierarchy):
+    """
+    encode the output of `build_hierarchy` in the binary format (see above)
+    """
+    ids = [i for level in range(LEVELS) for i in hierarchy['levels'][str(level)]]
+    indexes = {region_id: i for i, region_id in enumerate(ids)}
+    levels = [0]
+    for level in range(LEVELS):
+        levels.append(levels[-1] + len(hierarchy['levels'][str(level)]))
+
+    records = []
+    children = []
+    for region_id in ids:
+        region = hierarchy['regions'][region_id]
+        parent = indexes[region['parent']] if region['parent'] is not None else -1
+        records.append(RECORD.pack(region_id.encode('utf-8'), region['level'], parent, len(children),
+                                   len(region['children'])))
+        children += [indexes[c] for c in region['children']]
+
+    capacity = _get_capacity(len(ids))
+    table = [0] * capacity
+    for i, region_id in enumerate(ids):
+        slot = _get_slot(region_id, capacity)
+        while table[slot]:
+            slot = (slot + 1) & (capacity - 1)
+        table[slot] = i + 1
+
+    return b''.join([
+        HEADER.pack(MAGIC, len(ids), len(children), capacity),
+        LEVEL.pack(*levels),
+        b''.join(records),
+        struct.pack('<%sI' % len(children), *children),
+        struct.pack('<%sI' % capacity, *table)
+    ])
+
+
+def write(fp, hierarchy):
+    with open(fp, 'wb') as f:
+        f.write(to_bytes(hierarchy))
+
+
+class Hierarchy:
+    """
+    read the binary format via `mmap`, only the touched pages are loaded
+    """
+    def __init__(self, fp):
+        self.fp = fp
+        self._file = open(fp, 'rb')
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.size, self._children_count, self._capacity = HEADER.unpack_from(self._data)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('`%s` is not a region hierarchy.' % fp)
+        self._levels = LEVEL.unpack_from(self._data, HEADER.size)
+        self._records_offset = HEADER.size + LEVEL.size
+        self._children_offset = self._records_offset + self.size * RECORD.size
+        self._table_offset = self._children_offset + self._children_count * INDEX.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, region_id):
+        return self._find(region_id) is not None
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._file.close()
+            self._data = self._file = None
+
+    def _record(self, index):
+        region_id, level, parent, offset, count = RECORD.unpack_from(
+            self._data, self._records_offset + index * RECORD.size)
+        return region_id.rstrip(b'\x00').decode('utf-8'), level, parent, offset, count
+
+    def _find(self, region_id):
+        # record index of `region_id` or `None`
+        encoded = region_id.encode('utf-8')
+        mask = self._capacity - 1
+        slot = _get_slot(region_id, self._capacity)
+        while True:
+            index, = INDEX.unpack_from(self._data, self._table_offset + slot * INDEX.size)
+            if not index:
+                return
+            offset = self._records_offset + (index - 1) * RECORD.size
+            if self._data[offset:offset + 12].rstrip(b'\x00') == encoded:
+                return index - 1
+            slot = (slot + 1) & mask
+
+    def _get(self, region_id):
+        index = self._find(region_id)
+        if index is None:
+            raise KeyError(region_id)
+        return self._record(index)
+
+    def get_level(self, region_id):
+        return self._get(region_id)[1]
+
+    def parent(self, region_id):
+        parent = self._get(region_id)[2]
+        if parent >= 0:
+            return self._record(parent)[0]
+
+    def _children(self, offset, count):
+        return struct.unpack_from('<%sI' % count, self._data, self._children_offset + offset * INDEX.size)
+
+    def children(self, region_id):
+        _, _, _, offset, count = self._get(region_id)
+        return [self._record(i)[0] for i in self._children(offset, count)]
+
+    def descendants(self, region_id, level=None):
+        """
+        all regions below `region_id` (only the ones of `level`), sorted by
+        level and id
+        """
+        res = []
+        todo = [self._find(region_id)]
+        if todo[0] is None:
+            raise KeyError(region_id)
+        while todo:
+            found = []
+            for index in todo:
+                _, _, _, offset, count = self._record(index)
+                found += self._children(offset, count)
+            todo = []
+            for index in found:
+                child_level = self._record(index)[1]
+                if level is None or child_level == level:
+                    res.append(index)
+                if level is None or child_level < level:
+                    todo.append(index)
+        # records are sorted by level and id
+        return [self._record(i)[0] for i in sorted(res)]
+
+    def level(self, level):
+        return [self._record(i)[0] for i in range(self._levels[level], self._levels[level + 1])]
@@ -0,0 +1,83 @@
+"""
+append-only journal to checkpoint long running commands, so that they can
+be resumed after a crash (`--resume`)
+
+the journal is stored in the `logs/` dir of the storage, one file per
+command (e.g. `logs/jsonify.journal`), one tab-separated line per event:
+
+    2019-08-07T08:40:20.123456  <run id>    start
+    2019-08-07T08:41:02.654321  <run id>    done    11111BJ001
+    ...
+    2019-08-07T10:12:40.000000  <run id>    finish
+
+a run that has no `finish` line didn't complete. When resuming, the run id of
+the last unfinished run is reused and all its `done` items are skipped.
+"""
+
+
+import logging
+import os
+import uuid
+
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, directory, command, resume=False):
+        os.makedirs(directory, exist_ok=True)
+        self.fp = os.path.join(directory, '%s.journal' % command)
+        self.completed = set()
+        self.run_id = None
+        if resume:
+            self.run_id, self.completed = self._get_unfinished_run()
+            if self.run_id:
+                logger.info('Resuming run `%s` from `%s` (%s items already done)' %
+                            (self.run_id, self.fp, len(self.completed)))
+            else:
+                logger.info('Nothing to resume in `%s`, starting a new run' % self.fp)
+        if self.run_id is None:
+            self.run_id = uuid.uuid4().hex
+        self._write('start')
+
+    def _get_unfinished_run(self):
+        runs = {}
+        last_run = None
+        if os.path.exists(self.fp):
+            with open(self.fp) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) < 3:  # incomplete line from a crash
+                        continue
+                    run_id, event = parts[1], parts[2]
+                    if event == 'start':
+                        last_run = run_id
+                        runs.setdefault(run_id, set())
+                    elif event == 'done' and len(parts) > 3:
+                        runs.setdefault(run_id, set()).add(parts[3])
+                    elif event == 'finish':
+                        runs.pop(run_id, None)
+        if last_run in runs:
+            return last_run, runs[last_run]
+        return None, set()
+
+    def _write(self, event, item=None):
+        parts = [datetime.now().isoformat(), self.run_id, event]
+        if item is not None:
+            parts.append(item)
+        with open(self.fp, 'a') as f:
+            f.write('\t'.join(parts) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def is_done(self, item):
+        return item in self.completed
+
+    def done(self, item):
+        self.completed.add(item)
+        self._write('done', item)
+
+    def finish(self):
+        self._write('finish')
@@ -3,77 +3,264 @@ jsonify cubes records
 """
 
 
+import functools
 import json
 import logging
 import os
-import sys
 
+from datetime import datetime
+from time import perf_counter
+
+from genesapi import metrics
+from genesapi.dedup import Deduplicator, FactIndex, get_entry, get_fact_key, is_duplicate
+from genesapi.facts import FactFilter, SlimCube, compact_fact, get_cube_record, pack_facts, serialize_facts
+from genesapi.journal import Journal
+from genesapi.output import BufferedWriter, get_encoder
+from genesapi.rollup import get_rollups
+from genesapi.scheduler import MB, Scheduler
 from genesapi.storage import Storage
 from genesapi.util import (
-    serialize_fact,
     parallelize,
+    parse_shard,
     get_fulltext_data,
-    unpack_fact
+    get_index_name,
+    to_date
 )
 
 
 logger = logging.getLogger(__name__)
 
 
-def _get_facts(facts, cube, args):
+PROFILE_SAMPLE = 100  # encode every n-th fact in full as well for the `compact` profile report
+
+
+def _get_facts(facts, cube, args, dedup_fp=None):
     res = []
-    for fact in facts:
-        i = 0
-        for unpacked_fact in unpack_fact(fact, cube.schema):
-            data = serialize_fact(unpacked_fact, cube)
-            if args.fulltext:
-                data.update(get_fulltext_data(data, cube))
-            if args.output:
+    encode = get_encoder(args.encoder, args.format, args.pretty)
+    if args.index_prefix:
+        index = get_index_name(cube.name, args.index_prefix, args.index_granularity, args.index_version)
+    if dedup_fp:
+        # return `(fact key, entry, encoded fact or None if duplicate, encoded size)`, see `genesapi.dedup`
+        fact_index = FactIndex(dedup_fp, readonly=True)
+        stand = to_date(cube.metadata['stand'], True)
+    compact = args.output_profile == 'compact'
+    i = 0
+    for data in serialize_facts(facts, cube):
+        if dedup_fp:
+            key, entry = get_fact_key(data['fact_id']), get_entry(data[data['measure']], stand)
+            # duplicates are encoded as well, for the size of the skipped facts
+            duplicate = is_duplicate(fact_index.get(key), entry)
+        if args.fulltext:
+            data.update(get_fulltext_data(data, cube))
+        if args.index_prefix:
+            data['index'] = index
+        if compact:
+            if i % PROFILE_SAMPLE == 0:
+                # estimate the savings on a sample of the facts
+                metrics.inc('profile_samples')
+                metrics.inc('profile_sample_full_bytes', len(encode(data)))
+                metrics.inc('profile_sample_bytes', len(encode(compact_fact(data))))
+            else:
+                compact_fact(data)
+        if args.output:
+            if not (dedup_fp and duplicate):
                 path = os.path.join(args.output, cube.name)
                 os.makedirs(path, exist_ok=True)
-                with open(os.path.join(path, '%s.json' % unpacked_fact['fact_id']), 'w') as f:
+                with open(os.path.join(path, '%s.json' % data['fact_id']), 'w') as f:
                     if args.pretty:
                         json.dump(data, f, indent=2)
                     else:
                         json.dump(data, f)
-            else:
-                if args.pretty:
-                    res.append(json.dumps(data, indent=2))
-                else:
-                    res.append(json.dumps(data))
+            if dedup_fp:
+                res.append((key, entry, None if duplicate else b'', 0))
+        elif dedup_fp:
+            encoded = encode(data)
+            res.append((key, entry, None if duplicate else encoded, len(encoded)))
+        else:
+            res.append(encode(data))
+        i += 1
 
-            i += 1
-
-        if i > 1:
-            logger.log(logging.DEBUG, 'unpacked %s facts' % i)
+    if dedup_fp:
+        fact_index.close()
+    metrics.inc('facts_serialized', i)
+    logger.log(logging.DEBUG, 'unpacked %s facts from %s raw facts' % (i, len(facts)))
     return res
 
 
-def _serialize_cube(cubes, args):
-    for i, cube in enumerate(cubes):
-        logger.info('Loading cube `%s` (%s of %s) ...' % (cube, i + 1, len(cubes)))
-        facts = parallelize(_get_facts, cube.export(args.force_export).facts, cube, args)
-        for fact in facts:
-            yield fact
+def _get_fact_filter(args, regions=True):
+    # `regions`: filter by `--region-levels` as well
+    return FactFilter(
+        region_levels=[int(v) for v in args.region_levels.split(',')] if args.region_levels and regions else None,
+        since=args.since_year,
+        until=args.until_year,
+        measures=[v.strip() for v in args.measures.split(',')] if args.measures else None
+    )
+
+
+def _get_export_target(args):
+    # a filtered export is not an export of the whole cube: it gets its own
+    # timestamp per filter, so that a later unfiltered run still exports the cube
+    fact_filter = _get_fact_filter(args)
+    if fact_filter:
+        return 'last_exported_filter-%s' % fact_filter.key
+    return 'last_exported'
 
 
-def main(args):
+def _load_facts(cube, args, fact_filter=None):
+    # compact records and a `SlimCube` instead of `regenesis` facts and the
+    # `Cube`, cheaper to pass to the workers, the `regenesis` cube (if any) is
+    # only referenced here and dropped before the facts are serialized
+    if fact_filter and fact_filter.measures is not None:
+        # only the metadata sections of the csv are read for this, not the facts
+        with cube.current.read() as reader:
+            if not fact_filter.get_measures(reader.measures):
+                return [], SlimCube(cube)
+    if args.reader == 'native':
+        # the schema (which needs `regenesis`) is only needed for these
+        schema = cube.current.get_schema() if args.fulltext or args.rollup else None
+        with cube.current.read() as reader:
+            return pack_facts(reader.facts(fact_filter), reader), SlimCube(cube, schema)
+    regenesis_cube = cube.export(args.force_export)
+    schema = cube.current.get_schema(regenesis_cube)
+    return pack_facts(regenesis_cube.facts, schema, fact_filter), SlimCube(cube, schema)
+
+
+def _serialize_cube(cube, args, dedup_fp=None, chunked=True):
+    # `chunked`: split the facts of the cube across all cores, otherwise
+    # serialize them in this process (a `scheduler` worker)
+    # return: `(loaded, facts)`, `loaded`: the time before the cube was read,
+    # for its `last_exported` (see `_write_cube`)
+    logger.info('Loading cube `%s` ...' % cube)
+    loaded = datetime.now()
+    start = perf_counter()
+    # the region sums of `--rollup` need the facts of all region levels
+    region_filter = args.rollup and args.region_levels
+    fact_filter = _get_fact_filter(args, regions=not region_filter)
+    raw_facts, slim = _load_facts(cube, args, fact_filter)
+    if args.rollup and raw_facts:
+        # `slim` has no schema if the cube was skipped (e.g. by `--measures`)
+        derived = get_rollups(raw_facts, slim, args.hierarchy)
+        metrics.inc('facts_derived', len(derived))
+        raw_facts += derived
+    metrics.inc('facts_filtered', fact_filter.skipped)
+    if region_filter:
+        keeps_region = _get_fact_filter(args).keeps_region
+        filtered = [f for f in raw_facts if keeps_region(f.to_dict())]
+        metrics.inc('facts_filtered', len(raw_facts) - len(filtered))
+        raw_facts = filtered
+    parsed = perf_counter()
+    if chunked:
+        facts = parallelize(_get_facts, raw_facts, slim, args, dedup_fp)
+    else:
+        facts = _get_facts(raw_facts, slim, args, dedup_fp)
+    serialized = perf_counter()
+    metrics.observe('cube_parse_seconds', parsed - start)
+    metrics.observe('cube_serialize_seconds', serialized - parsed)
+    metrics.record_cube(cube.name, parse_seconds=parsed - start, serialize_seconds=serialized - parsed)
+    return loaded, facts
+
+
+def _write_cube_record(cube, fp):
+    # append-only, the last line of a cube is its current record
+    with open(fp, 'a') as f:
+        f.write(json.dumps(get_cube_record(cube)) + '\n')
+
+
+def _report_profile():
+    samples = metrics.get('profile_samples')
+    if samples:
+        full, compact = metrics.get('profile_sample_full_bytes'), metrics.get('profile_sample_bytes')
+        logger.info('Compact profile: about %.0f instead of %.0f bytes per fact (-%.1f%%)' % (
+            compact / samples, full / samples, (1 - compact / full) * 100))
+
+
+def _write_cube(cube, facts, writer, dedup, args, exported=None):
+    # `exported`: timestamp for `last_exported` (default: now), e.g. when the
+    # cube was loaded, so that revisions created meanwhile are exported again
+    i = 0
+    for data in facts:
+        if dedup is not None:
+            key, entry, data, size = data
+            if not dedup.check(key, entry, data, size):
+                continue
+        if not args.output:
+            writer.write(data)
+        i += 1
+    # only commit the export once all facts of this cube are written
+    writer.flush()
+    if dedup is not None:
+        dedup.commit()
+    cube.touch(_get_export_target(args), exported)
+    return i
+
+
+def main(args, stream=None):
+    # `stream`: binary stream to write the facts to (default: stdout)
     if args.output and not os.path.isdir(args.output):
         logger.error('output `%s` not valid.' % args.output)
         raise FileNotFoundError(args.output)
 
+    metrics.start('jsonify')
     storage = Storage(args.storage)
-    cubes = storage.get_cubes_for_export(args.force_export, args.prefix)
+    shard = parse_shard(args.shard) if args.shard else None
+    target = _get_export_target(args)
+    cubes = storage.get_cubes_for_export(args.force_export, args.prefix, shard, target)
     logger.info('Starting to serialize %s cubes from `%s` ...' % (len(cubes), storage))
+    if shard:
+        logger.info('Shard %s of %s: %s bytes of cube data' % (shard[0] + 1, shard[1], sum(c.size for c in cubes)))
+    if args.dedup:
+        # most recent cubes first, so that the freshest version of a duplicate fact is written
+        cubes = sorted(cubes, key=lambda c: to_date(c.metadata['stand'], True), reverse=True)
+        dedup_fp = storage._path('facts_%s-%s.idx' % (shard[0] + 1, shard[1]) if shard else 'facts.idx')
+        dedup = Deduplicator(dedup_fp, reset=args.dedup_reset)
+    else:
+        dedup_fp = dedup = None
+    if args.output_profile == 'compact':
+        # the per-cube fields that the compact facts leave out
+        cube_table = args.cube_table or storage._path('cubes.ndjson')
+        logger.info('Writing cube records to `%s` ...' % cube_table)
 
     i = 0
     if len(cubes) == 0:
         logger.info('Everything seems up to date.')
     else:
-        storage.touch('last_exported')  # set timestamp before to avoid potential race conditions
-        for data in _serialize_cube(cubes, args):
-            if not args.output:
-                sys.stdout.write(data + '\n')
-            i += 1
+        journal = Journal(storage._path('logs'), 'jsonify-%s-%s' % (shard[0] + 1, shard[1]) if shard else 'jsonify',
+                          resume=args.resume)
+        started = datetime.now()
+        with BufferedWriter(stream) as writer:
+            todo = []
+            for j, cube in enumerate(cubes):
+                if journal.is_done(cube.name):
+                    logger.info('Skipping cube `%s` (%s of %s), already done.' % (cube, j + 1, len(cubes)))
+                else:
+                    todo.append(cube)
+            if args.max_memory:
+                # cubes are finished in the order of the scheduler, not by their `stand`
+                scheduler = Scheduler(args.max_memory * MB, memory_factor=args.memory_factor)
+                results = scheduler.run(todo, functools.partial(_serialize_cube, chunked=False), _serialize_cube,
+                                        args, dedup_fp)
+            else:
+                results = ((cube, _serialize_cube(cube, args, dedup_fp)) for cube in todo)
+            for j, (cube, (loaded, facts)) in enumerate(results):
+                i += _write_cube(cube, facts, writer, dedup, args, exported=loaded)
+                if args.output_profile == 'compact':
+                    _write_cube_record(cube, cube_table)
+                logger.info('Finished cube `%s` (%s of %s).' % (cube, j + 1, len(todo)))
+                journal.done(cube.name)
+                # only in this process, the metrics of the workers are merged in by now
+                metrics.maybe_flush(storage._path('logs'))
+            if args.max_memory:
+                logger.info('Peak estimated memory: %s MB' % (scheduler.peak // MB))
+        metrics.inc('bytes_written', writer.bytes_written)
+        if dedup is not None:
+            dedup.close()
+            metrics.inc('facts_deduplicated', dedup.skipped)
+            metrics.inc('dedup_bytes_saved', dedup.bytes_saved)
+            logger.info('Skipped %s duplicate facts (%s bytes saved).' % (dedup.skipped, dedup.bytes_saved))
+        # each shard has its own timestamp
+        storage.touch('%s_%s-%s' % (target, shard[0] + 1, shard[1]) if shard else target, started)
+        journal.finish()
     logger.info('Serialized %s facts.' % i)
+    _report_profile()
+    metrics.flush(storage._path('logs'))
     logger.info('Finished serialize %s cubes from `%s` .' % (len(cubes), storage))
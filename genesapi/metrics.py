@@ -0,0 +1,215 @@
+"""
+collect throughput metrics (counters, timers) of a command and write them as
+prometheus textfile and json summary into the `logs/` dir of the storage
+
+    logs/
+        genesapi_fetch.prom         -   prometheus textfile (e.g. for the node_exporter textfile collector)
+        genesapi_fetch.json         -   json summary including per-cube durations
+
+metrics are collected per process, the workers spawned via
+`util.parallelize` send their metrics back to the parent process together
+with their results, where they are merged.
+
+usage:
+
+    metrics.start('jsonify')
+    metrics.inc('facts_serialized')
+    with metrics.timer('cube_parse_seconds', cube=cube.name):
+        ...
+    metrics.flush(storage._path('logs'))
+"""
+
+
+import json
+import logging
+import os
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+from time import perf_counter, time
+
+
+logger = logging.getLogger(__name__)
+
+
+PREFIX = 'genesapi'
+BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf'))
+FLUSH_INTERVAL = 60  # seconds
+
+
+class Registry:
+    def __init__(self, command=None):
+        self.command = command
+        self.started = time()
+        self.flushed = self.started
+        self.counters = {}
+        self.histograms = {}
+        self.cubes = {}
+        self._lock = threading.Lock()  # e.g. `fetch --concurrency` updates from several threads
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            histogram = self.histograms[key]
+            for i, le in enumerate(BUCKETS):
+                if value <= le:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def record_cube(self, cube, **values):
+        self.cubes.setdefault(cube, {}).update(values)
+
+    def snapshot(self):
+        return {'counters': self.counters, 'histograms': self.histograms, 'cubes': self.cubes}
+
+    def merge(self, snapshot):
+        for key, value in snapshot['counters'].items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, (buckets, total, count) in snapshot['histograms'].items():
+            if key not in self.histograms:
+                self.histograms[key] = [[0] * len(BUCKETS), 0, 0]
+            histogram = self.histograms[key]
+            histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+            histogram[1] += total
+            histogram[2] += count
+        for cube, values in snapshot['cubes'].items():
+            self.record_cube(cube, **values)
+
+    def _get_rates(self):
+        elapsed = time() - self.started
+        return {
+            'run_duration_seconds': elapsed,
+            'facts_per_second': self.get('facts_serialized') / elapsed if elapsed else 0
+        }
+
+    def get(self, name):
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def to_prometheus(self):
+        lines = []
+        command = (('command', self.command),)
+
+        def _labels(labels, **extra):
+            labels = command + labels + tuple(extra.items())
+            return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+        for name in sorted(set(n for n, _ in self.counters)):
+            lines.append('# TYPE %s_%s_total counter' % (PREFIX, name))
+            for (n, labels), value in sorted(self.counters.items()):
+                if n == name:
+                    lines.append('%s_%s_total%s %s' % (PREFIX, name, _labels(labels), value))
+        for name in sorted(set(n for n, _ in self.histograms)):
+            lines.append('# TYPE %s_%s histogram' % (PREFIX, name))
+            for (n, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                if n == name:
+                    for le, value in zip(BUCKETS, buckets):
+                        le = '+Inf' if le == float('inf') else le
+                        lines.append('%s_%s_bucket%s %s' % (PREFIX, name, _labels(labels, le=le), value))
+                    lines.append('%s_%s_sum%s %s' % (PREFIX, name, _labels(labels), total))
+                    lines.append('%s_%s_count%s %s' % (PREFIX, name, _labels(labels), count))
+        for name, value in self._get_rates().items():
+            lines.append('# TYPE %s_%s gauge' % (PREFIX, name))
+            lines.append('%s_%s%s %s' % (PREFIX, name, _labels(()), value))
+        lines.append('# TYPE %s_last_flush_timestamp_seconds gauge' % PREFIX)
+        lines.append('%s_last_flush_timestamp_seconds%s %s' % (PREFIX, _labels(()), time()))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        def _name(name, labels):
+            return '%s%s' % (name, ''.join('[%s=%s]' % label for label in labels))
+
+        return {
+            'command': self.command,
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'updated': datetime.now().isoformat(),
+            **self._get_rates(),
+            'counters': {_name(*k): v for k, v in self.counters.items()},
+            'timers': {_name(*k): {'sum': total, 'count': count, 'avg': total / count if count else 0}
+                       for k, (_, total, count) in self.histograms.items()},
+            'cubes': self.cubes
+        }
+
+
+registry = Registry()
+
+
+def start(command):
+    global registry
+    registry = Registry(command)
+
+
+def is_enabled():
+    return registry.command is not None
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def record_cube(cube, **values):
+    registry.record_cube(cube, **values)
+
+
+def get(name):
+    return registry.get(name)
+
+
+@contextmanager
+def timer(name, **labels):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(name, perf_counter() - start, **labels)
+
+
+def run_collected(func, *args):
+    """
+    call `func(*args)` within a `util.parallelize` worker and return its
+    result together with the metrics collected in this worker
+    """
+    global registry
+    registry = Registry(registry.command)
+    res = func(*args)
+    return res, registry.snapshot()
+
+
+def merge(snapshot):
+    registry.merge(snapshot)
+
+
+def _write(fp, content):
+    # write atomically so that the textfile collector never reads partial files
+    with open('%s.tmp' % fp, 'w') as f:
+        f.write(content)
+    os.replace('%s.tmp' % fp, fp)
+
+
+def flush(directory):
+    if not is_enabled():
+        return
+    os.makedirs(directory, exist_ok=True)
+    name = '%s_%s' % (PREFIX, registry.command)
+    _write(os.path.join(directory, '%s.prom' % name), registry.to_prometheus())
+    _write(os.path.join(directory, '%s.json' % name), json.dumps(registry.to_dict(), indent=2))
+    registry.flushed = time()
+    logger.debug('Wrote metrics for `%s` to `%s`' % (registry.command, directory))
+
+
+def maybe_flush(directory):
+    """flush periodically, at most every `FLUSH_INTERVAL` seconds"""
+    if time() - registry.flushed > FLUSH_INTERVAL:
+        flush(directory)
@@ -0,0 +1,91 @@
+"""
+encode serialized facts to bytes and write them in large buffers
+
+encoders:
+
+- json: stdlib `json` (default), output is exactly the same as `json.dumps`
+- orjson: https://github.com/ijl/orjson (if installed)
+- ujson: https://github.com/ultrajson/ultrajson (if installed)
+
+`orjson` and `ujson` produce equivalent json, but not byte-identical output
+(no whitespace after separators, `orjson` doesn't escape non-ascii chars)
+
+formats:
+
+- json: one json document per line (ndjson)
+- msgpack: a stream of concatenated msgpack documents (requires `msgpack`),
+  e.g. for logstash's `msgpack` codec
+"""
+
+
+import json
+import sys
+
+
+ENCODERS = ('json', 'orjson', 'ujson')
+FORMATS = ('json', 'msgpack')
+BUFFER_SIZE = 4 * 1024 * 1024  # bytes
+
+
+def get_encoder(encoder='json', format='json', pretty=False):
+    """
+    return a function that encodes a serialized fact to bytes
+    """
+    if format == 'msgpack':
+        import msgpack
+        return lambda data: msgpack.packb(data, use_bin_type=True)
+
+    if pretty or encoder == 'json':
+        indent = 2 if pretty else None
+        return lambda data: (json.dumps(data, indent=indent) + '\n').encode('utf-8')
+    if encoder == 'orjson':
+        import orjson
+        return lambda data: orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE)
+    if encoder == 'ujson':
+        import ujson
+        return lambda data: (ujson.dumps(data, escape_forward_slashes=False) + '\n').encode('utf-8')
+    raise ValueError('Unknown encoder `%s`' % encoder)
+
+
+def get_available_encoders():
+    encoders = []
+    for encoder in ENCODERS:
+        try:
+            get_encoder(encoder)
+            encoders.append(encoder)
+        except ImportError:
+            pass
+    return encoders
+
+
+class BufferedWriter:
+    """
+    collect encoded facts and write them to the binary `stream` (default:
+    `sys.stdout.buffer`) in chunks of `buffer_size` bytes
+    """
+    def __init__(self, stream=None, buffer_size=BUFFER_SIZE):
+        if stream is None:
+            sys.stdout.flush()  # don't mix up with text already written to stdout
+            stream = sys.stdout.buffer
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(self.buffer)
+            self.bytes_written += len(self.buffer)
+            self.buffer = bytearray()
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
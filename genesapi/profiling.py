@@ -0,0 +1,136 @@
+"""
+profile any `genesapi` command with cProfile and optionally tracemalloc
+
+    genesapi --profile jsonify.prof jsonify ./data/ > /dev/null
+
+this writes the merged `pstats` data to `jsonify.prof` (to inspect it with
+`python -m pstats` or snakeviz) and a readable report to `jsonify.prof.txt`
+
+the workers spawned via `util.parallelize` are profiled as well: each worker
+dumps its stats into a temporary directory (passed via the environment to the
+forked processes) and they are merged into the main profile at the end.
+
+with `--profile-memory`, tracemalloc is enabled in the main process and in all
+workers and the report contains the peak memory per process and the top
+allocation sites (summed over all processes).
+"""
+
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import tracemalloc
+import uuid
+
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+PROFILE_DIR_ENV = 'GENESAPI_PROFILE_DIR'
+PROFILE_MEMORY_ENV = 'GENESAPI_PROFILE_MEMORY'
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 25
+
+
+def _start(memory):
+    profiler = cProfile.Profile()
+    if memory:
+        if tracemalloc.is_tracing():  # inherited from the parent process via fork
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+    profiler.enable()
+    return profiler
+
+
+def _stop(profiler, memory, name):
+    profiler.disable()
+    directory = os.environ[PROFILE_DIR_ENV]
+    profiler.dump_stats(os.path.join(directory, '%s.prof' % name))
+    if memory:
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        with open(os.path.join(directory, '%s.mem.json' % name), 'w') as f:
+            json.dump({
+                'name': name,
+                'peak': peak,
+                'allocations': [(str(s.traceback), s.size, s.count)
+                                for s in snapshot.statistics('lineno')[:TOP_ALLOCATIONS * 4]]
+            }, f)
+
+
+def run_profiled(func, *args):
+    """
+    call `func(*args)` within a `util.parallelize` worker and dump its stats
+    """
+    memory = bool(os.getenv(PROFILE_MEMORY_ENV))
+    profiler = _start(memory)
+    try:
+        return func(*args)
+    finally:
+        _stop(profiler, memory, 'worker-%s-%s' % (os.getpid(), uuid.uuid4().hex[:8]))
+
+
+def _get_memory_report(directory):
+    processes = []
+    allocations = {}
+    for fn in sorted(os.listdir(directory)):
+        if fn.endswith('.mem.json'):
+            with open(os.path.join(directory, fn)) as f:
+                data = json.load(f)
+            processes.append((data['name'], data['peak']))
+            for site, size, count in data['allocations']:
+                total_size, total_count = allocations.get(site, (0, 0))
+                allocations[site] = (total_size + size, total_count + count)
+
+    lines = ['', 'Peak traced memory per process:', '']
+    lines += ['  %-32s %10.1f MB' % (name, peak / 1024 / 1024) for name, peak in processes]
+    lines += ['', 'Top %s allocation sites (summed over all processes):' % TOP_ALLOCATIONS, '']
+    top = sorted(allocations.items(), key=lambda x: x[1][0], reverse=True)[:TOP_ALLOCATIONS]
+    lines += ['  %10.1f KB %10s blocks  %s' % (size / 1024, count, site) for site, (size, count) in top]
+    return '\n'.join(lines) + '\n'
+
+
+def _write_report(directory, fp, memory):
+    stats_files = [os.path.join(directory, fn) for fn in sorted(os.listdir(directory)) if fn.endswith('.prof')]
+    out = io.StringIO()
+    stats = pstats.Stats(*stats_files, stream=out)
+    stats.dump_stats(fp)
+    out.write('Merged profile of %s processes\n' % len(stats_files))
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+    if memory:
+        out.write(_get_memory_report(directory))
+    with open('%s.txt' % fp, 'w') as f:
+        f.write(out.getvalue())
+
+
+@contextmanager
+def profile(fp, memory=False):
+    """
+    profile everything within this context (including `util.parallelize`
+    workers) and write the merged stats to `fp` and a report to `fp.txt`
+    """
+    directory = tempfile.mkdtemp(prefix='genesapi-profile-')
+    os.environ[PROFILE_DIR_ENV] = directory
+    if memory:
+        os.environ[PROFILE_MEMORY_ENV] = '1'
+    profiler = _start(memory)
+    try:
+        yield
+    finally:
+        _stop(profiler, memory, 'main')
+        _write_report(directory, fp, memory)
+        del os.environ[PROFILE_DIR_ENV]
+        os.environ.pop(PROFILE_MEMORY_ENV, None)
+        shutil.rmtree(directory)
+        logger.info('Saved profile to `%s` and report to `%s.txt`' % (fp, fp))
@@ -0,0 +1,232 @@
+"""
+streaming reader for the *GENESIS* "Datenquader" csv format, a faster
+alternative to parsing cubes with `regenesis.cube.Cube`
+
+the `data.csv` is memory-mapped and read line by line (as `;`-separated csv,
+values may be quoted), it is never loaded into memory as a whole. The (small) metadata sections are parsed first, the
+facts of the `QEI` section are yielded one by one as dicts in the same shape
+as `regenesis.cube.Fact.to_dict()`:
+
+    {
+        'GEMEIN': '03158402',                   # dimensions: value keys
+        'WHGGR1': 'WHGRME05',
+        'STAG': {                               # time (if the cube has one)
+            'value': '31.12.2016',
+            'from': datetime(2016, 12, 31, 0, 0),
+            'until': datetime(2016, 12, 31, 23, 59, 59)
+        },
+        'WOHNY1': {                             # measures
+            'value': 1120,
+            'quality': 'e',
+            'locked': '',
+            'error': '0'
+        }
+    }
+
+usage:
+
+    with Reader('data.csv') as reader:
+        reader.measures  # ('WOHNY1',)
+        for fact in reader.facts():
+            ...
+
+`genesapi bench` compares the facts of this reader with `regenesis` (if
+installed) for every benchmarked cube.
+"""
+
+
+import csv
+import mmap
+import sys
+
+from datetime import datetime
+
+
+FACTS_SECTION = 'QEI'
+TIME_FIELD = 'ZI-WERT'  # column of the time value in the facts, missing for cubes without time
+MEASURE_FIELDS = (('value', 'WERT'), ('quality', 'QUALITAET'), ('locked', 'GESPERRT'),
+                  ('error', 'WERT-VERFAELSCHT'))
+
+
+def _to_number(value):
+    value = value.strip()
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value.replace(',', '.'))
+    except ValueError:
+        return
+
+
+def _get_time(key, value):
+    if key == 'STAG':
+        date = datetime.strptime(value, '%d.%m.%Y')
+        return {'value': value, 'from': date, 'until': date.replace(hour=23, minute=59, second=59)}
+    if key == 'JAHR':
+        year = int(value)
+        return {'value': value, 'from': datetime(year, 1, 1), 'until': datetime(year, 12, 31, 23, 59, 59)}
+    return {'value': value, 'from': None, 'until': None}
+
+
+class Reader:
+    def __init__(self, fp):
+        self.fp = fp
+        self.sections = {}  # metadata sections: name -> (header, rows)
+        self._file = open(fp, 'rb')
+        try:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            self._data = None
+        self._facts_header = None
+        self._facts_offset = None
+        self._read_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+        self._file.close()
+
+    def _lines(self, offset=0):
+        # the csv reader pulls one line after another (more only for quoted
+        # line breaks), so `self._data.tell()` is right after the last row
+        if self._data is None:
+            return
+        self._data.seek(offset)
+        lines = (line.decode('utf-8') for line in iter(self._data.readline, b''))
+        for parts in csv.reader(lines, delimiter=';'):
+            if parts:
+                yield parts
+
+    def _read_metadata(self):
+        section = None
+        if self._data is None:
+            return
+        for parts in self._lines():
+            if parts[0] == 'K':
+                section = parts[1]
+                if section == FACTS_SECTION:
+                    self._facts_header = parts[2:]
+                    self._facts_offset = self._data.tell()
+                    return
+                self.sections[section] = (parts[2:], [])
+            elif parts[0] == 'D' and section:
+                self.sections[section][1].append(parts[1:])
+
+    def _get_rows(self, section):
+        header, rows = self.sections.get(section, ((), ()))
+        return [dict(zip(header, row)) for row in rows]
+
+    @property
+    def dimensions(self):
+        # dimension names in the order of their values in the fact keys
+        rows = sorted(self._get_rows('DQA'), key=lambda r: int(r.get('RHF-BSR') or 0))
+        return tuple(sys.intern(r['NAME']) for r in rows)
+
+    @property
+    def time(self):
+        rows = self._get_rows('DQZ')
+        if rows:
+            return sys.intern(rows[0]['NAME'])
+
+    @property
+    def measures(self):
+        return tuple(sys.intern(r['NAME']) for r in self._get_rows('DQI'))
+
+    def facts(self, fact_filter=None):
+        """
+        yield the facts of the cube as dicts (see module docstring),
+        `fact_filter`: optional `genesapi.facts.FactFilter`, excluded facts
+        and measures are skipped before their values are parsed
+        """
+        if self._facts_offset is None:
+            return
+        dimensions, time_key = self.dimensions, self.time
+        # the header has no `D` column: column index in the line = header index + 1
+        time_index = self._facts_header.index(TIME_FIELD) + 1 if TIME_FIELD in self._facts_header else None
+        if time_index is None:
+            time_key = None
+        # column indexes of value, quality, locked, error for each measure
+        indexes = [self._facts_header.index(field, 1) + 1 for _, field in MEASURE_FIELDS]
+        width = len(MEASURE_FIELDS)
+        columns = [(m, [i + n * width for i in indexes]) for n, m in enumerate(self.measures)]
+        if fact_filter:
+            kept = fact_filter.get_measures(self.measures)
+            columns = [c for c in columns if c[0] in kept]
+            if not columns:
+                return
+        times = {}
+        for parts in self._lines(self._facts_offset):
+            if parts[0] == 'K':  # next section
+                return
+            if parts[0] != 'D':
+                continue
+            time = parts[time_index] if time_key else None
+            if fact_filter and not fact_filter.keeps_time(time_key, time):
+                fact_filter.skipped += 1
+                continue
+            fact = {}
+            for dimension, value in zip(dimensions, parts[1].split(',')):
+                fact[dimension] = sys.intern(value)
+            if fact_filter and not fact_filter.keeps_region(fact):
+                fact_filter.skipped += 1
+                continue
+            if time_key:
+                if time not in times:
+                    times[time] = _get_time(time_key, time)
+                fact[time_key] = dict(times[time])
+            for measure, (value, quality, locked, error) in columns:
+                fact[measure] = {'value': _to_number(parts[value]), 'quality': parts[quality],
+                                 'locked': parts[locked], 'error': parts[error]}
+            yield fact
+
+
+def merge_slices(slices):
+    """
+    merge the raw csv data of several slices of a cube (downloaded with
+    different `regionalschluessel` or `startjahr` / `endjahr`) into one
+
+    the sections appear in the order of the first slice, the lines of the
+    metadata sections are the union of all slices (in order of appearance),
+    the facts of all slices are sorted by key and time, so that the result
+    doesn't depend on how the cube was sliced
+    """
+    sections = {}  # `K` line -> `D` lines, ordered by appearance
+    seen = {}
+    for data in slices:
+        section = None
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith('K;'):
+                section = line
+                sections.setdefault(section, [])
+                seen.setdefault(section, set())
+            elif section is not None and line not in seen[section]:
+                sections[section].append(line)
+                seen[section].add(line)
+
+    lines = []
+    for section, rows in sections.items():
+        if section.split(';')[1] == FACTS_SECTION:
+            rows = sorted(rows, key=_get_fact_order)
+        lines.append(section)
+        lines += rows
+    return '\n'.join(lines) + '\n'
+
+
+def _get_fact_order(line):
+    parts = line.split(';', 3)
+    time = parts[2] if len(parts) > 2 else ''
+    try:
+        time = datetime.strptime(time, '%d.%m.%Y').strftime('%Y%m%d')
+    except ValueError:
+        pass
+    return parts[1], time
@@ -0,0 +1,198 @@
+"""
+precompute aggregates of summable measures as additional, derived facts
+
+for the measures of a cube that are `summable` (see `CubeSchema.measures`):
+
+- region rollups: sums up the region hierarchy (see `genesapi.hierarchy`)
+  for the region levels the cube doesn't publish, e.g. the Kreise, Länder
+  and Deutschland of a cube with Gemeinde values
+- dimension totals: sums over all values of a dimension whose values are a
+  complete breakdown (`GLIED_TYP` "DAVON"), e.g. the total over all age
+  groups, at the published region levels
+
+a sum is only derived if all of its parts are present in the cube (all
+children of the region in the hierarchy, all values of the dimension) and
+none of them is missing (e.g. locked). The derived facts have the same shape
+as the facts of the cube (and are serialized the same way) with an
+additional `derived: true`, which is part of their `fact_id`, so they never
+overwrite published facts.
+"""
+
+
+import logging
+
+from genesapi.facts import REGION_KEYS, pack_facts
+from genesapi.hierarchy import Hierarchy
+from genesapi.util import slugify_graphql
+
+
+logger = logging.getLogger(__name__)
+
+
+DISJOINT = 'DAVON'  # `GLIED_TYP` of dimensions whose values add up to the total
+
+
+def _sum(measures):
+    # `measures`: measure dicts of the parts, `None` if a value is missing
+    values = [m.get('value') for m in measures]
+    if any(v is None for v in values):
+        return
+    total = sum(values)
+    if isinstance(total, float):
+        total = round(total, 6)
+    qualities = set(m.get('quality') for m in measures)
+    return {'value': total, 'quality': qualities.pop() if len(qualities) == 1 else '', 'locked': '', 'error': '0'}
+
+
+def _sum_all(parts):
+    # `parts`: `{measure: measure dict}` of each part, sum up the measures all parts have
+    res = {}
+    for measure in set.intersection(*(set(p) for p in parts)):
+        value = _sum([p[measure] for p in parts])
+        if value is not None:
+            res[measure] = value
+    return res
+
+
+class Rollup:
+    """
+    collect the summable measures of the (compact) facts of `cube` and
+    derive the sums, `hierarchy`: `genesapi.hierarchy.Hierarchy` for the
+    region rollups
+    """
+    def __init__(self, cube, hierarchy=None):
+        schema = cube.schema
+        self.summable = set(k for k, m in schema.measures.items() if m.get('summable'))
+        # dimension slug -> all of its value names
+        self.disjoint = {k: set(v['name'] for v in d['values']) for k, d in schema.dimensions.items()
+                         if d.get('GLIED_TYP') == DISJOINT and d['values']}
+        self.hierarchy = hierarchy
+        self.measures = set()  # summable measures of the facts (for `pack_facts`)
+        self.levels = set()  # published region levels
+        self.regions = {}  # other items -> region id -> measures
+        self.totals = {}  # (dimension, other items) -> value -> measures
+        self.nested = set()
+        self._slugs = {}
+        self._parents = {}
+        self._children = {}
+        self._region_levels = {}
+
+    def _slugify(self, key):
+        if key not in self._slugs:
+            self._slugs[key] = slugify_graphql(key, False)
+        return self._slugs[key]
+
+    def _parent(self, region_id):
+        if region_id not in self._parents:
+            self._parents[region_id] = self.hierarchy.parent(region_id) if region_id in self.hierarchy else None
+        return self._parents[region_id]
+
+    def _get_children(self, region_id):
+        if region_id not in self._children:
+            self._children[region_id] = self.hierarchy.children(region_id)
+        return self._children[region_id]
+
+    def _get_level(self, region_id):
+        if region_id not in self._region_levels:
+            self._region_levels[region_id] = self.hierarchy.get_level(region_id)
+        return self._region_levels[region_id]
+
+    def add(self, fact):
+        """
+        `fact`: `genesapi.facts.Fact`
+        """
+        measures = {}
+        other = []
+        region_key = None
+        for key, nested, value in zip(fact.schema.keys, fact.schema.nested, fact.values):
+            if key in fact.schema.measures:
+                if self._slugify(key) in self.summable:
+                    measures[key] = dict(value)
+                    self.measures.add(key)
+            elif key in REGION_KEYS and value and region_key is None:
+                region_key = key
+                region_id = value
+            else:
+                if nested:
+                    self.nested.add(key)
+                other.append((key, value))
+        if not measures:
+            return
+
+        if region_key is not None and self.hierarchy is not None:
+            self.levels.add(REGION_KEYS.index(region_key))
+            self.regions.setdefault(tuple(other), {})[region_id] = measures
+        for i, (key, value) in enumerate(other):
+            if self._slugify(key) in self.disjoint:
+                rest = other[:i] + other[i + 1:]
+                if region_key is not None:
+                    rest = [(region_key, region_id)] + rest
+                self.totals.setdefault((key, tuple(rest)), {})[value] = measures
+
+    def _to_dict(self, items):
+        return {k: dict(v) if k in self.nested else v for k, v in items}
+
+    def _get_region_facts(self):
+        for other, regions in self.regions.items():
+            targets = set()
+            for region_id in regions:
+                parent = self._parent(region_id)
+                while parent is not None:
+                    if self._get_level(parent) not in self.levels:
+                        targets.add(parent)
+                    parent = self._parent(parent)
+
+            resolved = {}
+
+            def _resolve(region_id):
+                if region_id in regions:
+                    return regions[region_id]
+                if region_id not in resolved:
+                    resolved[region_id] = None
+                    children = self._get_children(region_id)
+                    if self._get_level(region_id) not in self.levels and children:
+                        parts = [_resolve(c) for c in children]
+                        if all(parts):
+                            resolved[region_id] = _sum_all(parts) or None
+                return resolved[region_id]
+
+            for region_id in sorted(targets):
+                measures = _resolve(region_id)
+                if measures:
+                    yield {REGION_KEYS[self._get_level(region_id)]: region_id, **self._to_dict(other), **measures,
+                           'derived': True}
+
+    def _get_total_facts(self):
+        for (dimension, other), values in self.totals.items():
+            if set(values) == self.disjoint[self._slugify(dimension)]:
+                measures = _sum_all(list(values.values()))
+                if measures:
+                    yield {**self._to_dict(other), **measures, 'derived': True}
+
+    def facts(self):
+        """
+        yield the derived facts as dicts (in the shape of the cube's facts)
+        """
+        yield from self._get_region_facts()
+        yield from self._get_total_facts()
+
+
+def get_rollups(facts, cube, hierarchy_fp=None):
+    """
+    return the derived facts for the compact `facts` of `cube` as compact
+    `genesapi.facts.Fact` records, region rollups need the binary region
+    hierarchy of `build_regions --hierarchy` (`hierarchy_fp`)
+    """
+    hierarchy = Hierarchy(hierarchy_fp) if hierarchy_fp else None
+    try:
+        rollup = Rollup(cube, hierarchy)
+        if not rollup.summable:
+            return []
+        for fact in facts:
+            rollup.add(fact)
+        res = pack_facts(rollup.facts(), rollup)
+    finally:
+        if hierarchy is not None:
+            hierarchy.close()
+    logger.debug('derived %s facts for cube `%s`' % (len(res), cube))
+    return res
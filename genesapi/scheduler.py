@@ -0,0 +1,126 @@
+"""
+process cubes concurrently within a memory budget
+
+without a budget, `jsonify` loads one cube after another and splits its facts
+into chunks for all cores (`util.parallelize`), so a few huge cubes (e.g. on
+the Gemeinde level) can exceed the available memory, while many small cubes
+leave most of the cores idle.
+
+`Scheduler` instead runs one cube per worker and estimates the memory it
+needs from the size of its `data.csv` (`get_cost`) times a memory factor.
+Cubes are started biggest
+first, as long as the estimated working set of all running cubes stays within
+the budget, smaller cubes fill the remaining budget and idle workers:
+
+    scheduler = Scheduler(max_memory)
+    for cube, result in scheduler.run(cubes, func, large_func, *args):
+        ...
+
+cubes that alone would exceed the budget are processed with `large_func` in
+the main process (e.g. chunked via `util.parallelize`) once all other workers
+are done, so that at most one of them is in memory at a time.
+
+results are yielded in the order the cubes are finished.
+
+the memory factor (`jsonify --memory-factor`, default: `MEMORY_FACTOR`) is the
+peak memory of a worker per byte of `data.csv`. It depends on the shape of the
+cubes (e.g. the length of the dimension names per fact) and the `jsonify`
+options, `genesapi bench` measures it for each reader (`memory_factor`, the
+maximum and the median over its cubes), with the given `--storage` for the
+real cubes.
+"""
+
+
+import logging
+import queue
+
+from genesapi import metrics
+from genesapi.util import CPUS, get_worker
+
+
+logger = logging.getLogger(__name__)
+
+
+# estimated peak memory of serializing a cube per byte of its `data.csv`
+# (parsed facts, compact records, encoded output and its pickled copy for the
+# main process): `genesapi bench` measured 35 to 42 for the `native` reader on
+# synthetic cubes of 6 to 40 MB (`memory_factor`), rounded up. The `regenesis`
+# reader needs more, measure it for the real cubes with `bench --storage`.
+MEMORY_FACTOR = 45
+MB = 1024 * 1024
+
+
+def get_cost(cube, factor=MEMORY_FACTOR):
+    """
+    estimated memory in bytes to serialize `cube`
+    """
+    return int(cube.size * factor)
+
+
+class Scheduler:
+    def __init__(self, budget, workers=CPUS, memory_factor=None):
+        """
+        `budget`: maximum estimated working set in bytes, `memory_factor`:
+        peak memory per byte of `data.csv` (default: `MEMORY_FACTOR`)
+        """
+        self.budget = budget
+        self.workers = workers
+        self.memory_factor = memory_factor or MEMORY_FACTOR
+        self.used = 0
+        self.peak = 0
+
+    def get_cost(self, cube):
+        return get_cost(cube, self.memory_factor)
+
+    def run(self, cubes, func, large_func, *args):
+        """
+        yield `(cube, func(cube, *args))` or `(cube, large_func(cube, *args))`
+        for each cube in `cubes`
+        """
+        from multiprocessing import Pool
+
+        pending = sorted(cubes, key=self.get_cost, reverse=True)
+        func, collect_metrics = get_worker(func)
+        results = queue.Queue()
+        running = 0
+
+        def _done(cube):
+            return lambda res: results.put((cube, res, None))
+
+        def _failed(cube):
+            return lambda e: results.put((cube, None, e))
+
+        with Pool(processes=self.workers) as P:
+            while pending or running:
+                for cube in list(pending):
+                    if running >= self.workers:
+                        break
+                    cost = self.get_cost(cube)
+                    if cost > self.budget or self.used + cost > self.budget:
+                        continue
+                    pending.remove(cube)
+                    running += 1
+                    self.used += cost
+                    self.peak = max(self.peak, self.used)
+                    logger.info('Scheduling cube `%s` (about %s MB, %s MB of %s MB in use) ...'
+                                % (cube, cost // MB, self.used // MB, self.budget // MB))
+                    P.apply_async(func, (cube,) + args, callback=_done(cube), error_callback=_failed(cube))
+
+                if not running:
+                    # only cubes that exceed the budget on their own are left
+                    cube = pending.pop(0)
+                    logger.warning('Cube `%s` needs about %s MB, more than the memory budget of %s MB, '
+                                   'processing it alone ...' % (cube, self.get_cost(cube) // MB, self.budget // MB))
+                    metrics.inc('cubes_over_budget')
+                    yield cube, large_func(cube, *args)
+                    continue
+
+                cube, res, error = results.get()
+                running -= 1
+                self.used -= self.get_cost(cube)
+                if error is not None:
+                    raise error
+                if collect_metrics:
+                    res, snapshot = res
+                    metrics.merge(snapshot)
+                yield cube, res
@@ -0,0 +1,219 @@
+"""
+long-running daemon that keeps the pipeline warm and up to date
+
+instead of cold cron invocations of `fetch`, `build_schema` and `jsonify`,
+`serve` runs them in one process on a schedule (every `--interval` minutes):
+
+1. fetch: poll the *GENESIS* catalog and download updated cubes
+2. build_schema: update the `--schema` file incrementally (`--previous`)
+3. jsonify: serialize only the changed cubes and pipe them into `--pipe`
+   (e.g. logstash)
+
+these stay in memory between runs (and steps), the forked workers inherit
+them:
+
+- imported modules (pandas, zeep, regenesis)
+- the SOAP clients of the main thread (see `soap_services`)
+- the parsed schemas of the last `--schema-cache` cubes (see
+  `storage.SchemaCache`): `jsonify` doesn't parse the cubes again that
+  `build_schema` just parsed, and unchanged cubes that are exported again
+  (e.g. `--force-export`) keep theirs
+- slugified keys and values (see `util.slugify_graphql`)
+
+the storage index is not kept: `fetch` (and other processes, e.g. sharded
+runs) change it between the steps, so each step lists the storage and reads
+the timestamps of the cubes again, which costs a directory listing and a few
+small files per cube.
+
+a unix socket (default: `genesapi.sock` in the storage) accepts one command
+per line and answers with one json line:
+
+    status  -   current state and progress of the daemon
+    run     -   start a run now (instead of waiting for the next interval)
+    stop    -   stop the daemon after the current run
+
+use `genesapi serve <storage> --send status` to send a command to a running
+daemon.
+"""
+
+
+import json
+import logging
+import os
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import traceback
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from importlib import import_module
+
+
+logger = logging.getLogger(__name__)
+
+
+COMMANDS = ('status', 'run', 'stop')
+
+
+def get_args(command, *argv):
+    """
+    return the parsed arguments for a `genesapi` command, as if it was called
+    with `argv` on the command line
+    """
+    from genesapi.entry import COMMANDS
+
+    parser = ArgumentParser(prog='genesapi %s' % command)
+    for args in COMMANDS[command]['args']:
+        args = dict(args)
+        flag = args.pop('flag')
+        parser.add_argument(flag, **args)
+    return parser.parse_args(argv)
+
+
+class Daemon:
+    def __init__(self, args):
+        from genesapi.storage import schema_cache
+
+        self.args = args
+        schema_cache.resize(args.schema_cache)
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.status = {
+            'state': 'starting',
+            'started': datetime.now().isoformat(),
+            'runs': 0,
+            'step': None,
+            'last_run': None,
+            'last_duration': None,
+            'last_error': None,
+            'next_run': None
+        }
+
+    def handle(self, command):
+        if command == 'status':
+            return self.status
+        if command == 'run':
+            self.wakeup.set()
+            return {'ok': True, 'state': self.status['state']}
+        if command == 'stop':
+            self.stop()
+            return {'ok': True}
+        return {'error': 'Unknown command `%s`, use one of: %s' % (command, ', '.join(COMMANDS))}
+
+    def stop(self, *args):
+        self.stopped = True
+        self.wakeup.set()
+
+    def _step(self, step, command, *argv, **kwargs):
+        self.status['step'] = step
+        logger.info('[serve] %s ...' % step)
+        import_module('genesapi.%s' % command).main(get_args(command, *argv), **kwargs)
+
+    def _build_schema(self):
+        fp = self.args.schema
+        argv = [self.args.storage, '--provenance', '%s.provenance.json' % fp]
+        if os.path.exists(fp):
+            argv += ['--previous', fp]
+        with open('%s.tmp' % fp, 'w') as f:
+            self._step('build_schema', 'build_schema', *argv, stream=f)
+        os.replace('%s.tmp' % fp, fp)
+
+    def _jsonify(self):
+        argv = [self.args.storage] + shlex.split(self.args.jsonify_args or '')
+        proc = subprocess.Popen(self.args.pipe, shell=True, stdin=subprocess.PIPE)
+        try:
+            self._step('jsonify', 'jsonify', *argv, stream=proc.stdin)
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+        # after `finally`, so that it doesn't replace an error of `jsonify`
+        if returncode:
+            raise RuntimeError('`%s` exited with %s' % (self.args.pipe, returncode))
+
+    def run(self):
+        started = datetime.now()
+        self.status.update(state='running', last_error=None)
+        try:
+            argv = [self.args.storage]
+            if self.args.prefix:
+                argv += ['--prefix', self.args.prefix]
+            if self.args.slice_threshold:
+                argv += ['--slice-threshold', str(self.args.slice_threshold)]
+            if self.args.concurrency > 1:
+                argv += ['--concurrency', str(self.args.concurrency)]
+            self._step('fetch', 'fetch', *argv)
+            if self.args.schema:
+                self._build_schema()
+            if self.args.pipe:
+                self._jsonify()
+        except Exception as e:
+            logger.error('[serve] Run failed: %s' % e)
+            logger.debug(traceback.format_exc())
+            self.status['last_error'] = '%s: %s' % (e.__class__.__name__, e)
+        self.status.update(state='idle', step=None, runs=self.status['runs'] + 1, last_run=started.isoformat(),
+                           last_duration=(datetime.now() - started).total_seconds())
+
+    def serve_forever(self):
+        while not self.stopped:
+            self.wakeup.clear()
+            self.run()
+            next_run = datetime.now() + timedelta(minutes=self.args.interval)
+            self.status['next_run'] = next_run.isoformat()
+            logger.info('[serve] Next run at %s' % next_run.isoformat())
+            self.wakeup.wait(self.args.interval * 60)
+        self.status['state'] = 'stopped'
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf-8').strip()
+            if command:
+                res = self.server.daemon.handle(command)
+                self.wfile.write((json.dumps(res) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def send(fp, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(fp)
+        sock.sendall(('%s\n' % command).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return json.loads(sock.makefile().readline())
+
+
+def main(args):
+    fp = args.socket or os.path.join(args.storage, 'genesapi.sock')
+    if args.send:
+        sys.stdout.write(json.dumps(send(fp, args.send), indent=2) + '\n')
+        return
+
+    if os.path.exists(fp):
+        try:
+            send(fp, 'status')
+            raise RuntimeError('Another daemon is already listening on `%s`.' % fp)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(fp)  # left over from a crashed daemon
+    daemon = Daemon(args)
+    server = _Server(fp, _Handler)
+    server.daemon = daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    signal.signal(signal.SIGTERM, daemon.stop)
+    logger.info('[serve] Listening on `%s`, running every %s minutes ...' % (fp, args.interval))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(fp)
+        logger.info('[serve] Stopped.')
@@ -1,14 +1,56 @@
 import logging
 import os
-import yaml
-from zeep import Client, Settings
+import threading
+import time
 
+from datetime import date
+
+from genesapi import metrics
 from genesapi.exceptions import UndefinedCatalog, UnexpectedSoapResult
+from genesapi.util import load_yaml, parallelize
 
 
 logger = logging.getLogger(__name__)
 
 
+START_YEAR = 1990
+SLICE_YEARS = 5  # years per slice for `ExportService.get_year_slices`
+STATES = range(1, 17)  # region keys of the Bundeslaender, for `ExportService.get_region_slices`
+
+RETRIES = 3  # retries of failed soap requests, waiting `RETRY_WAIT` * attempt seconds in between
+RETRY_WAIT = 1
+
+_clients = threading.local()
+
+
+def _get_client(url):
+    # loading the wsdl is expensive, keep one client per url (zeep clients are not thread-safe: per thread)
+    from zeep import Client, Settings
+
+    clients = _clients.__dict__.setdefault('clients', {})
+    if url not in clients:
+        clients[url] = Client(url, settings=Settings(strict=False, xml_huge_tree=True))
+    return clients[url]
+
+
+def _call(service, operation, **kwargs):
+    # call `service` (a zeep operation), retry on connection and server errors (http 5xx),
+    # soap faults (e.g. an unknown cube) and client errors won't go away
+    from requests.exceptions import RequestException
+    from zeep.exceptions import TransportError
+
+    for attempt in range(RETRIES + 1):
+        try:
+            with metrics.timer('soap_request_seconds', operation=operation):
+                return service(**kwargs)
+        except (RequestException, TransportError) as e:
+            if attempt == RETRIES or isinstance(e, TransportError) and e.status_code < 500:
+                raise
+            logger.warning('`%s` failed (%s), retrying (%s of %s) ...' % (operation, e, attempt + 1, RETRIES))
+            metrics.inc('soap_retries', operation=operation)
+            time.sleep(RETRY_WAIT * (attempt + 1))
+
+
 class BaseService:
     def __init__(self):
         catalog = os.getenv('CATALOG')
@@ -18,10 +60,9 @@ class BaseService:
         logger.debug('Using `%s` as catalog' % catalog)
 
         with open(catalog) as f:
-            catalog = yaml.load(f.read().strip())
+            catalog = load_yaml(f.read().strip())
 
-        self.client = Client(catalog['%s_url' % self.__class__.__name__.lower().replace('service', '')],
-                             settings=Settings(strict=False, xml_huge_tree=True))
+        self.client = _get_client(catalog['%s_url' % self.__class__.__name__.lower().replace('service', '')])
         self.kwargs = {
             'kennung': catalog['username'],
             'passwort': catalog['password'],
@@ -41,7 +82,7 @@ class IndexService(BaseService):
 
     def get_metadata_for_cube(self, cube_name):
         logger.debug('Obtaining metadata for cube `%s` ...' % cube_name)
-        res = self.service(filter=cube_name, **self.kwargs)
+        res = _call(self.service, 'DatenKatalog', filter=cube_name, **self.kwargs)
         if len(res.datenKatalogEintraege) > 1:
             raise UnexpectedSoapResult('Got more than 1 cube')
         data = res.datenKatalogEintraege[0]
@@ -49,15 +90,19 @@ class IndexService(BaseService):
 
     def filter(self, prefix):
         logger.debug('Look up cubes with name starting with `%s` ...' % prefix)
-        res = self.service(filter='%s*' % prefix, **self.kwargs)
+        res = _call(self.service, 'DatenKatalog', filter='%s*' % prefix, **self.kwargs)
         logger.debug('Found %s cubes with name starting with `%s`' %
                      (len(res.datenKatalogEintraege), prefix))
         if len(res.datenKatalogEintraege) == 500:
             raise UnexpectedSoapResult('Cube list for "%s*" too long' % prefix)
         return [self.to_dict(e) for e in res.datenKatalogEintraege]
 
+    # cube names start with a 5-digit statistic number, the catalog can only
+    # be searched with wildcards and returns max. 500 entries at once
+    prefixes = range(100, 1000)
+
     def __iter__(self):
-        for i in range(100, 1000):
+        for i in self.prefixes:
             for entry in self.filter(i):
                 yield entry
 
@@ -71,7 +116,7 @@ class ExportService(BaseService):
             werte=True,
             metadaten=True,
             zusatz=True,
-            startjahr=1990,
+            startjahr=START_YEAR,
             endjahr='',
             zeitscheiben='',
             inhalte='',
@@ -86,9 +131,13 @@ class ExportService(BaseService):
             stand=''
         )
 
-    def download_cube(self, name):
-        logger.info('Downloading cube `%s` from `%s` ...' % (name, self.client.wsdl.location))
-        res = self.service(namen=name, **self.kwargs)
+    def download_cube(self, name, **kwargs):
+        """
+        `kwargs` overwrite the default request parameters, e.g. to download
+        only a slice of the cube (`startjahr`, `endjahr`, `regionalschluessel`...)
+        """
+        logger.info('Downloading cube `%s` from `%s` %s...' % (name, self.client.wsdl.location, kwargs or ''))
+        res = _call(self.service, 'DatenExport', namen=name, **{**self.kwargs, **kwargs})
         download_metadata = {k: getattr(res, k) for k in res if k != 'quader'}
         cube = res.quader[0]
         cube_metadata = {
@@ -98,3 +147,46 @@ class ExportService(BaseService):
         cube_data = cube.find('quaderDaten').text
         logger.debug('Downloaded cube `%s`.' % name)
         return download_metadata, cube_metadata, cube_data
+
+    @staticmethod
+    def get_year_slices(start=START_YEAR, end=None, years=SLICE_YEARS):
+        end = end or date.today().year
+        return [{'startjahr': year, 'endjahr': min(year + years - 1, end)}
+                for year in range(start, end + 1, years)]
+
+    @staticmethod
+    def get_region_slices(region_key):
+        # all regions of a level (`KREISE`, `GEMEIN`) by their Bundesland
+        return [{'regionalmerkmal': region_key, 'regionalschluessel': '%s*' % str(i).zfill(2)} for i in STATES]
+
+    def download_cube_sliced(self, name, slices):
+        """
+        download the cube in `slices` (request parameters, see `get_*_slices`)
+        concurrently and merge them into one, fall back to a full download if
+        a slice fails or the slices have different `stand`s
+        """
+        from genesapi.reader import merge_slices
+
+        logger.info('Downloading cube `%s` in %s slices ...' % (name, len(slices)))
+        try:
+            parts = list(parallelize(_download_slices, slices, name, threads=True))
+        except Exception as e:
+            logger.warning('Sliced download of cube `%s` failed (%s), downloading it at once.' % (name, e))
+            return self.download_cube(name)
+        parts = [part for part in parts if part[2]]  # slices without data
+        if not parts:
+            return self.download_cube(name)
+        stands = set(part[1]['stand'] for part in parts)
+        if len(stands) > 1:
+            # the cube was updated during the download, don't mix two versions
+            logger.warning('Slices of cube `%s` have different versions (%s), downloading it at once.'
+                           % (name, ', '.join(sorted(map(str, stands)))))
+            metrics.inc('cubes_sliced_mismatch')
+            return self.download_cube(name)
+        download_metadata, cube_metadata, _ = parts[0]
+        return download_metadata, cube_metadata, merge_slices(data for _, _, data in parts)
+
+
+def _download_slices(slices, name):
+    service = ExportService()  # with its own client for this thread
+    return [service.download_cube(name, **kwargs) for kwargs in slices]
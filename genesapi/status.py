@@ -4,11 +4,8 @@ obtain status of the storage and optionally compare with elastic index
 
 
 import logging
-import pandas as pd
 import sys
 
-from elasticsearch import Elasticsearch
-
 from genesapi.storage import Storage
 # from genesapi.util import parallelize
 from genesapi.util import to_date
@@ -30,6 +27,8 @@ def _get_cubes_data(cubes):
 
 
 def main(args):
+    import pandas as pd
+
     logger.info('Obtaining stats for Storage `%s` ...' % args.storage)
     storage = Storage(args.storage)
     # data = parallelize(_get_cubes_data, storage)
@@ -51,6 +50,8 @@ def main(args):
         'remote_status',
         'facts_count']
     if args.host and args.index:
+        from elasticsearch import Elasticsearch
+
         es = Elasticsearch(hosts=[args.host])
         res = es.search(index=args.index, body={'aggs': {'cubes': {'terms': {'field': 'cube', 'size': 20000}}}})
         df_es = pd.DataFrame(
@@ -17,39 +17,56 @@ a `Storage` has a base directory with this layout:
     11111BJ001/                     -   directory for cube name "11111BJ001"
         last_updated                -   plain text file containing date in isoformat
         last_exported               -   plain text file containing date in isoformat
+        .lock                       -   lock file, see `Cube.lock`
         current/                    -   symbolic link to the latest revision directory
         2019-08-07T08:40:20/        -   revision directory for given date (isoformat)
             downloaded              -   plain text file containing date in isoformat
             exported                -   plain text file containing date in isoformat
             meta.yml                -   original metadata from webservice in yaml format
             data.csv                -   original csv data for this cube
+            data.sha1               -   plain text file containing the sha1 hexdigest of `data.csv`
+            unchanged               -   (optional) marker file: `data.csv` is identical to the
+                                        previous revision and hard-linked to it
         2017-06-07T08:40:20/        -   an older revision...
             ...
     11111BJ002/                     -   another cube...
         ...
 
-
+revisions are written to a temporary directory (`.<revision>.tmp`) and renamed
+when complete, the `current` link is replaced atomically, so readers never see
+a half-written revision. `Cube.update` holds an exclusive lock of the cube
+while it creates a revision, readers that need the data and the metadata of
+the same revision (e.g. `sync`) hold a shared one.
 """
 
+import fcntl
+import functools
+import hashlib
 import logging
 import os
-import pandas as pd
 import re
-import yaml
+import shutil
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
-from regenesis.cube import Cube as RegenesisCube
 
+from genesapi import metrics
 from genesapi.exceptions import StorageDoesNotExist, ShouldNotHappen
+from genesapi.facts import SlimSchema
 from genesapi.soap_services import IndexService, ExportService
 from genesapi.util import (
     EXCLUDE_KEYS,
+    GENESIS_REGIONS,
     cached_property,
+    dump_yaml,
     get_value_from_file,
+    load_yaml,
     is_isoformat,
     to_date,
     slugify_graphql,
-    get_region
+    get_region,
+    get_shard
 )
 
 
@@ -59,6 +76,24 @@ logger = logging.getLogger(__name__)
 CUBE_NAME_RE = re.compile(r'^\d{5}[A-Z]')  # FIXME
 
 
+def get_data_hash(cube_data):
+    return hashlib.sha1(cube_data.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def lock_file(fp, shared=False):
+    """
+    hold an (advisory) `flock` on `fp` across processes, blocks until it is
+    acquired
+    """
+    with open(fp, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class Mixin:
     @cached_property
     def last_exported(self):
@@ -71,10 +106,13 @@ class Mixin:
     def _path(self, *paths):
         return os.path.join(self.directory, *paths)
 
-    def touch(self, item):
-        # write current time into `item` (which is a file path)
-        with open(self._path(item), 'w') as f:
-            f.write(datetime.now().isoformat())
+    def touch(self, item, date=None):
+        # write current time (or `date`) into `item` (which is a file path)
+        # atomically, as concurrent runs (e.g. shards) may read it
+        fp = self._path(item)
+        with open('%s.tmp' % fp, 'w') as f:
+            f.write((date or datetime.now()).isoformat())
+        os.replace('%s.tmp' % fp, fp)
 
     def __str__(self):
         return self.name
@@ -134,6 +172,40 @@ class CubeSchema:
         return tuple(a.lower() for a in self.measures.keys()) + EXCLUDE_KEYS
 
 
+class SchemaCache:
+    """
+    parsed schemas (`facts.SlimSchema`) by cube name and data hash, kept for
+    the lifetime of the process: in `genesapi serve`, the changed cubes parsed
+    by `build_schema` are not parsed again for the schema in `jsonify`
+
+    disabled (`size` 0) unless a command enables it, beyond `size` the least
+    recently used schemas are dropped
+    """
+    def __init__(self, size=0):
+        self.size = size
+        self._schemas = OrderedDict()
+
+    def resize(self, size):
+        self.size = size
+        while len(self._schemas) > size:
+            self._schemas.popitem(last=False)
+
+    def get(self, revision, regenesis_cube=None):
+        key = (revision.cube.name, revision.data_hash)
+        if key in self._schemas:
+            metrics.inc('schema_cache_hits')
+            self._schemas.move_to_end(key)
+            return self._schemas[key]
+        schema = SlimSchema(CubeSchema(revision.load() if regenesis_cube is None else regenesis_cube))
+        if self.size:
+            self._schemas[key] = schema
+            self.resize(self.size)
+        return schema
+
+
+schema_cache = SchemaCache()
+
+
 class CubeRevision(Mixin):
     def __init__(self, cube, name):
         self.cube = cube
@@ -152,9 +224,40 @@ class CubeRevision(Mixin):
 
     @cached_property
     def metadata(self):
-        return get_value_from_file(self._path('meta.yml'), transform=yaml.load)
+        return get_value_from_file(self._path('meta.yml'), transform=load_yaml)
+
+    @cached_property
+    def data_hash(self):
+        data_hash = get_value_from_file(self._path('data.sha1'))
+        if data_hash is None and os.path.exists(self._path('data.csv')):
+            # revisions created before hashing was introduced, only hash them once
+            with open(self._path('data.csv')) as f:
+                data_hash = get_data_hash(f.read())
+            with open(self._path('data.sha1'), 'w') as f:
+                f.write(data_hash)
+        return data_hash
+
+    @cached_property
+    def unchanged(self):
+        return os.path.exists(self._path('unchanged'))
+
+    @cached_property
+    def previous(self):
+        revisions = [r for r in self.cube.revisions if r.date < self.date]
+        if revisions:
+            return revisions[0]
 
     def create(self, download_metadata, cube_metadata, cube_data, overwrite=False):
+        """
+        store a new revision, its data is hard-linked to the previous revision
+        if it is byte-identical (`unchanged`)
+
+        the facts of a sliced download (`ExportService.download_cube_sliced`)
+        are ordered differently than a full download, so a switch between
+        both (e.g. the first sliced revision of a cube, or a sliced download
+        that fell back to a full one) is never detected as `unchanged` and
+        the cube is exported again once
+        """
         logger.debug('Creating new revision for cube `%s` ...' % self.cube)
         if overwrite:
             logger.debug('(Force updating)')
@@ -162,34 +265,89 @@ class CubeRevision(Mixin):
             raise ShouldNotHappen(
                 'Revision "%s" for cube "%s" already exists!' %
                 (self.cube.name, self.date.isoformat()))
-        os.makedirs(self.directory, exist_ok=True)
-        self.touch('downloaded')
-        with open(self._path('download.yml'), 'w') as f:
-            f.write(yaml.dump(download_metadata, default_flow_style=False))
-        with open(self._path('meta.yml'), 'w') as f:
-            f.write(yaml.dump(cube_metadata, default_flow_style=False))
-        with open(self._path('data.csv'), 'w') as f:
-            f.write(cube_data)
+        # write everything to a temporary directory first, see module docstring
+        directory = self.directory
+        self.directory = self.cube._path('.%s.tmp' % self.name)
+        try:
+            if os.path.exists(self.directory):  # left over from a crashed run
+                shutil.rmtree(self.directory)
+            os.makedirs(self.directory)
+            self.touch('downloaded')
+            with open(self._path('download.yml'), 'w') as f:
+                f.write(dump_yaml(download_metadata))
+            with open(self._path('meta.yml'), 'w') as f:
+                f.write(dump_yaml(cube_metadata))
+
+            # don't store byte-identical data twice, GENESIS often only bumps the `stand`
+            data_hash = get_data_hash(cube_data)
+            previous = self.previous
+            if previous is not None and previous.data_hash == data_hash:
+                self._link_data(previous)
+            else:
+                # never write through a link to the data of another revision
+                for name in ('data.csv', 'unchanged'):
+                    if os.path.lexists(self._path(name)):
+                        os.remove(self._path(name))
+                self.__dict__['unchanged'] = False
+                with open(self._path('data.csv'), 'w') as f:
+                    f.write(cube_data)
+            with open(self._path('data.sha1'), 'w') as f:
+                f.write(data_hash)
+            self.__dict__['data_hash'] = data_hash
+
+            if self.exists:  # overwrite, keep the gap without this revision short
+                os.rename(directory, '%s.old' % self.directory)
+            os.rename(self.directory, directory)
+            if self.exists:
+                shutil.rmtree('%s.old' % self.directory)
+        finally:
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+            self.directory = directory
+        self.exists = True
 
         # update current symlink
         fp = self.cube._path('current')
-        if os.path.exists(fp):
-            os.remove(fp)
-        os.symlink(self.name, fp)
+        os.symlink(self.name, '%s.tmp' % fp)
+        os.replace('%s.tmp' % fp, fp)
         logger.info('Created new revision `%s` for cube `%s`.' % (self.name, self.cube))
 
+    def _link_data(self, revision):
+        fp = self._path('data.csv')
+        if os.path.lexists(fp):
+            os.remove(fp)
+        try:
+            os.link(revision._path('data.csv'), fp)
+        except OSError:  # e.g. filesystem without hard link support
+            os.symlink(os.path.join(os.pardir, revision.name, 'data.csv'), fp)
+        self.touch('unchanged')
+        self.__dict__['unchanged'] = True
+        logger.info('Data for revision `%s` of cube `%s` is unchanged since revision `%s`.' %
+                    (self.name, self.cube, revision.name))
+
     def load(self):
+        from regenesis.cube import Cube as RegenesisCube
         with open(self._path('data.csv')) as f:
             raw = f.read().strip()
         return RegenesisCube(self.cube.name, raw)
 
+    def read(self):
+        # streaming alternative to `load` without regenesis, see `genesapi.reader`
+        from genesapi.reader import Reader
+        return Reader(self._path('data.csv'))
+
     def as_df(self):
+        import pandas as pd
         return pd.DataFrame(self.load().facts)
 
     @cached_property
     def schema(self):
         return CubeSchema(self.load())
 
+    def get_schema(self, regenesis_cube=None):
+        # `SlimSchema` via the `schema_cache`, `regenesis_cube`: the already parsed data, if any
+        return schema_cache.get(self, regenesis_cube)
+
 
 class Cube(Mixin):
     def __init__(self, name, storage):
@@ -209,9 +367,17 @@ class Cube(Mixin):
     def current(self):
         return self.revisions[0]
 
+    def lock(self, shared=False):
+        """
+        lock this cube (across processes) while a revision is created
+        (exclusive) or read (`shared`), see module docstring
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        return lock_file(self._path('.lock'), shared)
+
     @cached_property
     def metadata(self):
-        return get_value_from_file(self._path('current', 'meta.yml'), transform=yaml.load)
+        return get_value_from_file(self._path('current', 'meta.yml'), transform=load_yaml)
 
     @cached_property
     def facts(self):
@@ -226,6 +392,14 @@ class Cube(Mixin):
     def schema(self):
         return self.current.schema
 
+    @cached_property
+    def size(self):
+        # size of the current data in bytes, as an estimate for the processing costs
+        fp = self._path('current', 'data.csv')
+        if os.path.exists(fp):
+            return os.path.getsize(fp)
+        return 0
+
     def should_update(self, date=None):
         if not self.exists:
             logger.info('Updating cube `%s` because it didn\'t exist yet ...' % self.name)
@@ -240,29 +414,72 @@ class Cube(Mixin):
             logger.debug('Cube `%s` is up to date.' % self.name)
         return should_update
 
-    def update(self, force=False):
+    def get_slices(self, threshold=None):
+        """
+        return request parameters to download this cube in slices if its
+        current data is bigger than `threshold` bytes: by Bundesland for
+        cubes at Kreis or Gemeinde level, otherwise by years
+        """
+        if not threshold or not self.exists or self.size < threshold:
+            return
+        with self.current.read() as reader:
+            dimensions = reader.dimensions
+        for key in ('GEMEIN', 'KREISE'):
+            if key in dimensions:
+                return ExportService.get_region_slices(key)
+        return ExportService.get_year_slices()
+
+    def update(self, force=False, slice_threshold=None):
+        """
+        return `True` if a revision with new data was created
+        """
+        metrics.inc('cubes_checked')
         if force or self.should_update():
-            download_metadata, cube_metadata, cube_data = ExportService().download_cube(self.name)
+            service = ExportService()
+            slices = self.get_slices(slice_threshold)
+            if slices:
+                download_metadata, cube_metadata, cube_data = service.download_cube_sliced(self.name, slices)
+                metrics.inc('cubes_downloaded_sliced')
+            else:
+                download_metadata, cube_metadata, cube_data = service.download_cube(self.name)
+            metrics.inc('cubes_downloaded')
+            metrics.inc('downloaded_bytes', len(cube_data.encode('utf-8')) if cube_data else 0)
             if cube_metadata['stand'] and cube_data:
                 rev_name = to_date(cube_metadata['stand'], force_ws=True).isoformat()
-                revision = CubeRevision(self, rev_name)
-                revision.create(download_metadata, cube_metadata, cube_data, force)
-                self.touch('last_updated')
+                with self.lock():
+                    revision = CubeRevision(self, rev_name)
+                    revision.create(download_metadata, cube_metadata, cube_data, force)
+                    if revision.unchanged:
+                        # nothing new to export, keep `last_updated` so that `should_export` skips it
+                        logger.info('Cube `%s` has a new revision but unchanged data.' % self)
+                        metrics.inc('cubes_unchanged')
+                        return False
+                    self.touch('last_updated')
+                    return True
             else:
                 logger.error('Cube `%s` seems not to be valid' % self)
+                metrics.inc('cubes_invalid')
+        else:
+            metrics.inc('cubes_skipped')
+        return False
 
-    def should_export(self, force=False, prefix=None):
+    def should_export(self, force=False, prefix=None, target='last_exported'):
+        # `target`: timestamp file of the export target, e.g. `last_exported_parquet`
         if prefix and not self.name.startswith(prefix):
             return False
         if force:
             return True
-        if self.last_exported:
-            return self.last_updated > self.last_exported
+        if target == 'last_exported':
+            last_exported = self.last_exported
+        else:
+            last_exported = get_value_from_file(self._path(target), transform=to_date)
+        if last_exported:
+            return self.last_updated > last_exported
         return True
 
     def export(self, force=False):
+        # the caller has to `touch('last_exported')` once the facts are written
         if force or self.should_export():
-            self.touch('last_exported')
             return self.current.load()
 
     @cached_property
@@ -276,6 +493,17 @@ class Cube(Mixin):
         raise ShouldNotHappen('Use this property only if you know this cube exists')
 
 
+def _update_cube(cube, force=False, slice_threshold=None):
+    # return `None` instead of `has_data` if the update failed (after the
+    # retries of `soap_services`), so that one cube doesn't abort the run
+    try:
+        return cube, cube.update(force, slice_threshold)
+    except Exception as e:
+        logger.error('Updating cube `%s` failed: %s: %s' % (cube, e.__class__.__name__, e))
+        metrics.inc('cubes_failed')
+        return cube, None
+
+
 class Storage(Mixin):
     def __init__(self, directory, filelogging=False):
         if not os.path.exists(directory):
@@ -298,17 +526,63 @@ class Storage(Mixin):
     def __len__(self):
         return len(self.cubes)
 
-    def update(self, prefix=None, force=False):
+    def update(self, prefix=None, force=False, journal=None, slice_threshold=None, concurrency=1, callback=None):
+        """
+        `concurrency`: number of cubes to update at once (in threads)
+        `callback`: called with each cube that got new data, right after its
+        revision was created (e.g. to export it, see `genesapi.sync`)
+
+        return the names of the cubes that failed to update, they are not
+        marked as done in the `journal`
+        """
         self.touch('last_updated')  # set timestamp before to avoid potential race conditions
         service = IndexService()
-        if prefix:
-            service = service.filter(prefix)
-        for entry in service:
-            cube = Cube(entry['code'], self)
-            cube.update(force)
-
-    def get_cubes_for_export(self, force=False, prefix=None):
-        return [c for c in self if c.should_export(force, prefix)]
+        pool = None
+        failed = []
+        if concurrency > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(concurrency)
+        try:
+            for _prefix in [prefix] if prefix else service.prefixes:
+                if journal and journal.is_done('prefix:%s' % _prefix):
+                    logger.info('Skipping cubes with prefix `%s`, already done.' % _prefix)
+                    continue
+                cubes = [Cube(entry['code'], self) for entry in service.filter(_prefix)
+                         if not (journal and journal.is_done(entry['code']))]
+                updated = functools.partial(_update_cube, force=force, slice_threshold=slice_threshold)
+                done = True
+                for cube, has_data in pool.imap_unordered(updated, cubes) if pool else map(updated, cubes):
+                    if has_data is None:
+                        failed.append(cube.name)
+                        done = False
+                        continue
+                    if has_data and callback is not None:
+                        callback(cube)
+                    if journal:
+                        journal.done(cube.name)
+                    metrics.maybe_flush(self._path('logs'))
+                if journal and done:
+                    journal.done('prefix:%s' % _prefix)
+        finally:
+            if pool:
+                pool.terminate()
+        return failed
+
+    def get_cubes(self, shard=None):
+        """
+        return all cubes or only the ones for the given `shard` (`(index, total)`)
+
+        shards are computed over all cubes in the storage, weighted by their
+        size, so that every node of a sharded run gets the same split,
+        regardless of which cubes the other nodes already have exported
+        """
+        if shard is None:
+            return self.cubes
+        index, total = shard
+        return get_shard(self.cubes, index, total, weight=lambda c: c.size)
+
+    def get_cubes_for_export(self, force=False, prefix=None, shard=None, target='last_exported'):
+        return [c for c in self.get_cubes(shard) if c.should_export(force, prefix, target)]
 
     def cube(self, name):
         if CUBE_NAME_RE.match(name):
@@ -316,7 +590,7 @@ class Storage(Mixin):
 
     @cached_property
     def cubes(self):
-        return list(self)
+        return [c for c in self]  # `list(self)` would call `__len__` -> recursion
 
     @cached_property
     def _cubes(self):
@@ -331,7 +605,7 @@ class Storage(Mixin):
         return get_value_from_file(self.path('webservice_url'))
 
     @classmethod
-    def create(cls, directory):
+    def create(cls, directory, filelogging=False):
         os.mkdir(directory)
         os.mkdir(os.path.join(directory, 'logs'))
-        return Storage(directory)
+        return Storage(directory, filelogging=filelogging)
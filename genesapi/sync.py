@@ -0,0 +1,182 @@
+"""
+download and export cubes in one pipelined run
+
+`fetch` followed by `jsonify` takes the time of both: the export only starts
+once the whole catalog is checked and downloaded, and then finds the updated
+cubes again by their timestamps. `sync` overlaps them:
+
+    fetch thread        checks and downloads the cubes (`--concurrency`
+                        threads, see `Storage.update`), every cube with new
+                        data is queued right after its revision was created
+    export workers      a pool of `--workers` processes serializes the queued
+                        cubes (one cube per worker, like `jsonify`)
+    main process        writes the facts of each finished cube to `stdout`
+                        and marks it as exported
+
+so a full refresh takes about as long as the slower of both sides. Cubes
+that were downloaded but not exported before (e.g. by `fetch` or an aborted
+`sync`) are queued first.
+
+the workers read a cube under its shared lock (see `Cube.lock`), fetching
+creates revisions under the exclusive lock and atomically, so an export
+never sees a half-written revision or data and metadata of different
+revisions. A cube that gets a new revision while it is exported is exported
+again afterwards, `last_exported` is the time it was loaded.
+
+    genesapi sync ./data/ --concurrency 4 --jsonify-args "--reader native" | logstash -f logstash.conf
+"""
+
+
+import logging
+import queue
+import shlex
+import threading
+
+from datetime import datetime
+from time import perf_counter
+
+from genesapi import metrics
+from genesapi.exceptions import StorageDoesNotExist
+from genesapi.jsonify import _get_export_target, _report_profile, _serialize_cube, _write_cube, _write_cube_record
+from genesapi.output import BufferedWriter
+from genesapi.serve import get_args
+from genesapi.storage import Storage
+from genesapi.util import get_worker
+
+
+logger = logging.getLogger(__name__)
+
+
+# `jsonify` options that need all cubes of a run up front
+UNSUPPORTED_ARGS = ('dedup', 'shard', 'resume', 'max_memory')
+
+
+def _export_cube(cube, args):
+    # runs in a worker: load the current revision under the shared lock
+    with cube.lock(shared=True):
+        return _serialize_cube(cube, args, chunked=False)
+
+
+class Pipeline:
+    def __init__(self, storage, args, export_args):
+        self.storage = storage
+        self.args = args
+        self.export_args = export_args
+        self.events = queue.Queue()  # ('fetched', cube name) or ('exported', cube name, result, error)
+        self.running = set()
+        self.again = set()  # got a new revision while it was exported
+        self.fetching = True
+        self.fetch_seconds = None
+        self.exported = 0
+        self.facts = 0
+        self.cube_table = None
+        if export_args.output_profile == 'compact':
+            self.cube_table = export_args.cube_table or storage._path('cubes.ndjson')
+
+    def _fetch(self):
+        started = perf_counter()
+        try:
+            slice_threshold = self.args.slice_threshold * 1024 * 1024 if self.args.slice_threshold else None
+            self.storage.update(prefix=self.args.prefix, force=self.args.force_update,
+                                slice_threshold=slice_threshold, concurrency=self.args.concurrency,
+                                callback=lambda cube: self.events.put(('fetched', cube.name)))
+            self.fetch_seconds = perf_counter() - started
+            self.events.put(('fetched', None))
+        except Exception as e:
+            self.events.put(('failed', None, None, e))
+
+    def _submit(self, P, func, name):
+        if name in self.running:
+            self.again.add(name)
+            return
+        # a fresh cube, its revisions are read in the worker
+        cube = self.storage.cube(name)
+        self.running.add(name)
+        metrics.inc('cubes_queued')
+        logger.info('Queued cube `%s` for export (%s running).' % (cube, len(self.running)))
+        P.apply_async(func, (cube, self.export_args),
+                      callback=lambda res: self.events.put(('exported', name, res, None)),
+                      error_callback=lambda e: self.events.put(('exported', name, None, e)))
+
+    def run(self, writer, pending):
+        from multiprocessing import Pool
+
+        func, collect_metrics = get_worker(_export_cube)
+        # fork the workers before the fetch thread is started
+        with Pool(processes=self.args.workers) as P:
+            fetcher = threading.Thread(target=self._fetch, daemon=True)
+            fetcher.start()
+            for cube in pending:
+                self._submit(P, func, cube.name)
+            while self.fetching or self.running:
+                event, name, *res = self.events.get()
+                if event == 'failed':
+                    raise res[1]
+                if event == 'fetched':
+                    if name is None:
+                        self.fetching = False
+                        logger.info('Finished fetching in %.1f seconds, %s cubes in export.'
+                                    % (self.fetch_seconds, len(self.running)))
+                    else:
+                        self._submit(P, func, name)
+                    continue
+
+                res, error = res
+                self.running.remove(name)
+                if error is not None:
+                    raise error
+                if collect_metrics:
+                    res, snapshot = res
+                    metrics.merge(snapshot)
+                loaded, facts = res
+                cube = self.storage.cube(name)
+                self.facts += _write_cube(cube, facts, writer, None, self.export_args, loaded)
+                if self.cube_table:
+                    _write_cube_record(cube, self.cube_table)
+                self.exported += 1
+                logger.info('Exported cube `%s` (%s done, %s running).' % (cube, self.exported, len(self.running)))
+                metrics.maybe_flush(self.storage._path('logs'))
+                if name in self.again:
+                    self.again.remove(name)
+                    self._submit(P, func, name)
+            fetcher.join()
+
+
+def main(args, stream=None):
+    # `stream`: binary stream to write the facts to (default: stdout)
+    export_args = get_args('jsonify', args.storage, *shlex.split(args.jsonify_args or ''))
+    for key in UNSUPPORTED_ARGS:
+        if getattr(export_args, key):
+            raise ValueError('`jsonify --%s` is not supported by `sync`.' % key.replace('_', '-'))
+    if export_args.output:
+        raise ValueError('`sync` writes the facts to stdout, `--output` is not supported.')
+
+    metrics.start('sync')
+    try:
+        storage = Storage(args.storage)
+    except StorageDoesNotExist:
+        if args.new:
+            storage = Storage.create(args.storage)
+        else:
+            raise StorageDoesNotExist(
+                'Storage does not exist at `%s`. If you want to create it, use the --new flag.' %
+                args.storage)
+
+    started = datetime.now()
+    start = perf_counter()
+    # downloaded before, but not exported yet
+    target = _get_export_target(export_args)
+    pending = storage.get_cubes_for_export(export_args.force_export, args.prefix, target=target)
+    # cubes are only queued if they need to be exported
+    export_args.force_export = True
+    logger.info('Starting sync for Storage `%s`, %s cubes to export from before ...' % (storage, len(pending)))
+    pipeline = Pipeline(storage, args, export_args)
+    with BufferedWriter(stream) as writer:
+        pipeline.run(writer, pending)
+    metrics.inc('bytes_written', writer.bytes_written)
+    storage.touch(target, started)
+    _report_profile()
+    metrics.flush(storage._path('logs'))
+    logger.info('Finished sync for Storage `%s`: exported %s facts of %s cubes in %.1f seconds '
+                '(fetching: %.1f seconds).' % (storage, pipeline.facts, pipeline.exported,
+                                               perf_counter() - start, pipeline.fetch_seconds))
@@ -1,22 +1,26 @@
 import copy
+import functools
 import json
 import os
 import re
 import sys
 
-import dateutil.parser
-
 from datetime import datetime
-from multiprocessing import Pool, cpu_count
-from slugify import Slugify, GERMAN
 from time import strptime
-from regenesis.util import make_key
 
+from genesapi import metrics
+
+# heavy dependencies (`multiprocessing`, `slugify`, `dateutil`, `regenesis`,
+# `yaml`) are imported where they are used, so that commands and workers that
+# don't need them start faster.
 
-CPUS = cpu_count()
 
+CPUS = os.cpu_count() or 1
 
-slugify_de = Slugify(pretranslate=GERMAN)
+
+slugify_de = None  # initialized on first use, see `slugify`
+make_key = None  # `regenesis.util.make_key`, imported on first use, see `compute_fact_id`
+parse_date = None  # `dateutil.parser.parse`, imported on first use, see `to_date`
 
 
 def get_chunks(iterable, n=CPUS):
@@ -36,11 +40,31 @@ def get_chunks(iterable, n=CPUS):
     return chunks
 
 
-def parallelize(func, iterable, *args):
+def get_worker(func):
+    """
+    wrap `func` to run in a worker process: profile it (if enabled, see
+    `genesapi.profiling`) and collect its metrics
+
+    return: `(func, collect_metrics)`, if `collect_metrics` is true, `func`
+    returns `(result, metrics snapshot)` to `metrics.merge` in the main process
+    """
+    if os.getenv('GENESAPI_PROFILE_DIR'):
+        from genesapi import profiling
+        func = functools.partial(profiling.run_profiled, func)
+    collect_metrics = metrics.is_enabled()
+    if collect_metrics:
+        func = functools.partial(metrics.run_collected, func)
+    return func, collect_metrics
+
+
+def parallelize(func, iterable, *args, threads=False):
     """
     parallelize `func` applied to n chunks of `iterable`
     with optional `args`
 
+    threads: use a pool of threads instead of processes, cheaper to start for
+    small inputs (`func` is not profiled or metered per worker then)
+
     return: flattened generator of `func` returns
     """
     try:
@@ -50,6 +74,13 @@ def parallelize(func, iterable, *args):
 
     chunks = get_chunks(iterable, CPUS)
 
+    collect_metrics = False
+    if threads:
+        from multiprocessing.pool import ThreadPool as Pool
+    else:
+        func, collect_metrics = get_worker(func)
+        from multiprocessing import Pool
+
     if args:
         _args = ([a] * CPUS for a in args)
         with Pool(processes=CPUS) as P:
@@ -58,10 +89,63 @@ def parallelize(func, iterable, *args):
         with Pool(processes=CPUS) as P:
             res = P.map(func, chunks)
 
+    if collect_metrics:
+        for _, snapshot in res:
+            metrics.merge(snapshot)
+        res = [r for r, _ in res]
+
     return (i for r in res for i in r)
 
 
+def parse_shard(value):
+    """
+    parse a shard definition like "2/4" (the second of 4 shards) into a
+    tuple `(index, total)` with a zero-based index
+    """
+    try:
+        index, total = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError('Invalid shard `%s`, use the format `i/N`, e.g. `1/4`' % value)
+    if not 0 < index <= total:
+        raise ValueError('Invalid shard `%s`, `i` must be between 1 and N' % value)
+    return index - 1, total
+
+
+def get_shard(items, index, total, weight=lambda x: 1):
+    """
+    split `items` deterministically into `total` shards of about the same
+    total `weight` and return the items of the shard `index` (zero-based)
+
+    biggest items first, each to the currently lightest shard (items with the
+    same weight are ordered by their string representation)
+    """
+    loads = [0] * total
+    shards = [[] for _ in range(total)]
+    for item in sorted(items, key=lambda x: (-weight(x), str(x))):
+        lightest = loads.index(min(loads))
+        loads[lightest] += weight(item)
+        shards[lightest].append(item)
+    return shards[index]
+
+
+def get_index_name(cube_name, prefix, granularity=5, version=None):
+    """
+    name of the elasticsearch index for the facts of `cube_name`, e.g.
+    `genesapi-12111` (one index per statistic), or with a lower `granularity`
+    `genesapi-121` (one index per group of statistics). An optional `version`
+    is appended (`genesapi-12111-2`) to rebuild an index next to the old one.
+    """
+    name = '%s-%s' % (prefix, cube_name[:granularity])
+    if version:
+        name = '%s-%s' % (name, version)
+    return name
+
+
 def slugify(value, to_lower=True, separator='-'):
+    global slugify_de
+    if slugify_de is None:
+        from slugify import Slugify, GERMAN
+        slugify_de = Slugify(pretranslate=GERMAN)
     return slugify_de(value, to_lower=to_lower, separator=separator)
 
 
@@ -85,9 +169,10 @@ def cube_serializer(value):
 GENESIS_REGIONS = ('dinsg', 'dland', 'regbez', 'kreise', 'gemein')
 META_KEYS = GENESIS_REGIONS + ('stag', 'date', 'jahr', 'year', 'region_id', 'fact_id',
                                'nuts', 'lau', 'cube', 'statistic', 'region_level', 'measure', 'value',
-                               'last_updated', 'last_downloaded', 'last_imported')
+                               'last_updated', 'last_downloaded', 'last_imported', 'derived')
 EXCLUDE_KEYS = GENESIS_REGIONS + ('stag', 'jahr')
-EXCLUDE_FACT_ID_KEYS = set(META_KEYS) - set(('region_id', 'date', 'year'))
+# `derived` facts (see `genesapi.rollup`) get their own ids
+EXCLUDE_FACT_ID_KEYS = set(META_KEYS) - set(('region_id', 'date', 'year', 'derived'))
 REGION_LEVEL_NAMES = (  # FIXME internationalization
     ('Deutschland', 'Deutschland'),
     ('Bundesland', 'Bundesländer'),
@@ -104,6 +189,13 @@ def slugify_graphql(value, to_lower=True):
     """
     if not isinstance(value, str):
         return value
+    return _slugify_graphql(value, to_lower)
+
+
+# the same keys and values come up in every cube and every run (of `genesapi
+# serve`), the forked workers inherit the cache
+@functools.lru_cache(maxsize=2 ** 16)
+def _slugify_graphql(value, to_lower):
     return slugify(value, separator='_', to_lower=to_lower)
 
 
@@ -113,6 +205,9 @@ def compute_fact_id(fact):
     needed for elasticsearch doc_id and for de-duplication
     """
     # FIXME make sure this is really working as expected  xD
+    global make_key
+    if make_key is None:
+        from regenesis.util import make_key
 
     parts = []
     for key, value in fact.items():
@@ -197,10 +292,23 @@ def get_value_from_file(fp, default=None, transform=lambda x: x):
     return default
 
 
+def load_yaml(value):
+    import yaml
+    return yaml.load(value, Loader=yaml.SafeLoader)
+
+
+def dump_yaml(value):
+    import yaml
+    return yaml.dump(value, default_flow_style=False)
+
+
 def to_date(value, force_ws=False):
+    global parse_date
     if not force_ws:
+        if parse_date is None:
+            from dateutil.parser import parse as parse_date
         try:
-            return dateutil.parser.parse(value)
+            return parse_date(value)
         except ValueError:
             pass
     # date format in webservice:
@@ -0,0 +1,47 @@
+import io
+import json
+import os
+
+import pytest
+
+from genesapi import jsonify as _jsonify
+from genesapi.serve import get_args
+from genesapi.storage import CubeRevision, Storage
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def add_cube(storage, name, fixture='99999BJ001.csv', stand='07.08.2019 08:40:20h'):
+    """
+    add the cube `name` with the data of `fixture` to `storage`
+    """
+    with open(os.path.join(FIXTURES, fixture)) as f:
+        data = f.read()
+    cube = storage.cube(name)
+    os.makedirs(cube.directory)
+    CubeRevision(cube, '2019-08-07T08:40:20').create({}, {'stand': stand}, data)
+    cube.touch('last_updated')
+    return cube
+
+
+@pytest.fixture
+def storage(tmp_path):
+    """
+    a storage with the fixture cube `99999BJ001` (see `fixtures/`)
+    """
+    storage = Storage.create(str(tmp_path / 'data'))
+    add_cube(storage, '99999BJ001')
+    return storage
+
+
+@pytest.fixture
+def jsonify():
+    """
+    run `genesapi jsonify <storage> <argv>` and return the written facts
+    """
+    def run(storage, *argv):
+        stream = io.BytesIO()
+        _jsonify.main(get_args('jsonify', storage.directory, *argv), stream=stream)
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+    return run
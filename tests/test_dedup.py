@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+from conftest import add_cube
+from genesapi import metrics
+from genesapi.dedup import Deduplicator, FactIndex, get_entry, get_fact_key
+from genesapi.util import to_date
+
+
+STAND = to_date('07.08.2019 08:40:20h', True)
+VALUE = {'value': 313710, 'quality': 'e'}
+
+
+def test_index_collision(tmp_path):
+    # same first 64 bits of the `fact_id`, different facts
+    a, b = get_fact_key('ab' * 20), get_fact_key('ab' * 8 + 'cd' * 12)
+    with FactIndex(str(tmp_path / 'facts.idx')) as index:
+        index.put(a, 1)
+        assert index.get(b) is None
+        index.put(b, 2)
+        assert (index.get(a), index.get(b), len(index)) == (1, 2, 2)
+
+
+def test_index_grow(tmp_path):
+    keys = [get_fact_key('%040x' % (i * 2 ** 130 // 100000)) for i in range(1, 100000)]
+    with FactIndex(str(tmp_path / 'facts.idx')) as index:
+        for i, key in enumerate(keys):
+            index.put(key, i)
+        assert len(index) == len(keys)
+        assert all(index.get(key) == i for i, key in enumerate(keys))
+
+
+def test_deduplicator(tmp_path):
+    fp = str(tmp_path / 'facts.idx')
+    key, entry = get_fact_key('ab' * 20), get_entry(VALUE, STAND)
+    dedup = Deduplicator(fp)
+    assert dedup.check(key, entry, b'fact', 4)
+    # the same fact again in the same run (another cube)
+    assert not dedup.check(key, entry, b'fact', 4)
+    dedup.commit()
+    dedup.close()
+
+    # next run
+    dedup = Deduplicator(fp)
+    assert not dedup.check(key, entry, None, 4)  # found by a worker
+    assert not dedup.check(key, entry, b'fact', 4)
+    # a new value
+    assert dedup.check(key, get_entry({**VALUE, 'value': 1}, STAND), b'fact', 4)
+    assert (dedup.skipped, dedup.bytes_saved) == (2, 8)
+    dedup.close()
+
+    dedup = Deduplicator(fp, reset=True)
+    assert dedup.check(key, entry, b'fact', 4)
+    dedup.close()
+
+
+def test_legacy_index(tmp_path):
+    fp = str(tmp_path / 'facts.idx')
+    with open(fp, 'wb') as f:
+        f.write(b'GAPIDDP1' + bytes(16))
+    with pytest.raises(ValueError, match='--dedup-reset'):
+        FactIndex(fp)
+
+
+def test_jsonify_dedup(storage, jsonify):
+    # serializing facts needs `regenesis.util.make_key`
+    pytest.importorskip('regenesis.util')
+    facts = jsonify(storage, '--reader', 'native', '--dedup')
+    assert facts
+    assert os.path.exists(storage._path('facts.idx'))
+
+    # nothing changed since the last run
+    assert jsonify(storage, '--reader', 'native', '--dedup', '--force-export') == []
+    assert metrics.get('facts_deduplicated') == len(facts)
+    assert metrics.get('dedup_bytes_saved') > 0
+
+    assert len(jsonify(storage, '--reader', 'native', '--dedup', '--force-export', '--dedup-reset')) == len(facts)
+
+    # a copy of the cube: same facts
+    add_cube(storage, '99999BJ002')
+    assert jsonify(storage, '--reader', 'native', '--dedup') == []
+
+
+def test_jsonify_dedup_shards(storage, jsonify):
+    pytest.importorskip('regenesis.util')
+    add_cube(storage, '99999BJ002')
+    facts = jsonify(storage, '--reader', 'native', '--dedup', '--shard', '1/2')
+    # each shard has its own index, duplicates across shards are not detected
+    assert len(jsonify(storage, '--reader', 'native', '--dedup', '--shard', '2/2')) == len(facts)
+    assert os.path.exists(storage._path('facts_1-2.idx'))
+    assert os.path.exists(storage._path('facts_2-2.idx'))
+    assert jsonify(storage, '--reader', 'native', '--dedup', '--shard', '1/2', '--force-export') == []
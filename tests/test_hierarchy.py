@@ -0,0 +1,57 @@
+import pytest
+
+from genesapi.hierarchy import Hierarchy, build_hierarchy, get_parent, write
+
+
+REGIONS = ('DG', '08', '081', '08111', '08115', '08111000', '09', '09162')
+
+
+@pytest.fixture
+def hierarchy(tmp_path):
+    fp = str(tmp_path / 'regions.bin')
+    write(fp, build_hierarchy({region_id: {} for region_id in REGIONS}))
+    with Hierarchy(fp) as hierarchy:
+        yield hierarchy
+
+
+def test_get_parent():
+    assert get_parent('08111000', REGIONS) == '08111'
+    assert get_parent('08111', REGIONS) == '081'
+    # no Regierungsbezirk: attached to the Land
+    assert get_parent('09162', REGIONS) == '09'
+    assert get_parent('08', REGIONS) == 'DG'
+    assert get_parent('DG', REGIONS) is None
+
+
+def test_build_hierarchy():
+    hierarchy = build_hierarchy({region_id: {} for region_id in REGIONS})
+    assert hierarchy['regions']['081'] == {'level': 2, 'parent': '08', 'children': ['08111', '08115']}
+    assert hierarchy['levels'] == {'0': ['DG'], '1': ['08', '09'], '2': ['081'], '3': ['08111', '08115', '09162'],
+                                   '4': ['08111000']}
+
+
+def test_parent(hierarchy):
+    assert len(hierarchy) == len(REGIONS)
+    assert hierarchy.parent('08111000') == '08111'
+    assert hierarchy.parent('09162') == '09'
+    assert hierarchy.parent('DG') is None
+    assert hierarchy.get_level('081') == 2
+    assert '08115' in hierarchy
+    assert '01' not in hierarchy
+    with pytest.raises(KeyError):
+        hierarchy.parent('01')
+
+
+def test_children(hierarchy):
+    assert hierarchy.children('DG') == ['08', '09']
+    assert hierarchy.children('081') == ['08111', '08115']
+    assert hierarchy.children('08115') == []
+
+
+def test_descendants(hierarchy):
+    assert hierarchy.descendants('08') == ['081', '08111', '08115', '08111000']
+    assert hierarchy.descendants('DG', level=3) == ['08111', '08115', '09162']
+    assert hierarchy.descendants('09', level=2) == []
+    assert hierarchy.level(1) == ['08', '09']
+    with pytest.raises(KeyError):
+        hierarchy.descendants('01')
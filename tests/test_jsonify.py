@@ -0,0 +1,4 @@
+def test_rollup_without_measures(storage, jsonify):
+    # the cube has none of the measures, it is skipped before it is parsed
+    # (no schema for the rollup)
+    assert jsonify(storage, '--rollup', '--measures', 'WOHNY1') == []
@@ -0,0 +1,92 @@
+import os
+
+from datetime import datetime
+
+import pytest
+
+from genesapi.facts import FactFilter
+from genesapi.reader import Reader
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', '99999BJ001.csv')
+FIXTURE_WITHOUT_TIME = os.path.join(os.path.dirname(__file__), 'fixtures', '99999BJ002.csv')
+
+
+def test_metadata():
+    with Reader(FIXTURE) as reader:
+        assert reader.dimensions == ('KREISE', 'GES')
+        assert reader.time == 'STAG'
+        assert reader.measures == ('BEVSTD', 'FLC006')
+        # quoted values with `;` don't shift the columns
+        assert reader.sections['ERH'][1] == [['99999', 'Bevölkerungsstand; Fläche', '01.01.1990', 'JAEHRLICH']]
+        assert ['KREISE', '08111', 'Stuttgart; Landeshauptstadt'] in reader.sections['KMA'][1]
+
+
+def _time(value):
+    date = datetime.strptime(value, '%d.%m.%Y')
+    return {'value': value, 'from': date, 'until': date.replace(hour=23, minute=59, second=59)}
+
+
+def _measure(value, quality='e', locked=''):
+    return {'value': value, 'quality': quality, 'locked': locked, 'error': '0.0'}
+
+
+def test_facts():
+    with Reader(FIXTURE) as reader:
+        facts = list(reader.facts())
+    assert facts == [
+        {'KREISE': '08111', 'GES': 'GESM', 'STAG': _time('31.12.2018'),
+         'BEVSTD': _measure(313710), 'FLC006': _measure(207.3)},
+        {'KREISE': '08111', 'GES': 'GESW', 'STAG': _time('31.12.2018'),
+         'BEVSTD': _measure(320509), 'FLC006': _measure(207.3)},
+        {'KREISE': '08115', 'GES': 'GESM', 'STAG': _time('31.12.2018'),
+         'BEVSTD': _measure(195313), 'FLC006': _measure(617.8)},
+        {'KREISE': '08115', 'GES': 'GESW', 'STAG': _time('31.12.2018'),
+         'BEVSTD': _measure(196327), 'FLC006': _measure(617.8)},
+        {'KREISE': '08111', 'GES': 'GESM', 'STAG': _time('31.12.2019'),
+         'BEVSTD': _measure(314880), 'FLC006': _measure(207.3)},
+        {'KREISE': '08111', 'GES': 'GESW', 'STAG': _time('31.12.2019'),
+         'BEVSTD': _measure(320860), 'FLC006': _measure(207.3)},
+        # missing and locked values
+        {'KREISE': '08115', 'GES': 'GESM', 'STAG': _time('31.12.2019'),
+         'BEVSTD': _measure(None, ''), 'FLC006': _measure(617.8)},
+        {'KREISE': '08115', 'GES': 'GESW', 'STAG': _time('31.12.2019'),
+         'BEVSTD': _measure(None, '', 'X'), 'FLC006': _measure(617.8)},
+    ]
+
+
+def test_facts_without_time():
+    with Reader(FIXTURE_WITHOUT_TIME) as reader:
+        assert reader.time is None
+        assert reader.dimensions == ('DLAND', 'GES')
+        assert reader.measures == ('FLC006',)
+        facts = list(reader.facts())
+        assert facts == [
+            {'DLAND': '08', 'GES': 'GESM', 'FLC006': _measure(35751.5)},
+            {'DLAND': '09', 'GES': 'GESM', 'FLC006': _measure(70541.6)},
+            {'DLAND': '09', 'GES': 'GESW', 'FLC006': _measure(None, '', 'X')},
+        ]
+        # facts without a year are dropped by a time filter
+        fact_filter = FactFilter(region_levels=[1], since=2000)
+        assert list(reader.facts(fact_filter)) == []
+        assert fact_filter.skipped == 3
+        assert list(reader.facts(FactFilter(region_levels=[1]))) == facts
+
+
+def test_filter():
+    fact_filter = FactFilter(region_levels=[3], since=2019, measures=['FLC006'])
+    with Reader(FIXTURE) as reader:
+        facts = list(reader.facts(fact_filter))
+    assert [(f['KREISE'], f['GES'], f['FLC006']['value']) for f in facts] == [
+        ('08111', 'GESM', 207.3), ('08111', 'GESW', 207.3), ('08115', 'GESM', 617.8), ('08115', 'GESW', 617.8)]
+    assert all('BEVSTD' not in f and f['STAG']['value'] == '31.12.2019' for f in facts)
+    assert fact_filter.skipped == 4
+
+
+def test_regenesis_parity():
+    cube = pytest.importorskip('regenesis.cube')
+    with open(FIXTURE) as f:
+        raw = f.read().strip()
+    expected = [fact.to_dict() for fact in cube.Cube('99999BJ001', raw).facts]
+    with Reader(FIXTURE) as reader:
+        assert list(reader.facts()) == expected
@@ -0,0 +1,64 @@
+import os
+
+from types import SimpleNamespace
+
+import pytest
+
+from genesapi.facts import pack_facts
+from genesapi.hierarchy import build_hierarchy, write
+from genesapi.reader import Reader
+from genesapi.rollup import get_rollups
+
+
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', '99999BJ001.csv')
+
+
+@pytest.fixture
+def cube():
+    # the parts of the schema of the fixture cube that the rollups need
+    schema = SimpleNamespace(
+        measures={'BEVSTD': {'summable': True}, 'FLC006': {'summable': True}},
+        dimensions={'GES': {'GLIED_TYP': 'DAVON', 'values': [{'name': 'GESM'}, {'name': 'GESW'}]}}
+    )
+    return SimpleNamespace(name='99999BJ001', schema=schema)
+
+
+@pytest.fixture
+def facts(cube):
+    with Reader(FIXTURE) as reader:
+        return pack_facts(reader.facts(), cube.schema)
+
+
+def _get_sums(derived):
+    res = {}
+    for fact in derived:
+        fact = fact.to_dict()
+        assert fact.pop('derived') is True
+        key = (fact.get('KREISE') or fact.get('REGBEZ') or fact.get('DLAND') or fact.get('DINSG'),
+               fact.get('GES'), fact['STAG']['value'])
+        res[key] = {m: fact[m]['value'] for m in ('BEVSTD', 'FLC006') if m in fact}
+    return res
+
+
+def test_totals(cube, facts):
+    # without a hierarchy: only the sums over all values of `GES`
+    assert _get_sums(get_rollups(facts, cube)) == {
+        ('08111', None, '31.12.2018'): {'BEVSTD': 634219, 'FLC006': 414.6},
+        ('08115', None, '31.12.2018'): {'BEVSTD': 391640, 'FLC006': 1235.6},
+        ('08111', None, '31.12.2019'): {'BEVSTD': 635740, 'FLC006': 414.6},
+        # `BEVSTD` is missing for both values
+        ('08115', None, '31.12.2019'): {'FLC006': 1235.6},
+    }
+
+
+def test_regions(tmp_path, cube, facts):
+    fp = str(tmp_path / 'regions.bin')
+    write(fp, build_hierarchy({r: {} for r in ('DG', '08', '081', '08111', '08115', '09', '09162')}))
+    sums = _get_sums(get_rollups(facts, cube, fp))
+    assert sums[('081', 'GESM', '31.12.2018')] == {'BEVSTD': 509023, 'FLC006': 825.1}
+    assert sums[('08', 'GESW', '31.12.2018')] == {'BEVSTD': 516836, 'FLC006': 825.1}
+    assert sums[('081', 'GESM', '31.12.2019')] == {'FLC006': 825.1}
+    # `09` has no values in the cube, so there is no sum for Deutschland
+    assert not [k for k in sums if k[0] == 'DG']
+    # regions + totals of the published level
+    assert len(sums) == 2 * 2 * 2 + 4
@@ -0,0 +1,35 @@
+from types import SimpleNamespace
+
+from genesapi.scheduler import MEMORY_FACTOR, Scheduler, get_cost
+
+
+CUBES = [SimpleNamespace(name=name, size=size) for name, size in (('small', 10), ('medium', 20), ('big', 100))]
+
+
+def _worker(cube):
+    return 'worker'
+
+
+def _large(cube):
+    return 'large'
+
+
+def test_get_cost():
+    assert get_cost(CUBES[0]) == 10 * MEMORY_FACTOR
+    assert get_cost(CUBES[0], 2.5) == 25
+
+
+def test_scheduler():
+    scheduler = Scheduler(1000, workers=2, memory_factor=5)
+    results = dict((cube.name, res) for cube, res in scheduler.run(CUBES, _worker, _large))
+    assert results == {'small': 'worker', 'medium': 'worker', 'big': 'worker'}
+    assert scheduler.peak <= 1000
+    assert scheduler.used == 0
+
+
+def test_scheduler_memory_factor():
+    # the same budget, but `big` alone exceeds it with a higher factor
+    scheduler = Scheduler(1000, workers=2, memory_factor=20)
+    results = dict((cube.name, res) for cube, res in scheduler.run(CUBES, _worker, _large))
+    assert results == {'small': 'worker', 'medium': 'worker', 'big': 'large'}
+    assert scheduler.peak == 600
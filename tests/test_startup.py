@@ -0,0 +1,28 @@
+import json
+import tempfile
+
+import pytest
+
+from genesapi.bench import STARTUP_COMMANDS, get_import_time
+
+
+BUDGET_MS = 100
+# only imported where they are used, see `genesapi.util`
+HEAVY_MODULES = ('pandas', 'numpy', 'zeep', 'requests', 'regenesis', 'elasticsearch', 'yaml', 'dateutil', 'slugify',
+                 'multiprocessing', 'pyarrow', 'duckdb', 'orjson', 'ujson', 'msgpack')
+
+
+@pytest.fixture(scope='module')
+def schema():
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump({}, f)
+        f.flush()
+        yield f.name
+
+
+@pytest.mark.parametrize('argv', STARTUP_COMMANDS, ids=lambda argv: argv[0])
+def test_startup(argv, schema):
+    total, imports = get_import_time([a.format(schema=schema) for a in argv])
+    imported = set(name.split('.')[0] for name, _ in imports)
+    assert not imported & set(HEAVY_MODULES)
+    assert total < BUDGET_MS
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+from conftest import add_cube
+from genesapi.storage import SchemaCache
+
+
+# stands in for a parsed `regenesis` cube, `CubeSchema` only reads these
+REGENESIS_CUBE = SimpleNamespace(metadata={'statistic': {'name': '99999'}, 'units': {}}, dimensions={})
+
+
+def test_schema_cache_disabled(storage):
+    cache = SchemaCache()
+    revision = storage.cube('99999BJ001').current
+    schema = cache.get(revision, REGENESIS_CUBE)
+    assert schema.statistic == {'name': '99999'}
+    assert cache.get(revision, REGENESIS_CUBE) is not schema
+
+
+def test_schema_cache(storage):
+    cache = SchemaCache(2)
+    revision = storage.cube('99999BJ001').current
+    schema = cache.get(revision, REGENESIS_CUBE)
+    # cached by cube and data hash, not by revision object: no parsing needed
+    assert cache.get(storage.cube('99999BJ001').current) is schema
+
+
+def test_schema_cache_lru(storage):
+    cache = SchemaCache(2)
+    names = ('99999BJ002', '99999BJ003', '99999BJ004')
+    for name in names:
+        add_cube(storage, name)
+    first, second, third = (storage.cube(name).current for name in names)
+    schema = cache.get(first, REGENESIS_CUBE)
+    dropped = cache.get(second, REGENESIS_CUBE)
+    assert cache.get(first) is schema  # most recently used now
+    cache.get(third, REGENESIS_CUBE)
+    assert cache.get(first) is schema
+    assert cache.get(second, REGENESIS_CUBE) is not dropped
+    cache.resize(0)
+    assert cache.get(first, REGENESIS_CUBE) is not schema
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+
+from genesapi.util import get_shard, parse_shard
+
+
+ITEMS = [SimpleNamespace(name=name, size=size) for name, size in
+         (('a', 10), ('b', 7), ('c', 5), ('d', 5), ('e', 3), ('f', 1))]
+
+
+def _size(item):
+    return item.size
+
+
+@pytest.mark.parametrize('value,shard', (('1/1', (0, 1)), ('2/4', (1, 4)), ('4/4', (3, 4))))
+def test_parse_shard(value, shard):
+    assert parse_shard(value) == shard
+
+
+@pytest.mark.parametrize('value', ('0/4', '5/4', '-1/4', '2', '2/', 'a/4', '1/2/3'))
+def test_parse_shard_invalid(value):
+    with pytest.raises(ValueError):
+        parse_shard(value)
+
+
+def test_get_shard():
+    shards = [get_shard(ITEMS, index, 2, weight=_size) for index in range(2)]
+    # biggest first, each to the lightest shard (the first one on a tie)
+    assert [i.name for i in shards[0]] == ['a', 'd', 'f']
+    assert [i.name for i in shards[1]] == ['b', 'c', 'e']
+    assert [sum(i.size for i in shard) for shard in shards] == [16, 15]
+
+
+def test_get_shard_complete():
+    for total in (1, 3, 4, 10):
+        shards = [get_shard(ITEMS, index, total, weight=_size) for index in range(total)]
+        assert sorted(i.name for shard in shards for i in shard) == [i.name for i in ITEMS]
+    assert get_shard(ITEMS, 9, 10, weight=_size) == []
+
+
+def test_get_shard_deterministic():
+    # the same split on every node, regardless of the order of the items
+    shards = [[i.name for i in get_shard(ITEMS, index, 3, weight=_size)] for index in range(3)]
+    reordered = [[i.name for i in get_shard(ITEMS[::-1], index, 3, weight=_size)] for index in range(3)]
+    assert shards == reordered
+    # ties (`c` and `d`) by name
+    assert [[i.name for i in get_shard(ITEMS, index, 6, weight=_size)] for index in range(6)] == \
+        [['a'], ['b'], ['c'], ['d'], ['e'], ['f']]
+
+
+def test_get_shard_unweighted():
+    shards = [get_shard(ITEMS, index, 2) for index in range(2)]
+    assert [len(shard) for shard in shards] == [3, 3]